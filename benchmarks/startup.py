@@ -0,0 +1,138 @@
+import argparse
+import os
+import shlex
+import statistics
+import subprocess # WARNING, POSSIBLE SECURITY ISSUE: Bandit report: 'Consider possible security implications associated with subprocess module.'
+import sys
+import time
+
+
+class StartupBenchmark():
+    """ envySec startup time benchmark.
+    Used to keep shell-integrated calls ('envysec.py -G', 'envysec.py -E path') fast.
+
+    Available methods:
+        public: import_time, command_time, run
+        private: __python
+
+    Required packages (dependencies):
+        built-in: argparse, os, shlex, statistics, subprocess, sys, time
+        3-d party: -
+
+    Measures:
+        import of envysec.py ('python -X importtime'), self time of slowest modules
+        and modules, which must not be imported on startup (see 'HEAVY');
+        wall time of CLI commands over bare interpreter start ('python -c pass').
+    Budgets are in milliseconds, 'run' fails if any is exceeded.
+    """
+
+    HEAVY = ('requests', 'asyncio', 'http.server', 'modules.metadefender', 'modules.clamav', 'modules.hashing', 'modules.service')
+    ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    def __init__(self, runs = 5, python = None):
+        """ Prepare benchmark.
+
+        'runs' - number of runs, median is taken;
+        'python' - interpreter to be benchmarked, None - current one.
+        """
+
+        self.runs = runs
+        self.python = python if python is not None else sys.executable
+
+
+    def import_time(self) -> tuple:
+        """ Import envysec.py with '-X importtime'.
+
+        Return tuple (total import time in ms (median), list of (self time in ms, module) sorted by time, set of imported modules).
+        """
+
+        totals, modules = list(), dict()
+        for _ in range(self.runs):
+            report = self.__python(['-X', 'importtime', '-c', 'import envysec']).stderr
+            for line in report.splitlines():
+                if line.startswith('import time:') is False or 'self [us]' in line:
+                    continue
+                self_us, cumulative_us, module = [field.strip() for field in line[len('import time:'):].split('|')]
+                modules.setdefault(module, list()).append(int(self_us) / 1000)
+                if module == 'envysec':
+                    totals.append(int(cumulative_us) / 1000)
+
+        slowest = sorted(((statistics.median(times), module) for module, times in modules.items()), reverse = True)
+        return statistics.median(totals), slowest, set(modules)
+
+    def command_time(self, command: list) -> float:
+        """ Run envysec.py command.
+
+        'command' - envysec.py arguments (list).
+
+        Return median wall time (ms) over bare interpreter start.
+        """
+
+        def __median(args: list) -> float:
+            times = list()
+            for _ in range(self.runs):
+                start = time.perf_counter()
+                self.__python(args)
+                times.append((time.perf_counter() - start) * 1000)
+            return statistics.median(times)
+
+        return __median([os.path.join(self.ROOT, 'envysec.py')] + command) - __median(['-c', 'pass'])
+
+    def run(self, import_budget = 50, command_budget = 80, commands = (('-G',),), top = 10) -> bool:
+        """ Run benchmark and print report.
+
+        'import_budget' - max import time of envysec.py (ms);
+        'command_budget' - max time of every command over bare interpreter start (ms);
+        'commands' - envysec.py commands to be measured;
+        'top' - number of slowest modules to be shown.
+
+        Return True if all budgets are met.
+        """
+
+        passed = True
+        self.__python(['-m', 'compileall', '-q', 'envysec.py', 'modules']) # As installed: modules are not compiled on every start.
+        total, slowest, imported = self.import_time()
+        print('import envysec: {:.1f} ms (budget {} ms)'.format(total, import_budget))
+        for self_ms, module in slowest[:top]:
+            print('\t{:7.1f} ms  {}'.format(self_ms, module))
+        if total > import_budget:
+            passed = False
+
+        heavy = sorted(module for module in imported if module in self.HEAVY)
+        if len(heavy) > 0:
+            print('imported on startup, but should be imported on first use: {}'.format(', '.join(heavy)))
+            passed = False
+
+        for command in commands:
+            command_ms = self.command_time(list(command))
+            print('envysec.py {}: {:.1f} ms over interpreter start (budget {} ms)'.format(' '.join(command), command_ms, command_budget))
+            if command_ms > command_budget:
+                passed = False
+
+        print('PASSED' if passed is True else 'FAILED')
+        return passed
+
+
+    def __python(self, args: list) -> subprocess.CompletedProcess:
+        """ Run interpreter in repository root, output is captured. """
+
+        return subprocess.run([self.python] + args, cwd = self.ROOT, stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                              universal_newlines = True, check = False)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='startup', description="""
+                                    envySec startup time benchmark. Exit code is 1 if budget is exceeded.
+                                    """)
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs, median is taken (default 5).')
+    parser.add_argument('--import-budget', type=float, default=50, help='Max import time of envysec.py, ms (default 50).')
+    parser.add_argument('--command-budget', type=float, default=80, help='Max time of command over interpreter start, ms (default 80).')
+    parser.add_argument('--command', type=shlex.split, action='append', metavar='ARGS',
+                        help='envysec.py command to be measured, might be repeated (default: --command=-G).')
+    args = parser.parse_args()
+
+    benchmark = StartupBenchmark(runs = args.runs)
+    passed = benchmark.run(import_budget = args.import_budget, command_budget = args.command_budget,
+                           commands = args.command if args.command is not None else (('-G',),))
+    sys.exit(0 if passed is True else 1)
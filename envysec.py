@@ -1,14 +1,19 @@
 import argparse
+import datetime
 import ipaddress
 import logging
 import os
 import shlex
 import sys
+import threading
 import urllib.parse
 
 try:
-    from modules import clamav
-    from modules import metadefender
+    # Heavy modules (clamav, hashing, metadefender with 'requests', service) are imported on first use,
+    # see ConsoleInterface subsystems, so '-G' or '-E' do not pay for them.
+    from modules import exclusions
+    from modules import output
+    from modules import scheduler
     from modules import envy_settings
     from modules import sql_management
 except (ModuleNotFoundError, ImportError):
@@ -27,15 +32,30 @@ class ConsoleInterface():
         and: ipaddress, shlex
 
     Available methods:
-        public: ip_scanner, file_scanner, update, add_exception, remove_exclude, get_exclude
-        private: __show_ip_scan_results, __parse_metadefender_scan, __input_parse
+        public: ip_scanner, file_scanner, update, add_exception, remove_exclude, import_exceptions, get_exclude, preload, close
+        private: __show_ip_scan_results, __verify_detection, __get_scanner, __parse_metadefender_scan, __input_parse, __subsystem
+
+    Subsystems (envy_conf, clam, metadef, databases, hasher) are created on first use,
+    so commands, which need exclude database only, do not read settings or probe ClamAV.
+
+    Independent commands of the same ConsoleInterface are run concurrently (see scheduler.CommandScheduler),
+    so subsystems are shared between threads:
+        subsystems are created once, under lock (see '__subsystem');
+        output writes every record at once, under lock (see output.OutputWriter);
+        databases serialize statements of every DBManager (see sql_management.DBManager);
+        Metadefender requests share pooled session, rate limiter and quota accounting are locked
+        (see metadefender.Metadefender and TokenBucket), as they are for pipeline and async threads;
+        ClamAV keeps state of the running scan (stats, duplicates, return code), so 'update' and 'file_scanner'
+        must not run at the same time (file scan is scheduled after update).
+    Shared attributes (for example, 'metadef.cache_mode') are set before commands are started and only read by them.
     """
 
-    def __init__(self, apikey = None, logging_level = 40):
+    def __init__(self, apikey = None, logging_level = 40, output_format = 'text'):
         """ ClamAV & Metadefender control panel class.
         Used to manage scans.
 
         'apikey' - Metadefender API key, see metadefender.py for more;
+        'output_format' - format of results: 'text', 'json' or 'ndjson' (see output.py);
         'logging_level' - verbosity of logging:
             0 - debug,
             30 - warnings,
@@ -51,26 +71,122 @@ class ConsoleInterface():
         self.envyCLI_Log = logging.getLogger('EnvySec CLI')
         self.envyCLI_Log.debug('Initializing class...')
 
-        try:
-            self.envyCLI_Log.debug('Trying to get default settings...')
-            self.envy_conf = envy_settings.Envyronment_Settings(path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'settings.json'), logging_level = logging_level)
-        except FileNotFoundError:
-            self.envyCLI_Log.debug('Default settings not found, looking for setting.json in current directory...')
-            self.envy_conf = envy_settings.Envyronment_Settings(path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'settings.json'), logging_level = logging_level)
-
-        self.clam = clamav.ClamAV(self.envy_conf.clam_config, logging_level = logging_level)
-        self.metadef = metadefender.Metadefender(self.envy_conf.settings["MetadefenderAPI"], logging_level = logging_level)
+        self.output = output.OutputWriter(output_format, logging_level = logging_level)
 
-        try:
-            self.envyCLI_Log.debug('Trying to find exclude database...')
-            self.exclude_db = sql_management.ExcludeDB(database = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'modules', 'exclude.db'))
-        except FileNotFoundError:
-            self.envyCLI_Log.debug('Database not found!')
-            raise
+        self.logging_level = logging_level
+        self.__subsystems = dict() # Subsystem name: subsystem, see '__subsystem'.
+        self.__subsystems_lock = threading.RLock() # Subsystems are created from each other\'s factories.
 
         self.envyCLI_Log.debug('Class initialized.')
 
 
+    @property
+    def envy_conf(self) -> 'envy_settings.Envyronment_Settings':
+        def __factory():
+            try:
+                self.envyCLI_Log.debug('Trying to get default settings...')
+                return envy_settings.Envyronment_Settings(path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'settings.json'), logging_level = self.logging_level)
+            except FileNotFoundError:
+                self.envyCLI_Log.debug('Default settings not found, looking for setting.json in current directory...')
+                return envy_settings.Envyronment_Settings(path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'settings.json'), logging_level = self.logging_level)
+        return self.__subsystem('envy_conf', __factory)
+
+    @property
+    def clamd_conf(self) -> dict:
+        return self.__subsystem('clamd_conf', lambda: self.envy_conf.clamd_config)
+
+    @property
+    def clam(self) -> 'clamav.ClamAV':
+        def __factory():
+            from modules import clamav
+            if self.clamd_conf["Backend"] == 'clamd':
+                return clamav.ClamAV(self.envy_conf.clam_config, logging_level = self.logging_level, daemon_address = self.clamd_conf["Address"])
+            return clamav.ClamAV(self.envy_conf.clam_config, logging_level = self.logging_level)
+        return self.__subsystem('clam', __factory)
+
+    @property
+    def exclude_db(self) -> sql_management.ExcludeDB:
+        return self.__subsystem('exclude_db', lambda: sql_management.ExcludeDB(database = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'modules', 'exclude.db')))
+
+    @property
+    def state_db(self) -> sql_management.FileStateDB:
+        return self.__subsystem('state_db', lambda: sql_management.FileStateDB(database = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'modules', 'exclude.db')))
+
+    @property
+    def quota_db(self) -> sql_management.QuotaDB:
+        return self.__subsystem('quota_db', lambda: sql_management.QuotaDB(database = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'modules', 'exclude.db')))
+
+    @property
+    def stat_db(self) -> sql_management.StatisticDB:
+        return self.__subsystem('stat_db', lambda: sql_management.StatisticDB(database = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'modules', 'exclude.db')))
+
+    @property
+    def cache_db(self) -> sql_management.CacheDB:
+        return self.__subsystem('cache_db', lambda: sql_management.CacheDB(database = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'modules', 'cache.db'),
+                                                                           max_entries = self.envy_conf.settings.get("MetadefenderCacheSize", 100000)))
+
+    @property
+    def hasher(self) -> 'hashing.HashingService':
+        def __factory():
+            from modules import hashing
+            return hashing.HashingService(workers = self.envy_conf.settings.get("HashWorkers"),
+                                          use_mmap = self.envy_conf.settings.get("HashUseMmap", False),
+                                          drop_cache = self.envy_conf.settings.get("HashDropCache", True),
+                                          memo = self.envy_conf.settings.get("HashMemo", False),
+                                          state_db = self.state_db,
+                                          logging_level = self.logging_level)
+        return self.__subsystem('hasher', __factory)
+
+    @property
+    def metadef(self) -> 'metadefender.Metadefender':
+        def __factory():
+            from modules import metadefender
+            return metadefender.Metadefender(self.envy_conf.settings["MetadefenderAPI"], logging_level = self.logging_level,
+                                             pool_size = self.envy_conf.settings.get("MetadefenderPoolSize", 10),
+                                             timeout = self.envy_conf.settings.get("MetadefenderTimeout", (5, 30)),
+                                             deadline = self.envy_conf.settings.get("MetadefenderDeadline", 120),
+                                             rate_limit = self.envy_conf.settings.get("MetadefenderRateLimit", 10),
+                                             quota_db = self.quota_db,
+                                             daily_quota = self.envy_conf.settings.get("MetadefenderDailyQuota"),
+                                             cache_db = self.cache_db,
+                                             cache_ttl = self.envy_conf.settings.get("MetadefenderCacheTTL"),
+                                             hasher = self.hasher)
+        return self.__subsystem('metadef', __factory)
+
+    @property
+    def async_metadef(self) -> 'metadefender.AsyncMetadefender':
+        def __factory():
+            from modules import metadefender
+            return metadefender.AsyncMetadefender(self.metadef, logging_level = self.logging_level,
+                                                  concurrency = self.envy_conf.settings.get("MetadefenderConcurrency", 10))
+        return self.__subsystem('async_metadef', __factory)
+
+    def preload(self):
+        """ Create all subsystems now (used by service mode, where first job should not wait for them). """
+
+        for name in ('envy_conf', 'clam', 'exclude_db', 'state_db', 'quota_db', 'stat_db', 'cache_db', 'hasher', 'metadef', 'async_metadef'):
+            getattr(self, name)
+
+    def close(self):
+        """ Flush output, log statistic, stop private clamd and close databases.
+        Subsystems never used are not created to be closed.
+        """
+
+        self.output.close()
+        subsystems = dict(self.__subsystems)
+        if 'cache_db' in subsystems:
+            self.envyCLI_Log.info('Metadefender cache statistic: {}'.format(subsystems['cache_db'].stats()))
+        if 'metadef' in subsystems:
+            self.envyCLI_Log.info('Metadefender upload statistic: {}'.format(subsystems['metadef'].upload_stats))
+        if 'hasher' in subsystems:
+            self.envyCLI_Log.info('Hash memoization statistic: {}'.format(subsystems['hasher'].memo_stats))
+        if 'clam' in subsystems and subsystems['clam'].daemon_process is not None:
+            subsystems['clam'].stop_daemon()
+        for name in ('exclude_db', 'state_db', 'quota_db', 'stat_db', 'cache_db'):
+            if name in subsystems:
+                subsystems[name].close()
+
+
     def ip_scanner(self, targets: list, geo = False) -> bool:
         """ Scan IP address using Metadefender API.
 
@@ -91,35 +207,34 @@ class ConsoleInterface():
             try:
                 ip_addr = ipaddress.ip_interface(target)
             except ipaddress.AddressValueError as wrong_ip:
-                print('envy_sec: Invalid IP address!')
+                self.output.message('envy_sec: Invalid IP address!')
                 self.envyCLI_Log.error('Invalid IP address: {}!'.format(targets))
                 self.envyCLI_Log.debug('ipaddress.AddressValueError args: {}'.format(wrong_ip))
                 raise
             except ipaddress.NetmaskValueError as wrong_mask:
-                print('envy_sec: Invalid IP mask!')
+                self.output.message('envy_sec: Invalid IP mask!')
                 self.envyCLI_Log.error('invalid IP mask: {}!'.format(targets))
                 self.envyCLI_Log.debug('ipaddress.NetmaskValueError args: {}'.format(wrong_mask))
                 raise
 
-            scan_dump = dict()
-            for ip in ip_addr.network:
-                ip = str(ip)
+            def __global_addresses(network) -> str:
+                """ Yield global addresses of network, report others. """
 
-                self.envyCLI_Log.debug('Gathering information for {}...'.format(ip))
-                if ipaddress.ip_address(ip).is_global is True:
-                    scan_data, geo_data = self.metadef.scan_ip(ip)
+                for ip in network:
+                    ip = str(ip)
+                    if ipaddress.ip_address(ip).is_global is True:
+                        self.envyCLI_Log.debug('Gathering information for {}...'.format(ip))
+                        yield ip
+                    else:
+                        self.envyCLI_Log.warning('Invalid IP address: {}!'.format(ip))
+                        self.output.message('{} is not global IP, so not scanned.'.format(ip))
 
-                    scan_dump[ip] = dict()
-                    scan_dump[ip]['ScanData'] = scan_data
-                    scan_dump[ip]['GeoData'] = geo_data
-                    self.envyCLI_Log.info('Gathering info for {} successfully done.'.format(ip))
-                else:
-                    self.envyCLI_Log.warning('Invalid IP address: {}!'.format(ip))
-                    print('{} is not global IP, so not scanned.'.format(ip))
+            for ip, scan_data, geo_data in self.metadef.scan_ip_bulk(__global_addresses(ip_addr.network)):
+                self.envyCLI_Log.info('Gathering info for {} successfully done.'.format(ip))
 
-            self.envyCLI_Log.debug('Calling for __show_ip_scan_results...')
-            if self.__show_scan_results(scan_dump, geo = geo) is True:
-                self.envyCLI_Log.info('Scanning {} is done.'.format(ip))
+                self.envyCLI_Log.debug('Calling for __show_ip_scan_results...')
+                if self.__show_scan_results('ip', ip, scan_data, geo_data if geo is True else None) is True: # Written as soon as received.
+                    self.envyCLI_Log.info('Scanning {} is done.'.format(ip))
 
         self.envyCLI_Log.info('Scan complete.')
         return True
@@ -139,27 +254,27 @@ class ConsoleInterface():
         targets = self.__targets_parse(targets)
 
         self.envyCLI_Log.debug('Starting url_scanner...')
+        addresses = list()
         for target in targets:
             try:
-                url_addr = urllib.parse.quote(urllib.parse.urlparse(target).geturl())
+                addresses.append(urllib.parse.quote(urllib.parse.urlparse(target).geturl()))
             except ValueError as wrong_url:
-                print('envy_sec: Invalid URL!')
+                self.output.message('envy_sec: Invalid URL!')
                 self.envyCLI_Log.error('invalid URL mask: {}!'.format(targets))
                 self.envyCLI_Log.debug('ValueError args: {}'.format(wrong_url))
                 raise
 
-            scan_dump = dict()
-            self.envyCLI_Log.debug('Gathering information for {}...'.format(url_addr))
-            scan_data = self.metadef.scan_url(url_addr)
-            if scan_data is False:
+        self.envyCLI_Log.debug('Gathering information for {} URLs concurrently...'.format(len(addresses)))
+        for url_addr, scan_data in self.async_metadef.scan_many('scan_url', addresses):
+            if isinstance(scan_data, Exception) is True:
+                raise scan_data
+            elif scan_data is False:
                 raise ConnectionError('')
 
-            scan_dump[url_addr] = dict()
-            scan_dump[url_addr]['ScanData'] = scan_data
             self.envyCLI_Log.info('Gathering info for {} successfully done.'.format(url_addr))
 
             self.envyCLI_Log.debug('Calling for __show_url_scan_results...')
-            if self.__show_scan_results(scan_dump) is True:
+            if self.__show_scan_results('url', url_addr, scan_data) is True:
                 self.envyCLI_Log.info('Scanning {} is done.'.format(url_addr))
 
         self.envyCLI_Log.info('Scan complete.')
@@ -180,75 +295,85 @@ class ConsoleInterface():
         targets = self.__targets_parse(targets)
 
         self.envyCLI_Log.debug('Starting domain_scanner...')
+        addresses = list()
         for target in targets:
             try:
-                domain_addr = urllib.parse.quote(urllib.parse.urlparse(target).geturl())
+                addresses.append(urllib.parse.quote(urllib.parse.urlparse(target).geturl()))
             except ValueError as wrong_domain:
-                print('envy_sec: Invalid domain!')
+                self.output.message('envy_sec: Invalid domain!')
                 self.envyCLI_Log.error('Invalid domain mask: {}!'.format(targets))
                 self.envyCLI_Log.debug('ValueError args: {}'.format(wrong_domain))
                 raise
 
-            scan_dump = dict()
-            self.envyCLI_Log.debug('Gathering information for {}...'.format(domain_addr))
-            scan_data = self.metadef.scan_domain(domain_addr)
-            if scan_data is False:
+        self.envyCLI_Log.debug('Gathering information for {} domains concurrently...'.format(len(addresses)))
+        for domain_addr, scan_data in self.async_metadef.scan_many('scan_domain', addresses):
+            if isinstance(scan_data, Exception) is True:
+                raise scan_data
+            elif scan_data is False:
                 raise ConnectionError('')
 
-            scan_dump[domain_addr] = dict()
-            scan_dump[domain_addr]['ScanData'] = scan_data
             self.envyCLI_Log.info('Gathering info for {} successfully done.'.format(domain_addr))
 
             self.envyCLI_Log.debug('Calling for __show_domain_scan_results...')
-            if self.__show_scan_results(scan_dump) is True:
+            if self.__show_scan_results('domain', domain_addr, scan_data) is True:
                 self.envyCLI_Log.info('Scanning {} is done.'.format(domain_addr))
 
         self.envyCLI_Log.info('Scan complete.')
         return True
 
 
-    def __show_scan_results(self, scan_results: dict, geo = False) -> bool:
-        """ Parse data and print it to std.out. 
+    def __show_scan_results(self, type_: str, target: str, scan_data: dict, geo_data = None) -> bool:
+        """ Write scan results of single target as one record (see output.py).
 
-        'scan_results' - actual scan results (dict), received from Metadefender;
-        'geo' - flag to show geo information about target.
+        'type_' - target type ('ip', 'url', 'domain');
+        'target' - scanned target;
+        'scan_data' - actual scan results (dict), received from Metadefender;
+        'geo_data' - geo information about target, None - not shown.
 
         Return True, if method complete without errors.
         """
 
         try:
-            for target in scan_results:
-                print('{} scan results:'.format(target))
-                for source in scan_results[target]['ScanData']:
-                    print('\t{}: {}'.format(str(source), str(scan_results[target]['ScanData'][source])))
-
-                if geo is True:
-                    print("""{} is placed in {}, {}, {}. Coordinates: {}, {}.""".format(
-                                target, 
-                                scan_results[target]['GeoData']["Country"], 
-                                scan_results[target]['GeoData']["Region"], 
-                                scan_results[target]['GeoData']["City"],
-                                scan_results[target]['GeoData']["Coordinates"]["Latitude"],
-                                scan_results[target]['GeoData']["Coordinates"]["Longitude"]
-                            ))
-        except IndexError as index_err:
+            text = ['{} scan results:'.format(target)]
+            for source in scan_data:
+                text.append('\t{}: {}'.format(str(source), str(scan_data[source])))
+
+            record = {"type": type_, "target": target, "scan": scan_data}
+            if geo_data is not None:
+                record["geo"] = geo_data
+                text.append("""{} is placed in {}, {}, {}. Coordinates: {}, {}.""".format(
+                            target, 
+                            geo_data["Country"], 
+                            geo_data["Region"], 
+                            geo_data["City"],
+                            geo_data["Coordinates"]["Latitude"],
+                            geo_data["Coordinates"]["Longitude"]
+                        ))
+            self.output.record(record, text = '\n'.join(text))
+        except LookupError as index_err:
             self.envyCLI_Log.critical('Unexpected index error.')
-            self.envyCLI_Log.debug('IndexError args: {}'.format(index_err.args))
+            self.envyCLI_Log.debug('LookupError args: {}'.format(index_err.args))
             raise
         else:
             self.envyCLI_Log.debug('Parsing done successfully.')
             return True
 
-    def file_scanner(self, targets: list, exclude = None) -> bool:
+    def file_scanner(self, targets: list, exclude = None, workers = None, full = False) -> bool:
         """ Scan file.
 
         'targets' - list of targets to be sanned;
-        'exclude' - list of paths to be ignored.
+        'exclude' - list of paths to be ignored;
+        'workers' - number of concurrent scanner processes (clamscan) or sessions (clamd).
+            If None, 'ScanWorkers' setting is used (default is number of CPU cores);
+        'full' - flag to scan all files. By default files unchanged since last clean scan
+            with the same or older signatures are skipped (see 'FileState' table in exclude.db).
 
         Return True, if scan complete successfully.
         Return False, if file does not exist or not found.
         """
 
+        from modules import metadefender # Imported on first use, see module imports.
+
         self.envyCLI_Log.debug('Starting file scan.')
         self.envyCLI_Log.debug('Received targets: {}'.format(str(targets)))
 
@@ -257,7 +382,7 @@ class ConsoleInterface():
             exclude = self.exclude_db.get_exceptions()
         self.envyCLI_Log.debug('exclude list: {}'.format(exclude))
 
-        print('Scanning...')
+        self.output.message('Scanning...')
 
         self.envyCLI_Log.debug('Parsing targets...')
         targets = self.__targets_parse(targets)
@@ -274,58 +399,169 @@ class ConsoleInterface():
             self.envyCLI_Log.debug('Start {} existence check.'.format(target))
             if os.path.exists(target.strip('\'\"')) is False:
                 self.envyCLI_Log.error('{} does not exist or might not be accessed.'.format(target))
-                print('{} does not exist.'.format(str(target)))
+                self.output.message('{} does not exist.'.format(str(target)))
                 return False # Just remove 'target' from targets and try to continue
 
         if exclude != []:
             self.envyCLI_Log.debug('Checking targets existence...')
             for exception in exclude:
                 self.envyCLI_Log.debug('Start {} existence check.'.format(target))
-                if os.path.exists(exception.strip('\'\"')) is False:
+                if exclusions.ExclusionMatcher.is_pattern(exception) is True:
+                    self.envyCLI_Log.debug('{} is a pattern, existence is not checked.'.format(exception))
+                elif os.path.exists(exception.strip('\'\"')) is False:
                     self.envyCLI_Log.error('{} does not exist or might not be accessed.'.format(target))
-                    print('{} does not exist, passing anyway.'.format(exception))
+                    self.output.message('{} does not exist, passing anyway.'.format(exception))
+
+        if workers is None:
+            workers = self.envy_conf.settings.get("ScanWorkers", os.cpu_count() or 1)
+        self.envyCLI_Log.debug('Scan workers: {}'.format(workers))
 
         self.envyCLI_Log.debug('Starting {}  scanning...'.format(target))
-        for i in self.clam.scan(targets = targets, exclude = exclude):
-            if str(i).strip().endswith('FOUND') is True:
-                i = i.split(': ')[0]
-
-                self.envyCLI_Log.info('{} considered suspicious, starting Metadefender scan.'.format(i))
-                self.envyCLI_Log.debug('Scanning...')
-                meta_response = list(self.metadef.scan_hash(i, True))
-                self.envyCLI_Log.debug('Response received, parsing...')
-                self.__parse_metadefender_scan(i, meta_response[0], meta_response[1])
-                self.envyCLI_Log.debug('Parsing complete.')
-            elif i is None:
-                self.envyCLI_Log.debug('Process ended without output.')
-                self.envyCLI_Log.info('Process ended without output.')
-            else:
-                self.envyCLI_Log.info('Unexpected behaviour: {}'.format(i))
-                return False
+        exclude = exclusions.ExclusionMatcher(exclude)
+        scanner = self.__get_scanner()
+        scan_output = self.clam.scan(targets = targets, exclude = exclude, workers = workers,
+                                     state_db = self.state_db, full = full, daemon = scanner is not self.clam,
+                                     dedup = self.envy_conf.settings.get("ScanDedup", True), hasher = self.hasher)
+
+        pipeline = metadefender.VerificationPipeline(self.metadef, self.__verify_detection,
+                                                     batch_size = self.envy_conf.settings.get("HashBatchSize", 100),
+                                                     window = self.envy_conf.settings.get("HashBatchWindow", 5),
+                                                     hash_workers = self.hasher.workers,
+                                                     upload_workers = self.envy_conf.settings.get("UploadWorkers", 2),
+                                                     with_hash = True)
+        copies = set() # Copies of queued files, they receive result of the queued one.
+        self.__detections = dict() # Path: (date found, signature), recorded with verdict (see '__verify_detection').
+        try:
+            for i in scan_output:
+                if str(i).strip().endswith('FOUND') is True:
+                    line = i.strip()
+                    i = i.split(': ')[0]
+                    self.__detections[i] = (datetime.datetime.now(), line[len(i) + 2:-len(' FOUND')])
+                    if i in copies:
+                        self.envyCLI_Log.debug('{} is a copy of queued file.'.format(i))
+                        continue
+
+                    self.envyCLI_Log.info('{} considered suspicious, queued for Metadefender lookup.'.format(i))
+                    _copies = [path for path, stat in self.clam.duplicates.get(i, ())]
+                    copies.update(_copies)
+                    pipeline.add(i, copies = _copies)
+                elif i is None:
+                    self.envyCLI_Log.debug('Process ended without output.')
+                    self.envyCLI_Log.info('Process ended without output.')
+                else:
+                    self.envyCLI_Log.info('Unexpected behaviour: {}'.format(i))
+                    return False
+        finally:
+            self.envyCLI_Log.debug('Waiting for Metadefender results...')
+            pipeline.close()
+
+        text = ['{} files scanned.'.format(self.clam.scan_stats["Scanned"])]
+        if self.clam.scan_stats["Skipped"] > 0:
+            text.append('{} unchanged files skipped ({} bytes), use --full to scan them.'.format(self.clam.scan_stats["Skipped"], self.clam.scan_stats["SkippedBytes"]))
+        if self.clam.scan_stats.get("Duplicates", 0) > 0:
+            text.append('{} duplicate files not scanned ({} bytes), they received verdict of their copies.'.format(self.clam.scan_stats["Duplicates"], self.clam.scan_stats["DuplicateBytes"]))
+        self.output.record({"type": "summary", "target": targets, "stats": self.clam.scan_stats}, text = '\n'.join(text))
 
         self.envyCLI_Log.debug('Scan complete.')
         return True
 
-    def __parse_metadefender_scan(self, target: str, scan_result: dict, scan_details: dict) -> bool:
-        """ Parse data and print it to std.out. 
+    def __verify_detection(self, target: str, meta_response, hashsum = None) -> bool:
+        """ Print Metadefender verdict for ClamAV detection and record detection to 'Statistic' table.
+        Used as VerificationPipeline callback (see metadefender.py).
+
+        'target' - path to detected file;
+        'meta_response' - verification result: (scan_result, scan_details), False if report is not received
+            or None if lookup or upload was refused (rate limit or daily quota);
+        'hashsum' - SHA-256 of detected file, None if file can\'t be read.
+
+        Return True if verdict printed.
+        """
+
+        detected, signature = self.__detections.pop(target, (None, None))
+        record = {"type": "file", "target": target, "signature": signature, "sha256": hashsum, "detected": detected}
+        text = list()
+        if hashsum is not None:
+            seen = self.stat_db.seen(hashsum = hashsum)
+            record["seen_before"], record["first_seen"] = seen["Count"], seen["First"]
+            if seen["Count"] > 0:
+                text.append('{}: the same file was detected {} times before, first at {}.'.format(target, seen["Count"], seen["First"]))
+        if isinstance(meta_response, tuple) is True:
+            self.stat_db.record(target, signature = signature, hashsum = hashsum, detected = detected,
+                                total_reports = meta_response[1].get('TotalDetections', 0), verified = datetime.datetime.now())
+        else:
+            self.stat_db.record(target, signature = signature, hashsum = hashsum, detected = detected)
+
+        if meta_response is None:
+            self.envyCLI_Log.warning('{} is not verified, Metadefender rate limit or quota exceeded.'.format(target))
+            record["status"] = 'not_verified'
+            text.append('Results for {}: not verified, Metadefender rate limit or daily quota exceeded.'.format(target))
+            self.output.record(record, text = '\n'.join(text))
+            return False
+        elif meta_response is False:
+            self.envyCLI_Log.warning('Failed to scan {} using Metadefender.'.format(target))
+            record["status"] = 'failed'
+            text.append('Results for {}: failed to receive Metadefender report.'.format(target))
+            self.output.record(record, text = '\n'.join(text))
+            return False
+
+        self.envyCLI_Log.debug('Response received, parsing...')
+        record.update({"status": 'verified', "detections": meta_response[1].get("TotalDetections"),
+                       "engines": meta_response[1].get("TotalAV"), "results": meta_response[0]})
+        text.append(self.__parse_metadefender_scan(target, meta_response[0], meta_response[1]))
+        self.output.record(record, text = '\n'.join(text))
+        self.envyCLI_Log.debug('Parsing complete.')
+        return True
+
+    def __get_scanner(self) -> 'clamav.ClamAV':
+        """ Choose file scanning backend.
+
+        Backend is defined by 'ClamAVBackend' setting (see envy_settings.py).
+        If 'clamd' backend is chosen, but clamd does not respond, private clamd is started
+        on private socket (if 'ClamdManaged' setting is true, configured address is never reused,
+        see ClamAV.start_daemon), otherwise 'clamscan' is used.
+
+        Return object with 'scan' method (ClamD or ClamAV).
+        """
+
+        if self.clam.daemon is not None:
+            self.envyCLI_Log.debug('Checking clamd at {}...'.format(self.clamd_conf["Address"]))
+            if self.clam.daemon.ping() is True:
+                self.envyCLI_Log.info('Using clamd backend.')
+                return self.clam.daemon
+            if self.clamd_conf["Managed"] is True:
+                self.envyCLI_Log.info('Starting private clamd...')
+                try:
+                    if self.clam.start_daemon() is True:
+                        self.envyCLI_Log.info('Using private clamd backend.')
+                        return self.clam.daemon
+                except ValueError as value_err:
+                    self.envyCLI_Log.warning('Failed to start private clamd.')
+                    self.envyCLI_Log.debug('ValueError args: {}'.format(value_err.args))
+            self.envyCLI_Log.warning('clamd is not available, falling back to clamscan.')
+
+        self.envyCLI_Log.info('Using clamscan backend.')
+        return self.clam
+
+    def __parse_metadefender_scan(self, target: str, scan_result: dict, scan_details: dict) -> str:
+        """ Parse data and format it as text.
 
         'target' - path to scanned file;
         'scan_result' - actual file scan result, received from Metadefender;
         'scan_details' - meta information about performed by Metadefender scan.
 
-        Return True if complete without errors.
+        Return text representation of file scan result.
         """
 
         self.envyCLI_Log.debug('Starting parsing Metadefender response.')
         self.envyCLI_Log.debug('Parsing response for {}.'.format(target))
 
-        print('Results for {}:'.format(target))
-        print('\tTotal detections: {}'.format(scan_details["TotalDetections"]))
+        text = ['Results for {}:'.format(target)]
+        text.append('\tTotal detections: {}'.format(scan_details["TotalDetections"]))
         for av in scan_result:
-            print('\t\t{}: {}'.format(av, scan_result[av]))
+            text.append('\t\t{}: {}'.format(av, scan_result[av]))
 
         self.envyCLI_Log.debug('Parsing complete.')
-        return True
+        return '\n'.join(text)
 
     def update(self, verbose = False) -> bool:
         """ Simple update command.
@@ -340,16 +576,16 @@ class ConsoleInterface():
         """
 
         self.envyCLI_Log.debug('Signatures update started.')
-        print('\tUpdating ClamAV signatures...')
+        self.output.message('\tUpdating ClamAV signatures...')
 
         for update_output in self.clam.update():
             if verbose is True:
-                print(update_output)
+                self.output.message(update_output)
             else:
                 pass
 
         self.envyCLI_Log.debug('Signatures update done.')
-        print('\tDone.')
+        self.output.message('\tDone.')
         return True
 
 
@@ -364,17 +600,18 @@ class ConsoleInterface():
         """
 
         self.envyCLI_Log.debug('Parsing targets...')
-        targets = [os.path.abspath(target) for target in targets]
+        targets = [target if exclusions.ExclusionMatcher.is_pattern(target) is True else os.path.abspath(target) for target in targets]
         self.envyCLI_Log.debug('Targets parsed.')
 
-        self.envyCLI_Log.debug('Adding exception...')
-        for target in targets:
-            if self.exclude_db.add_exception(target) is True:
-                self.envyCLI_Log.debug('Exclusion added.')
-                return True
-            else:
-                self.envyCLI_Log.warning('Failed to add exception.')
-                return False
+        self.envyCLI_Log.debug('Adding exceptions...')
+        added = self.exclude_db.add_exceptions(targets) # Single transaction for all targets.
+        if added < 0:
+            self.envyCLI_Log.warning('Failed to add exceptions.')
+            return False
+
+        self.envyCLI_Log.debug('{} exclusions added.'.format(added))
+        self.output.message('{} of {} exceptions added.'.format(added, len(targets)))
+        return True
 
     def remove_exception(self, targets: list) -> bool:
         """ Remove path from exclude database.
@@ -385,16 +622,44 @@ class ConsoleInterface():
         """
 
         self.envyCLI_Log.debug('Checking targets...')
-        targets = [os.path.abspath(target) for target in targets]
+        targets = [target if exclusions.ExclusionMatcher.is_pattern(target) is True else os.path.abspath(target) for target in targets]
         self.envyCLI_Log.debug('Targets removed.')
 
-        self.envyCLI_Log.debug('Removing exception...')
-        for target in targets:
-            if self.exclude_db.remove_exception(target) is True:
-                self.envyCLI_Log.debug('Exception removed.')
-            else:
-                self.envyCLI_Log.info('Failed to remove exception.')
+        self.envyCLI_Log.debug('Removing exceptions...')
+        removed = self.exclude_db.remove_exceptions(targets) # Single transaction for all targets.
+        if removed < 0:
+            self.envyCLI_Log.info('Failed to remove exceptions.')
+            return False
 
+        self.envyCLI_Log.debug('{} exceptions removed.'.format(removed))
+        return True
+
+    def import_exceptions(self, path: str) -> bool:
+        """ Add exceptions listed in file (one path or pattern per line) to exclude database.
+        File is read while exceptions are inserted (single transaction), so it is never loaded into memory.
+
+        'path' - path to file with exceptions, '-' - standard input.
+
+        Return True if exceptions had been added.
+        Return False if file might not be read or database error occurred.
+        """
+
+        self.envyCLI_Log.debug('Importing exceptions from {}...'.format(path))
+        try:
+            with (open(path, 'r', encoding = 'utf-8', errors = 'surrogateescape') if path != '-' else sys.stdin) as exceptions_f:
+                lines = (line.strip() for line in exceptions_f)
+                added = self.exclude_db.add_exceptions(line for line in lines if line != '' and line.startswith('#') is False)
+        except OSError as read_err:
+            self.envyCLI_Log.error('Failed to read {}.'.format(path))
+            self.envyCLI_Log.debug('OSError arguments: {}'.format(str(read_err.args)))
+            self.output.message('{} might not be read.'.format(path))
+            return False
+
+        if added < 0:
+            self.envyCLI_Log.warning('Failed to import exceptions.')
+            return False
+
+        self.output.message('{} exceptions imported.'.format(added))
         return True
 
     def get_exclude(self, get_date: bool = True) -> bool:
@@ -406,17 +671,32 @@ class ConsoleInterface():
         """
 
         self.envyCLI_Log.debug('Getting exclude list...')
-        exceptions = self.exclude_db.get_exceptions()
-        for exception in exceptions:
+        for exception, date in self.exclude_db.iter_exceptions(): # Streamed, exclude list is not loaded into memory.
             self.envyCLI_Log.debug('{} in exclude list;'.format(exception))
-            if get_date is True:
-                print('{}: {}'.format(exception, exceptions[exception]))
-            else:
-                print(exception)
+            self.output.record({"type": "exception", "target": exception, "date": date},
+                               text = '{}: {}'.format(exception, date) if get_date is True else exception)
 
         self.envyCLI_Log.debug('finished getting exceptions.')
         return True
 
+    def __subsystem(self, name: str, factory):
+        """ Return subsystem, create it by 'factory' on first use.
+
+        Raise whatever factory raises (FileNotFoundError if database or ClamAV not found, etc.),
+        subsystem is created again on next use then.
+        """
+
+        try:
+            return self.__subsystems[name]
+        except KeyError:
+            pass
+
+        with self.__subsystems_lock:
+            if name not in self.__subsystems:
+                self.envyCLI_Log.debug('Initializing {}...'.format(name))
+                self.__subsystems[name] = factory()
+            return self.__subsystems[name]
+
     def __targets_parse(self, targets: str) -> list:
         """ Parse comma-separated line to list.
 
@@ -433,7 +713,7 @@ class ConsoleInterface():
             self.envyCLI_Log.warning('Can\'t parse {}.'.format(targets))
             self.envyCLI_Log.info('Probably wrong targets type.')
             self.envyCLI_Log.debug('AttributeError args: {}'.format(attr_err))
-            print('Can\'t parse {}, probably wrong targets type.'.format(targets))
+            self.output.message('Can\'t parse {}, probably wrong targets type.'.format(targets))
             raise
         else:
             self.envyCLI_Log.info('{} was\'nt parsed, but no error occurred.'.format(targets))
@@ -467,6 +747,35 @@ if __name__ == '__main__':
                         Example: envy_sec.py --scan-file C:\\* 
                             or envy_sec.py -S D:\\SomeFolder\\SomeFile.exe
                         """)
+    parser.add_argument('-j', '--jobs', type=int, metavar='N', help="""
+                        Number of concurrent scanner workers used by file scan.
+                        Default is 'ScanWorkers' setting or number of CPU cores.
+
+                        Example: envy_sec.py -F /srv -j 8
+                        """)
+    parser.add_argument('--full', action='store_true', help="""
+                        Scan all files. By default file scan skips files, unchanged
+                        since last clean scan with the same (or older) signatures.
+
+                        Example: envy_sec.py -F /srv --full
+                        """)
+    parser.add_argument('--cache', type=str, choices=['use', 'refresh', 'bypass'], default='use', help="""
+                        Metadefender report cache mode:
+                        'use' - use cached reports (default),
+                        'refresh' - send all lookups and cache new reports,
+                        'bypass' - do not use cache.
+
+                        Example: envy_sec.py -I 8.8.8.8 --cache refresh
+                        """)
+    parser.add_argument('--output', type=str, choices=['text', 'json', 'ndjson'], default='text', help="""
+                        Format of results:
+                        'text' - human readable text (default),
+                        'json' - JSON array of records,
+                        'ndjson' - one JSON record per line.
+                        Every file, IP, URL or domain verdict is written as soon as it is known.
+
+                        Example: envy_sec.py -F /srv --output ndjson
+                        """)
     parser.add_argument('-I', '--scan-ip', type=str, nargs='+', action='append',
                         metavar='IP', help="""
                         IP will be scanned using OPSWAT Metadefender.
@@ -509,6 +818,11 @@ if __name__ == '__main__':
                         Example: envy_sec.py --remove-exception C:\\
                             or envy_sec.py -R D:\\SomeFolder\\SomeFile.exe
                         """)
+    parser.add_argument('--import-exceptions', type=str, metavar='FILE', help="""
+                        Add exceptions listed in file (one path or pattern per line, '-' for standard input) to exclude list.
+
+                        Example: envy_sec.py --import-exceptions exclude.txt
+                        """)
     parser.add_argument('-G', '--get-exceptions', action='store_true', help="""
                         List all secEnvyronment exceptions.
 
@@ -516,7 +830,9 @@ if __name__ == '__main__':
                             or envy_sec.py -G
                         """)
     parser.add_argument('-W', '--web', action='store_true', help="""
-                        Start Web-based GUI.
+                        Start service mode: keep scanner, Metadefender client and databases loaded
+                        and serve submit/status/result API on localhost HTTP ('ServiceAddress', 'ServicePort' settings)
+                        and Unix socket ('ServiceSocket' setting), see modules/service.py.
 
                         Example: envy_sec.py --web
                             or envy_sec.py -W
@@ -527,58 +843,76 @@ if __name__ == '__main__':
     envy_sec.debug('...parsing succeed.')
 
     if args.web == True:
-        pass
+        envy_sec.info('Initialize service.')
+        from modules import service
+        envy_cli = ConsoleInterface(output_format = 'ndjson')
+        envy_cli.preload() # Service keeps everything warm.
+        envy_service = service.ScanService(envy_cli,
+                                           address = envy_cli.envy_conf.settings.get("ServiceAddress", '127.0.0.1'),
+                                           port = envy_cli.envy_conf.settings.get("ServicePort", 8765),
+                                           socket_path = envy_cli.envy_conf.settings.get("ServiceSocket",
+                                                            os.path.join(os.path.abspath(os.path.dirname(__file__)), 'envysec.sock') if os.name == 'posix' else None),
+                                           max_jobs = envy_cli.envy_conf.settings.get("ServiceMaxJobs", 1000))
+        envy_sec.info('Serving...')
+        envy_service.serve_forever() # Until Ctrl+C.
+        envy_cli.close()
     else:
         envy_sec.info('Initialize Command Line Interface (CLI).')
-        envy_cli = ConsoleInterface() # class will initialize Metadefender and ClamAV automatically.
+        envy_cli = ConsoleInterface(output_format = args.output) # Metadefender and ClamAV are initialized on first use.
+        if args.cache != 'use':
+            envy_cli.metadef.cache_mode = args.cache
         envy_sec.info('Initialize work:')
+        # Independent command groups run concurrently: IP, URL and domain lookups wait for network,
+        # file scan waits for disk and CPU. Update goes before file scan, exclude list is edited after it.
+        envy_scheduler = scheduler.CommandScheduler()
         if args.update is True:
-            envy_sec.info('Starting update.')
-            envy_cli.update(verbose = True)
-            envy_sec.info('Update complete.')
+            envy_sec.debug('Scheduling update.')
+            envy_scheduler.add('update', envy_cli.update, verbose = True)
 
         if args.scan_ip != None:
-            envy_sec.info('Starting IP scan.')
             envy_sec.debug('IP Scanner arguments: {}'.format(args.scan_ip))
-            envy_cli.ip_scanner(args.scan_ip[0], geo = True)
-            envy_sec.info('IP scan complete.')
+            envy_scheduler.add('scan_ip', envy_cli.ip_scanner, args.scan_ip[0], geo = True)
 
         if args.scan_url != None:
-            envy_sec.info('Starting URL scan.')
             envy_sec.debug('URL Scanner arguments: {}'.format(args.scan_url))
-            envy_cli.url_scanner(args.scan_url[0])
-            envy_sec.info('URL scan complete.')
+            envy_scheduler.add('scan_url', envy_cli.url_scanner, args.scan_url[0])
 
         if args.scan_domain != None:
-            envy_sec.info('Starting domain scan.')
             envy_sec.debug('domain Scanner arguments: {}'.format(args.scan_domain))
-            envy_cli.domain_scanner(args.scan_domain[0])
-            envy_sec.info('domain scan complete.')
+            envy_scheduler.add('scan_domain', envy_cli.domain_scanner, args.scan_domain[0])
 
         if args.scan_file != None:
-            envy_sec.info('Starting file scan.')
             envy_sec.debug('File Scanner arguments: {}'.format(args.scan_file))
-            envy_cli.file_scanner(args.scan_file[0])
-            envy_sec.info('File scan complete.')
+            envy_scheduler.add('scan_file', envy_cli.file_scanner, args.scan_file[0], workers = args.jobs, full = args.full,
+                               after = ('update',))
 
         if args.add_exception != None:
-            envy_sec.info('Adding exception to exclude list.')
             envy_sec.debug('Add exception arguments: {}'.format(args.add_exception))
-            envy_cli.add_exception(args.add_exception[0])
-            envy_sec.info('Exception added.')
+            envy_scheduler.add('add_exception', envy_cli.add_exception, args.add_exception[0],
+                               after = ('scan_file',))
 
         if args.remove_exception != None:
-            envy_sec.info('Removing exception from exclude list.')
             envy_sec.debug('Remove exception arguments: {}'.format(args.remove_exception))
-            envy_cli.remove_exception(args.remove_exception[0])
-            envy_sec.info('Exception removed.')
+            envy_scheduler.add('remove_exception', envy_cli.remove_exception, args.remove_exception[0],
+                               after = ('scan_file', 'add_exception'))
 
-        if args.get_exceptions is True:
-            envy_sec.info('Getting exceptions list.')
-            envy_cli.get_exclude()
-            envy_sec.info('Exceptions list received.')
+        if args.import_exceptions != None:
+            envy_scheduler.add('import_exceptions', envy_cli.import_exceptions, args.import_exceptions,
+                               after = ('scan_file', 'add_exception', 'remove_exception'))
 
-        if args.web is True:
-            pass
+        if args.get_exceptions is True:
+            envy_scheduler.add('get_exceptions', envy_cli.get_exclude,
+                               after = ('scan_file', 'add_exception', 'remove_exception', 'import_exceptions'))
+
+        envy_sec.info('Running commands...')
+        passed = envy_scheduler.run()
+        envy_sec.info('Commands run time: {}'.format(envy_scheduler.times))
+
+        envy_cli.close()
+        if len(envy_scheduler.errors) > 0:
+            raise next(iter(envy_scheduler.errors.values())) # The same way it failed when commands were run one by one.
+        elif passed is False:
+            envy_sec.error('Commands are not run: {}'.format(envy_scheduler.skipped))
+            sys.exit(1)
 
     envy_sec.debug('secEnvyronment: done.')
@@ -1,9 +1,18 @@
+import heapq
 import logging
 import os
 import pathlib
 import queue
+import shutil
+import stat
 import subprocess # WARNING, POSSIBLE SECURITY ISSUE: Bandit report: 'Consider possible security implications associated with subprocess module.'
+import tempfile
 import threading
+import time
+
+from . import clamd
+from . import exclusions
+from . import hashing
 
 
 class ClamAV():
@@ -11,23 +20,28 @@ class ClamAV():
     It depends on original ClamAV and used to perform an easier-control.
 
     Available methods:
-        public: scan, update
-        private: __scan, __update, __call_proc, __resolve_path
+        public: scan, update, signature_version, start_daemon, stop_daemon, daemon_status
+        private: __scan, __parallel_scan, __scan_unlisted, __walk, __changed_files, __dedup, __make_shards, __update, __call_proc, __resolve_path,
+                 __spawn_daemon, __write_daemon_config, __daemon_dir, __watch_daemon
 
     Required packages (dependencies): 
-        built-in: logging, os, pathlib, queue, subprocess, threading
+        built-in: heapq, logging, os, pathlib, queue, shutil, stat, subprocess, tempfile, threading, time
         3-d party: -
 
     To perform a scan, it uses sys.Popen to call for a ClamAV bin with a customized args.
+    It also might own private clamd (see 'start_daemon'), which is reloaded after every successful update,
+    so scans performed using clamd (see clamd.py) are not blocked by signatures update.
 
     ClamAV official site (2018): www.clamav.net
     Cisco (ClamAV owner and maintainer) official site (2018): www.cisco.com
     """
 
-    def __init__(self, config: dict, logging_level = 30):
+    def __init__(self, config: dict, logging_level = 30, daemon_address = None):
         """ ClamAV class used to control ClamAV app.
 
-        'config' - dictionary with paths to ClamAV bins (freshclam & clamscan);
+        'config' - dictionary with paths to ClamAV bins (freshclam & clamscan, optionally clamd as 'Daemon');
+        'daemon_address' - clamd socket address (see clamd.py), used to reload clamd after update;
+            private clamd (see 'start_daemon') never listens on it, it might be system clamd's address;
         'logging_level' - verbosity of logging:
             0 - debug,
             30 - warnings,
@@ -44,17 +58,42 @@ class ClamAV():
         self.ClamLog.debug('Initializing class...')
 
         self.configuration = config
-        self.clamav_queue = queue.Queue()
+        self.queue_size = 1024 # Max lines buffered between ClamAV process and consumer
+        self.returncode = None # Exit code of last ClamAV process
+        self.logging_level = logging_level
+
+        self.daemon = None # clamd client, see clamd.py
+        if daemon_address is not None:
+            self.daemon = clamd.ClamD(daemon_address, logging_level = logging_level)
+
+        self.daemon_process = None # Private clamd process, see 'start_daemon'
+        self.daemon_dir = None # Private clamd config, pid file and socket directory, see '__daemon_dir'
+        self.__daemon_dir_temporary = False # 'daemon_dir' was created by 'tempfile.mkdtemp' and is removed by 'stop_daemon'
+        self.daemon_watchdog = None
+        self.__daemon_stop = threading.Event()
+        self.__daemon_lock = threading.Lock()
 
         self.ClamLog.debug('Class initialized.')
 
 
-    def scan(self, targets: list, args = ['-i', '-r', '--no-summary', '--alert-exceeds-max=no'], exclude = None) -> str:
+    def scan(self, targets: list, args = ['-i', '-r', '--no-summary', '--alert-exceeds-max=no'], exclude = None, workers = 1,
+             state_db = None, full = False, daemon = False, dedup = False, hasher = None) -> str:
         """ Method used to perform a ClamAV scan.
 
         'targets' - list of paths to be scanned;
         'args' - list of arguments to be sent to ClamAV;
-        'exclude' - list of paths not to be scanned.
+        'exclude' - list of paths (glob patterns, regular expressions) not to be scanned
+            or compiled exclusions.ExclusionMatcher;
+        'workers' - number of ClamAV processes (or clamd sessions) to be run concurrently.
+            If more than 1, targets are walked, split into shards of balanced size (in bytes)
+            and every shard is scanned by separate ClamAV process (see '__parallel_scan');
+        'state_db' - file state index (sql_management.FileStateDB). If defined, files unchanged
+            since clean scan with the same or newer signatures are skipped, clean files are recorded;
+        'full' - flag to scan all files even if 'state_db' is defined (clean files are still recorded);
+        'daemon' - flag to scan using clamd (see 'start_daemon' and clamd.py) instead of clamscan;
+        'dedup' - flag to scan one file of every unique content: hardlinks and copies of the same file
+            are not scanned, ClamAV output of scanned file is repeated for them (see '__dedup');
+        'hasher' - hashing.HashingService used to find copies, None - temporary one.
 
         Return False if file/dir (target) does not exists, might not be accessed
         or in exclude list (see config).
@@ -65,7 +104,8 @@ class ClamAV():
         'Args' are arguments list to be sent to ClamAV bin
         (see ClamAV documentations for more).
         Argument 'Exclude' is a list with valid paths not to be scanned.
-        Every in 'Exclude' will be formated individually (file or dir type definition, formation to '--exclude' or '--exclude-dir')
+        Walked targets are pruned by compiled exclude list (see exclusions.py), otherwise every exclusion
+        is sent to ClamAV as separate '--exclude' or '--exclude-dir' argument (escaped regular expression).
 
         Default scanner behaveour is (arguments descriptions):
             show only infected files (-i). It also will show all files, that might not be accessed by ClamAV;
@@ -75,6 +115,9 @@ class ClamAV():
         """
 
         self.ClamLog.debug('Starting scan.')
+        args = list(args) # Do not modify default arguments list.
+        if exclude is None:
+            exclude = list()
 
         def __parse_line(line: str) -> bool:
             """ Check if 'line' report thread found.
@@ -93,26 +136,9 @@ class ClamAV():
                 return False
 
         self.ClamLog.debug('Retrieving exceptions...')
-        if exclude is not None and exclude != []:
-            exception_list = str() # Used to translate exclude elements to string; example: exclude = ['a/b/c'] -> except_list = '--exclude=a/b/c'
-            for exception in exclude:
-                exception_path = self.__resolve_path(exception)
-
-                if os.path.isdir(exception_path) is True:
-                    exception_list += '--exclude-dir={}'.format(exception_path)
-                elif os.path.isfile(exception_path) is True:
-                    exception_list += '--exclude={}'.format(exception_path)
-                elif os.path.islink(exception_path) is True:
-                    self.ClamLog.info('{} is a symbolic link, trying to follow...'.format(exception_path))
-                    exception_list += '--exclude={}'.format(exception_path)
-                elif os.path.ismount(exception_path) is True:
-                    self.ClamLog.info('{} is a mount point, trying to continue...'.format(exception_path))
-                    exception_list += '--exclude={}'.format(exception_path)
-                else:
-                    self.ClamLog.warning('type of {} is not defined, trying to continue...'.format(exception_path))
-                    exception_list += '--exclude={}'.format(exception_path)
-                exception_list += ' ' # Add space, ClamAV does\'nt support comma-separated lists.
-            args.append(exception_list.strip()) # Strip whitespace at the end;
+        if isinstance(exclude, exclusions.ExclusionMatcher) is False:
+            exclude = exclusions.ExclusionMatcher(exclude, logging_level = self.logging_level)
+        self.ClamLog.debug('{} exclusions compiled.'.format(len(exclude)))
 
         self.ClamLog.debug('Checking targets...')
         targets = [self.__resolve_path(target) for target in targets]
@@ -121,13 +147,17 @@ class ClamAV():
         for target in targets: 
             if os.path.exists(target) is False:
                 self.ClamLog.info('{} does not exists, so could not be scanned.'.format(target))
-            elif target in exclude:
+            elif exclude.match(target) is True:
                 self.ClamLog.info('{} is in exclude list, so will not be scanned.'.format(target))
             else:
                 self.ClamLog.debug('{} added to scan list.'.format(target))
                 _targets.append(target)
 
-        if len(_targets) > 0: # Prevent empty 'targets' list to be insert in 'args'.
+        walk = workers > 1 or state_db is not None or dedup is True
+        if len(_targets) > 0 and (walk is True or daemon is True):
+            self.ClamLog.debug('Scan with {} workers, walk targets: {}.'.format(workers, walk))
+        elif len(_targets) > 0: # Prevent empty 'targets' list to be insert in 'args'.
+            args += exclude.clamscan_args() # Every exclusion is a separate argument.
             for target in _targets:
                 args.insert(0, target)
         else:
@@ -139,16 +169,78 @@ class ClamAV():
                         ''')
 
         self.ClamLog.debug('Starting work...')
-        for line in self.__call_proc(self.__scan, args = args):
+        self.scan_stats = {"Scanned": 0, "Skipped": 0, "SkippedBytes": 0, "Duplicates": 0, "DuplicateBytes": 0}
+        self.duplicates = dict() # Scanned path: [(path, os.stat_result) of it's copies], see '__dedup'
+        self.hashes = dict() # Path: SHA-256 of files hashed by '__dedup', recorded with clean states
+        version = None
+        if walk is True:
+            files = self.__walk(_targets, exclude)
+            if state_db is not None:
+                version = self.signature_version(daemon = daemon)
+                files = self.__changed_files(files, state_db, version, full)
+            if dedup is True:
+                files = self.__dedup(files, hasher)
+            shards = self.__make_shards(files, max(workers, 1))
+            self.scan_stats["Scanned"] = sum(len(shard) for shard in shards)
+            output = self.__parallel_scan(shards, args, daemon = daemon)
+        elif daemon is True:
+            output = self.daemon.scan(_targets, exclude = exclude)
+        else:
+            output = self.__scan(*args)
+
+        reported = set() # Paths reported by ClamAV (infected or failed to scan), not to be recorded as clean.
+        for output_line in output:
+            path, _, reply = output_line.partition(': ')
+            for line in [output_line] + ['{}: {}'.format(copy, reply) for copy, stat in self.duplicates.get(path, ())]:
+
+                self.ClamLog.debug('Init __parse_line...')
+                reported.add(line.split(': ')[0])
+                if __parse_line(line) is True:
+                    self.ClamLog.debug('line reports True.')
+                    self.ClamLog.warning('FOUND: {}'.format(str(line)))
+                    yield line
+                else:
+                    self.ClamLog.debug('line reports False.')
+                    self.ClamLog.warning('unknown line: {}'.format(str(line)))
+
+        if state_db is not None and version is not None:
+            clean = list()
+            for shard, returncode in zip(shards, self.shard_returncodes):
+                if returncode == 2:
+                    self.ClamLog.info('Shard finished with errors, its files are not recorded as clean.')
+                    continue
+                for path, stat in shard:
+                    if path in reported:
+                        continue
+                    clean += [(stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, self.hashes.get(path), version)
+                              for stat in [stat] + [copy_stat for copy, copy_stat in self.duplicates.get(path, ())]]
+            state_db.update_states(clean)
+
+        self.ClamLog.info('Scan stats: {}'.format(self.scan_stats))
+
+    def signature_version(self, daemon = False) -> int:
+        """ Get ClamAV signatures database version.
+
+        'daemon' - flag to ask clamd (see 'start_daemon') instead of clamscan.
+
+        Return database version (int), for example 26912 for 'ClamAV 0.103.8/26912/Mon May 22 07:27:43 2023'.
+        Return None if version can\'t be received.
+        """
 
-            self.ClamLog.debug('Init __parse_line...')
-            if __parse_line(line) is True:
-                self.ClamLog.debug('line reports True.')
-                self.ClamLog.warning('FOUND: {}'.format(str(line)))
-                yield line
+        self.ClamLog.debug('Getting signatures version...')
+        try:
+            if daemon is True and self.daemon is not None:
+                version = self.daemon.version()
             else:
-                self.ClamLog.debug('line reports False.')
-                self.ClamLog.warning('unknown line: {}'.format(str(line)))
+                version = ' '.join(self.__call_proc([self.configuration["Scanner"], '--version']))
+            version = int(version.split('/')[1])
+        except (OSError, ValueError, IndexError, KeyError) as version_err:
+            self.ClamLog.warning('Failed to get signatures version.')
+            self.ClamLog.debug('Error arguments: {}'.format(str(version_err.args)))
+            return None
+
+        self.ClamLog.debug('Signatures version: {}'.format(version))
+        return version
 
     def update(self, args = ['--stdout', '--show-progress']) -> str:
         """ Method used to perform a ClamAV database update.
@@ -167,18 +259,130 @@ class ClamAV():
         """
 
         self.ClamLog.info('ClamAV Update started.')
-        for line in self.__call_proc(self.__update, args=args):
+        self.update_returncode = None
+        for line in self.__update(*args):
             self.ClamLog.info(line.strip())
             yield line
 
+        if self.update_returncode == 0 and self.daemon is not None:
+            self.ClamLog.info('Signatures updated, reloading clamd...')
+            try:
+                if self.daemon.reload() is True:
+                    self.ClamLog.info('clamd is reloading signatures.')
+                    yield 'clamd is reloading signatures.'
+                else:
+                    self.ClamLog.warning('clamd refused to reload signatures.')
+            except OSError as os_err:
+                self.ClamLog.warning('clamd is not reachable, reload skipped.')
+                self.ClamLog.debug('OSError arguments: {}'.format(str(os_err.args)))
+        elif self.update_returncode != 0:
+            self.ClamLog.warning('Update finished with code {}, clamd reload skipped.'.format(self.update_returncode))
+
+    def start_daemon(self, address = None, timeout = 300, watch_interval = 30) -> bool:
+        """ Start private clamd with generated config.
+        clamd loads signatures once and is used for all following scans (see clamd.py).
+        Started clamd is watched by separate thread and restarted if crashed or hung.
+
+        'address' - clamd socket address; if None, private Unix socket in private directory
+            (see '__daemon_dir'; TCP 127.0.0.1:3310 on Windows) is used.
+            'daemon_address' (see __init__) is never reused: it is usually system clamd's socket;
+        'timeout' - time (in seconds) to wait for clamd to load signatures;
+        'watch_interval' - time (in seconds) between health checks.
+
+        Return True if clamd started and answers PING.
+        Return False if clamd failed to start in 'timeout'.
+        Raise ValueError if clamd bin's path is not defined or wrong.
+        """
+
+        self.ClamLog.info('Starting private clamd...')
+        if self.daemon_status()["Alive"] is True:
+            self.ClamLog.info('clamd is already running.')
+            return True
+
+        if address is None:
+            if os.name == 'nt':
+                address = 'tcp://127.0.0.1:3310'
+            else:
+                address = os.path.join(self.__daemon_dir(), 'clamd.sock')
+        self.daemon = clamd.ClamD(address, logging_level = self.logging_level)
+
+        self.daemon_config = self.__write_daemon_config(address)
+        self.__daemon_stop.clear()
+        if self.__spawn_daemon(timeout) is False:
+            return False
+
+        self.daemon_watchdog = threading.Thread(target = self.__watch_daemon, args = (watch_interval, timeout), daemon = True)
+        self.daemon_watchdog.start()
+        return True
+
+    def stop_daemon(self) -> bool:
+        """ Stop private clamd, started by 'start_daemon', and its watchdog.
+        Private directory is removed if it was created by 'tempfile.mkdtemp' (see '__daemon_dir').
+
+        Return True if clamd stopped (or was not started).
+        """
+
+        self.ClamLog.info('Stopping private clamd...')
+        self.__daemon_stop.set()
+        with self.__daemon_lock:
+            if self.daemon_process is not None and self.daemon_process.poll() is None:
+                self.daemon_process.terminate()
+                try:
+                    self.daemon_process.wait(timeout = 30)
+                except subprocess.TimeoutExpired:
+                    self.ClamLog.warning('clamd did not stop in time, killing.')
+                    self.daemon_process.kill()
+                    self.daemon_process.wait()
+            self.daemon_process = None
+        if self.daemon_watchdog is not None:
+            self.daemon_watchdog.join(timeout = 30)
+            self.daemon_watchdog = None
+
+        if self.__daemon_dir_temporary is True:
+            shutil.rmtree(self.daemon_dir, ignore_errors = True)
+            self.daemon_dir = None
+            self.__daemon_dir_temporary = False
+
+        self.ClamLog.info('clamd stopped.')
+        return True
+
+    def daemon_status(self) -> dict:
+        """ clamd health check (PING & VERSION).
+
+        Return dict, looks like:
+        {
+            "Alive": True,
+            "Version": "ClamAV 0.103.8/26912/Mon May 22 07:27:43 2023",
+            "Managed": True
+        }
+        'Managed' is True if clamd was started by 'start_daemon'.
+        """
+
+        status = {
+            "Alive": False,
+            "Version": None,
+            "Managed": self.daemon_process is not None and self.daemon_process.poll() is None
+        }
 
-    def __scan(self, *args) -> bool:
+        if self.daemon is not None and self.daemon.ping() is True:
+            status["Alive"] = True
+            try:
+                status["Version"] = self.daemon.version()
+            except OSError as os_err:
+                self.ClamLog.debug('OSError arguments: {}'.format(str(os_err.args)))
+
+        self.ClamLog.debug('clamd status: {}'.format(status))
+        return status
+
+
+    def __scan(self, *args) -> str:
         """ 'Lower-level' method (module) of scan. 
         Method used to call for ClamAV scanner bin.
         It fact, it used to call for ClamAV bin (for example: clamscan.exe on Windows)
-        and put it\'s output to pipe.
+        and yield it\'s output.
 
-        Return True if scan complete successfully.
+        Return clamscan exit code (0 - no virus found, 1 - virus found, 2 - some errors occurred),
+        it is also saved in 'self.returncode'.
         Raise OSError if OS or memory errors occurred.
         Raise ValueError if wrong internal arguments or wrong bin\'s path received.
 
@@ -190,10 +394,7 @@ class ClamAV():
         args = list(args)
 
         try: # Bandit report: 'subprocess call - check for execution of untrusted input.', see line 7.
-            with subprocess.Popen([self.configuration["Scanner"]] + args, stdout=subprocess.PIPE) as scanp:
-                self.ClamLog.debug('Subprocess opened. (subprocess.Popen)')
-                for line in iter(scanp.stdout.readline, b''):
-                    self.clamav_queue.put(line)
+            returncode = yield from self.__call_proc([self.configuration["Scanner"]] + args)
         except MemoryError as memory_err:
             self.ClamLog.critical('Failed to perform __scan. Probably not enough memory.')
             self.ClamLog.debug('MemoryError arguments: {}'.format(str(memory_err.args)))
@@ -209,16 +410,313 @@ class ClamAV():
             self.ClamLog.debug('ValueError arguments: {}'.format(str(value_err.args)))
             raise ValueError('Failed to spawn process, probably wrong internal arguments received.', value_err.args)
         else:
-            self.ClamLog.debug('Scan done.')
-            return True
+            if returncode == 2:
+                self.ClamLog.warning('Scan done, but some errors occurred (exit code 2).')
+            self.ClamLog.debug('Scan done, exit code {}.'.format(returncode))
+            return returncode
+
+    def __parallel_scan(self, shards: list, args: list, daemon = False) -> str:
+        """ Scan shards concurrently, one ClamAV process (or clamd session) per shard.
+
+        'shards' - list of shards (lists of (path, os.stat_result) tuples), see '__make_shards';
+        'args' - list of arguments to be sent to every ClamAV process;
+        'daemon' - flag to scan shards using clamd sessions instead of clamscan processes.
+
+        Every shard is written to temporary file and sent to ClamAV as '--file-list'
+        (or sent to clamd as CONTSCAN commands inside single IDSESSION).
+        Output of all workers is merged into single stream.
+        Shard, which files were all removed after walk, is not scanned (its exit code is 0).
+
+        Yield ClamAV output lines.
+        Return the worst exit code of all workers, it is also saved in 'self.returncode';
+        exit code of every shard is saved in 'self.shard_returncodes'.
+        """
+
+        self.shard_returncodes = [2] * len(shards) # Shard is considered failed until its worker is done.
+        if len(shards) == 0:
+            self.ClamLog.info('Nothing to be scanned.')
+            self.returncode = 0
+            return 0
+        self.ClamLog.info('{} files split into {} shards.'.format(sum(len(shard) for shard in shards), len(shards)))
+
+        shard_lists = list()
+        if daemon is False:
+            for shard in shards:
+                if any('\n' in path for path, stat in shard) is True: # See '__make_shards'.
+                    shard_lists.append(None)
+                    continue
+                descriptor, shard_list = tempfile.mkstemp(prefix = 'envysec-shard-', suffix = '.lst')
+                with os.fdopen(descriptor, 'w', encoding = 'utf-8', errors = 'surrogateescape') as shard_f:
+                    shard_f.write('\n'.join(path for path, stat in shard) + '\n')
+                shard_lists.append(shard_list)
+
+        output = queue.Queue(maxsize = self.queue_size)
+        stop = threading.Event()
+        errors = list()
+
+        def __worker(index: int):
+            """ Scan single shard and put output lines into shared queue. """
+
+            try:
+                if any(os.path.exists(path) for path, stat in shards[index]) is False:
+                    self.ClamLog.warning('Files of shard {} were removed after walk, shard is skipped.'.format(index))
+                    self.shard_returncodes[index] = 0
+                    return
+                if daemon is True: # clamd commands are null-terminated, newlines in paths are fine.
+                    scan = self.daemon.scan([path for path, stat in shards[index]], mode = 'CONTSCAN')
+                elif shard_lists[index] is None:
+                    scan = self.__scan_unlisted([path for path, stat in shards[index]], args)
+                else:
+                    scan = self.__scan(*(args + ['--file-list={}'.format(shard_lists[index])]))
+                while stop.is_set() is False:
+                    try:
+                        output.put(next(scan))
+                    except StopIteration as done:
+                        self.shard_returncodes[index] = done.value
+                        break
+                scan.close() # Terminates ClamAV if scan was stopped.
+            except ValueError as value_err:
+                if daemon is True and any(os.path.exists(path) for path, stat in shards[index]) is False:
+                    self.ClamLog.warning('Files of shard {} were removed before scan, shard is skipped.'.format(index))
+                    self.shard_returncodes[index] = 0 # See ClamD.scan, it refuses to scan nothing.
+                else:
+                    errors.append(value_err)
+            except OSError as os_err:
+                errors.append(os_err)
+            finally:
+                output.put(None) # End-of-shard sentinel
+
+        threads = [threading.Thread(target = __worker, args = (index,), daemon = True) for index in range(len(shards))]
+        for thread in threads:
+            thread.start()
+
+        running = len(threads)
+        try:
+            while running > 0:
+                line = output.get()
+                if line is None:
+                    running -= 1
+                else:
+                    yield line
+        finally:
+            stop.set()
+            while running > 0: # Consumer stopped early, let workers finish.
+                if output.get() is None:
+                    running -= 1
+            for thread in threads:
+                thread.join()
+            for shard_list in shard_lists:
+                if shard_list is not None:
+                    os.remove(shard_list)
+
+        if len(errors) > 0:
+            self.ClamLog.error('{} of {} workers failed.'.format(len(errors), len(threads)))
+            raise errors[0]
+
+        self.returncode = max(self.shard_returncodes) # 2 (errors) > 1 (virus found) > 0 (clean)
+        return self.returncode
+
+    def __scan_unlisted(self, paths: list, args: list) -> str:
+        """ Scan files, which can\'t be sent in file list (path contains newline), one ClamAV process per file.
+        ClamAV output of such file is split into several lines, so result line is rebuilt from known path.
+
+        'paths' - list of paths to be scanned;
+        'args' - list of arguments to be sent to ClamAV.
+
+        Files removed after walk are skipped.
+
+        Yield 'path: signature FOUND' (or 'path: error ERROR') lines.
+        Return the worst exit code of all processes.
+        """
+
+        returncode = 0
+        for path in paths:
+            if os.path.exists(path) is False:
+                self.ClamLog.info('{!r} does not exists anymore, so could not be scanned.'.format(path))
+                continue
+            scan, replies = self.__scan(*(args + [path])), list()
+            while True:
+                try:
+                    replies.append(next(scan))
+                except StopIteration as done:
+                    returncode = max(returncode, done.value if done.value is not None else 2)
+                    break
+            for reply in replies:
+                if reply.endswith(' FOUND') is True or reply.endswith(' ERROR') is True:
+                    yield '{}: {}'.format(path, reply.rsplit(': ', 1)[-1])
+        return returncode
+
+    def __walk(self, targets: list, exclude: exclusions.ExclusionMatcher) -> tuple:
+        """ Walk targets and yield regular files to be scanned.
+        Symbolic links, devices and other special files are skipped,
+        excluded files are skipped and excluded dirs are not walked into.
+
+        'targets' - list of absolute paths (files or dirs);
+        'exclude' - compiled exclude list.
+
+        Yield tuples (path, os.stat_result).
+        """
+
+        for target in targets:
+            if os.path.isfile(target) is True:
+                yield target, os.stat(target)
+                continue
+
+            stack = [target]
+            while len(stack) > 0:
+                directory = stack.pop()
+                try:
+                    with os.scandir(directory) as entries:
+                        for entry in entries:
+                            if exclude.match(entry.path) is True:
+                                self.ClamLog.debug('{} is in exclude list, skipped.'.format(entry.path))
+                            elif entry.is_dir(follow_symlinks = False) is True:
+                                stack.append(entry.path)
+                            elif entry.is_file(follow_symlinks = False) is True:
+                                yield entry.path, entry.stat(follow_symlinks = False)
+                except OSError as os_err:
+                    self.ClamLog.warning('Failed to walk {}, skipped.'.format(directory))
+                    self.ClamLog.debug('OSError arguments: {}'.format(str(os_err.args)))
+
+    def __changed_files(self, files: 'iterable', state_db, version: int, full = False) -> list:
+        """ Drop files unchanged since clean scan.
+        File is unchanged if it\'s size, mtime and ctime are equal to recorded ones
+        and it was scanned with the same or newer signatures.
+
+        'files' - iterable of tuples (path, os.stat_result), see '__walk';
+        'state_db' - file state index (sql_management.FileStateDB);
+        'version' - current signatures version (see 'signature_version');
+        'full' - flag to keep all files.
+
+        Return list of tuples (path, os.stat_result) to be scanned.
+        """
+
+        if full is True or version is None:
+            self.ClamLog.info('Full scan, file states are not checked.')
+            return list(files)
+
+        changed = list()
+        batch = list()
+
+        def __check_batch():
+            """ Compare batch of files to recorded states. """
 
-    def __update(self, *args) -> bool:
+            states = state_db.get_states([(stat.st_dev, stat.st_ino) for path, stat in batch])
+            for path, stat in batch:
+                state = states.get((stat.st_dev, stat.st_ino))
+                if state is not None and state[:3] == (stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns) and state[4] >= version:
+                    self.scan_stats["Skipped"] += 1
+                    self.scan_stats["SkippedBytes"] += stat.st_size
+                else:
+                    changed.append((path, stat))
+            batch.clear()
+
+        for path, stat in files:
+            if stat.st_ino == 0: # os.scandir does not fill inode on Windows.
+                stat = os.stat(path)
+            batch.append((path, stat))
+            if len(batch) >= 10000:
+                __check_batch()
+        __check_batch()
+
+        self.ClamLog.info('{} unchanged files ({} bytes) skipped.'.format(self.scan_stats["Skipped"], self.scan_stats["SkippedBytes"]))
+        return changed
+
+    def __dedup(self, files: 'iterable', hasher = None) -> list:
+        """ Keep one file of every unique content.
+        Files are grouped by (Device, Inode) first (hardlinks), then groups of the same size
+        are hashed (SHA-256) and grouped by hash. First file of every group is kept to be scanned,
+        other files of group are recorded in 'self.duplicates' (see 'scan'), calculated hashes in 'self.hashes'.
+        Files are always hashed (memoized digests are not used): memo is kept in extended attribute
+        writable by file owner, so forged digest would skip scan of file as "copy" of clean one.
+
+        'files' - iterable of tuples (path, os.stat_result), see '__walk';
+        'hasher' - hashing.HashingService, None - temporary one.
+
+        Return list of tuples (path, os.stat_result) to be scanned.
+        """
+
+        inodes = dict() # (Device, Inode): [(path, stat)]
+        for path, stat in files:
+            if stat.st_ino == 0: # os.scandir does not fill inode on Windows.
+                stat = os.stat(path)
+            inodes.setdefault((stat.st_dev, stat.st_ino), list()).append((path, stat))
+
+        sizes = dict() # Size: [inode groups]
+        for group in inodes.values():
+            sizes.setdefault(group[0][1].st_size, list()).append(group)
+
+        groups = list()
+        candidates = dict() # Path: inode group, only groups sharing size with other ones might be copies.
+        for size, size_groups in sizes.items():
+            if len(size_groups) == 1:
+                groups.append(size_groups[0])
+            else:
+                candidates.update((group[0][0], group) for group in size_groups)
+
+        if len(candidates) > 0:
+            self.ClamLog.info('Hashing {} files of the same size...'.format(len(candidates)))
+            _hasher = hasher if hasher is not None else hashing.HashingService(logging_level = self.logging_level)
+            contents = dict() # SHA-256: [paths and stats]
+            try:
+                for path, hashsum in _hasher.sha256_many(list(candidates), memo = False):
+                    if hashsum is None: # Can't be read, let ClamAV report it.
+                        groups.append(candidates[path])
+                    else:
+                        contents.setdefault(hashsum, list()).extend(candidates[path])
+                        self.hashes[path] = hashsum
+            finally:
+                if hasher is None:
+                    _hasher.close()
+            groups.extend(contents.values())
+
+        unique = list()
+        for group in groups:
+            unique.append(group[0])
+            if len(group) > 1:
+                self.duplicates[group[0][0]] = group[1:]
+                self.scan_stats["Duplicates"] += len(group) - 1
+                self.scan_stats["DuplicateBytes"] += (len(group) - 1) * group[0][1].st_size
+
+        self.ClamLog.info('{} duplicate files ({} bytes) skipped.'.format(self.scan_stats["Duplicates"], self.scan_stats["DuplicateBytes"]))
+        return unique
+
+    def __make_shards(self, files: 'iterable', shards: int) -> list:
+        """ Split files into shards of balanced size.
+        Files are sorted by size (largest first) and every file is put into
+        the smallest shard (in bytes) at the moment.
+
+        'files' - iterable of tuples (path, os.stat_result), see '__walk';
+        'shards' - max number of shards.
+
+        Return list of shards (lists of (path, os.stat_result) tuples), empty shards are dropped.
+        Files with newline in path can\'t be sent in file list, they are put into separate last shard,
+        which is scanned file by file (see '__scan_unlisted').
+        """
+
+        files = sorted(files, key = lambda file_: file_[1].st_size, reverse = True)
+        heap = [(0, shard) for shard in range(shards)]
+        result = [list() for shard in range(shards)]
+        unlisted = list()
+
+        for path, stat in files:
+            if '\n' in path:
+                self.ClamLog.warning('{!r} contains newline, it is scanned separately.'.format(path))
+                unlisted.append((path, stat))
+                continue
+            volume, shard = heapq.heappop(heap)
+            result[shard].append((path, stat))
+            heapq.heappush(heap, (volume + stat.st_size, shard))
+
+        return [shard for shard in result if len(shard) > 0] + ([unlisted] if len(unlisted) > 0 else [])
+
+    def __update(self, *args) -> str:
         """ 'Lower-level' database (signatures) update method.
         It call for update bin, bin's path taken from configuration.
         It fact, it used to call for ClamAV bin (for example: freshclam.exe on Windows)
-        and put it\'s output to pipe.
+        and yield it\'s output.
 
-        Return True if update complete successfully.
+        Return freshclam exit code, it is also saved in 'self.update_returncode'.
         Raise OSError if OS or memory errors occurred.
         Raise ValueError if wrong internal arguments or wrong bin\'s path received.
 
@@ -230,10 +728,7 @@ class ClamAV():
         args = list(args)
 
         try: # WARN: Bandit report: 'subprocess call - check for execution of untrusted input.', see line 7.
-            with subprocess.Popen([self.configuration["Updater"]] + args, stdout=subprocess.PIPE) as updatep:
-                self.ClamLog.debug('Subprocess opened. (subprocess.Popen)')
-                for line in iter(updatep.stdout.readline, b''):
-                    self.clamav_queue.put(line)
+            self.update_returncode = yield from self.__call_proc([self.configuration["Updater"]] + args)
         except OSError as os_err:
             self.ClamLog.critical("""Failed to call for __update. Probably, module subprocess.Popen 
                                 received wrong bin\'s filename.""")
@@ -249,45 +744,221 @@ class ClamAV():
             self.ClamLog.debug('MemoryError arguments: {}'.format(str(memory_err.args)))
             raise MemoryError('System may not perform update, probably not enough memory.', memory_err.args)
         else:
-            self.ClamLog.debug('Update done.')
-            return True
+            self.ClamLog.debug('Update done, exit code {}.'.format(self.update_returncode))
+            return self.update_returncode
 
 
-    def __call_proc(self, work: 'function', args = None) -> str:
-        """ Initialize main work thread.
-        It used to call for main working function (like scan or update).
+    def __write_daemon_config(self, address: str) -> str:
+        """ Generate private clamd config.
 
-        'work' - name of function to be called.
-        'args' - list of arguments to be sent to work function.
+        'address' - clamd socket address (Unix socket path or tcp://host:port).
 
-        Yield work\'s function output.
+        Return path to generated config.
         """
 
-        self.ClamLog.debug('Initialize work thread.')
-        if args is None:
-            self.ClamLog.debug('No arguments received.')
-            args = list()
+        config_dir = self.__daemon_dir()
+        config_path = os.path.join(config_dir, 'clamd.conf')
+
+        config = [
+            'Foreground yes',
+            'ConcurrentDatabaseReload yes', # Keep serving scans while RELOAD is in progress
+            'PidFile {}'.format(os.path.join(config_dir, 'clamd.pid'))
+        ]
+        if address.startswith('tcp://') is True:
+            host, port = address[len('tcp://'):].rsplit(':', 1)
+            config.append('TCPAddr {}'.format(host.strip('[]'))) # IPv6 host is bracketed in address only
+            config.append('TCPSocket {}'.format(port))
+        else:
+            socket_path = address[len('unix://'):] if address.startswith('unix://') is True else address
+            os.makedirs(os.path.dirname(socket_path), mode = 0o700, exist_ok = True)
+            config.append('LocalSocket {}'.format(socket_path))
+            config.append('LocalSocketMode 600')
+
+        self.ClamLog.debug('Writing clamd config to {}...'.format(config_path))
+        with open(config_path, 'w') as config_f:
+            config_f.write('\n'.join(config) + '\n')
+
+        return config_path
+
+    def __daemon_dir(self) -> str:
+        """ Get private clamd directory (config, pid file and socket).
+
+        '$XDG_RUNTIME_DIR/envysec-clamd' is used if it is owned by current user and not accessible by others
+        (it is created if missing), so the same socket is used by every run.
+        Otherwise new directory is created by 'tempfile.mkdtemp' (mode 700), shared temp directory itself is never used:
+        anyone could create predictable path there first and replace config or socket.
+
+        Return path to directory.
+        """
 
-        self.ClamLog.debug('Creating thread.')
-        work_thread = threading.Thread(target = work, args = args, daemon = True)
-        self.ClamLog.debug('Starting thread.')
-        work_thread.start()
-        self.ClamLog.debug('Work thread Initialized.')
+        if self.daemon_dir is not None:
+            return self.daemon_dir
 
-        self.ClamLog.debug('Looking for output.')
-        while work_thread.is_alive():
+        runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+        if os.name != 'nt' and runtime_dir is not None and os.path.isdir(runtime_dir) is True:
+            daemon_dir = os.path.join(runtime_dir, 'envysec-clamd')
             try:
-                line = self.clamav_queue.get_nowait()
-                line = line.decode('utf-8').strip()
-                self.ClamLog.debug('Output: {}'.format(line))
-            except queue.Empty:
+                os.mkdir(daemon_dir, mode = 0o700)
+            except FileExistsError:
                 pass
-            else:
-                self.ClamLog.debug('Yield {}.'.format(line))
-                yield line
-        else:
-            self.ClamLog.debug('Process ended without any output.')
-            return None
+            except OSError as os_err:
+                self.ClamLog.debug('OSError arguments: {}'.format(str(os_err.args)))
+
+            try:
+                dir_stat = os.lstat(daemon_dir) # lstat: symlink is not followed
+                if stat.S_ISDIR(dir_stat.st_mode) is True and dir_stat.st_uid == os.getuid() and dir_stat.st_mode & 0o077 == 0:
+                    self.daemon_dir = daemon_dir
+                    return self.daemon_dir
+                self.ClamLog.warning('{} is not a private directory of current user, it is not used.'.format(daemon_dir))
+            except OSError as os_err:
+                self.ClamLog.debug('OSError arguments: {}'.format(str(os_err.args)))
+
+        self.daemon_dir = tempfile.mkdtemp(prefix = 'envysec-clamd-')
+        self.__daemon_dir_temporary = True
+        self.ClamLog.debug('Private clamd directory: {}'.format(self.daemon_dir))
+        return self.daemon_dir
+
+    def __spawn_daemon(self, timeout = 300) -> bool:
+        """ Spawn clamd process and wait until it answers PING.
+
+        'timeout' - time (in seconds) to wait for clamd to load signatures.
+
+        Return True if clamd is ready.
+        Return False if clamd exited or did not answer in 'timeout'.
+        Raise ValueError if clamd bin's path is not defined or wrong.
+        """
+
+        if self.configuration.get("Daemon") is None:
+            self.ClamLog.critical('clamd path is not defined!')
+            raise ValueError('clamd path is not defined, check ClamAV installation.')
+
+        with self.__daemon_lock:
+            if self.__daemon_stop.is_set() is True: # 'stop_daemon' was called while watchdog was restarting clamd
+                return False
+            try: # WARN: Bandit report: 'subprocess call - check for execution of untrusted input.', see line 7.
+                self.daemon_process = subprocess.Popen([self.configuration["Daemon"], '--config-file={}'.format(self.daemon_config)],
+                                                        stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+            except OSError as os_err:
+                self.ClamLog.critical('Failed to spawn clamd. Probably wrong bin\'s filename.')
+                self.ClamLog.debug('OSError arguments: {}'.format(str(os_err.args)))
+                raise ValueError('Failed to spawn clamd, probably wrong bin\'s filename received.', os_err.args)
+
+        self.ClamLog.info('clamd spawned, waiting for signatures to be loaded...')
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.daemon_process.poll() is not None:
+                self.ClamLog.error('clamd exited with code {}.'.format(self.daemon_process.returncode))
+                return False
+            if self.daemon.ping() is True:
+                self.ClamLog.info('clamd is ready.')
+                return True
+            if self.__daemon_stop.wait(1) is True:
+                return False
+
+        self.ClamLog.error('clamd did not answer in {} seconds.'.format(timeout))
+        return False
+
+    def __watch_daemon(self, interval: int, timeout: int):
+        """ Watch private clamd and restart it if crashed or hung.
+        Watchdog gives up (with critical log record) if clamd can not be spawned at all.
+
+        'interval' - time (in seconds) between health checks;
+        'timeout' - time (in seconds) to wait for restarted clamd.
+        """
+
+        failures = 0
+        while self.__daemon_stop.wait(interval) is False:
+            if self.daemon_process is not None and self.daemon_process.poll() is None and self.daemon.ping() is True:
+                failures = 0
+                continue
+
+            failures += 1
+            self.ClamLog.warning('clamd health check failed ({} in a row).'.format(failures))
+            if self.daemon_process is not None and self.daemon_process.poll() is None and failures < 3:
+                continue # Process is alive, give it a chance
+
+            self.ClamLog.error('clamd crashed or hung, restarting...')
+            with self.__daemon_lock:
+                if self.daemon_process is not None and self.daemon_process.poll() is None:
+                    self.daemon_process.kill()
+                    self.daemon_process.wait()
+            if self.__daemon_stop.is_set() is True:
+                return
+            try:
+                if self.__spawn_daemon(timeout) is True:
+                    failures = 0
+            except ValueError as value_err: # clamd bin is missing or wrong, restarting it again will not help
+                self.ClamLog.critical('clamd can not be restarted, watchdog is stopped: {}'.format(str(value_err.args)))
+                return
+
+
+    def __call_proc(self, command: list) -> str:
+        """ Call for ClamAV bin and stream it\'s output.
+
+        'command' - bin\'s path and list of arguments to be sent to it.
+
+        Both stdout and stderr are read by separate threads (blocking reads, so no CPU is spent
+        while process is silent) and put into bounded queue ('self.queue_size' lines);
+        every thread puts None (end-of-stream sentinel) after pipe is closed,
+        so all lines are consumed before process exit code is collected.
+        stderr lines are logged, stdout lines are yielded.
+
+        Yield stdout lines (decoded and stripped).
+        Return process exit code, it is also saved in 'self.returncode'.
+        """
+
+        self.ClamLog.debug('Starting {}...'.format(command[0]))
+        output = queue.Queue(maxsize = self.queue_size)
+
+        def __pump(pipe, stream: str):
+            """ Read pipe line by line and put lines into output queue. """
+
+            try:
+                for line in iter(pipe.readline, b''):
+                    output.put((stream, line))
+            finally:
+                pipe.close()
+                output.put((stream, None)) # End-of-stream sentinel
+
+        process = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        self.ClamLog.debug('Subprocess opened. (subprocess.Popen)')
+
+        pumps = [
+            threading.Thread(target = __pump, args = (process.stdout, 'stdout'), daemon = True),
+            threading.Thread(target = __pump, args = (process.stderr, 'stderr'), daemon = True)
+        ]
+        for pump in pumps:
+            pump.start()
+
+        open_streams = len(pumps)
+        try:
+            while open_streams > 0:
+                stream, line = output.get()
+                if line is None:
+                    self.ClamLog.debug('{} closed.'.format(stream))
+                    open_streams -= 1
+                    continue
+
+                line = line.decode('utf-8', errors = 'replace').strip()
+                if stream == 'stderr':
+                    self.ClamLog.warning('{}: {}'.format(os.path.basename(command[0]), line))
+                elif line != '':
+                    self.ClamLog.debug('Yield {}.'.format(line))
+                    yield line
+        finally:
+            if open_streams > 0: # Consumer stopped early, do not leave process and threads behind.
+                self.ClamLog.info('Output is not consumed anymore, terminating {}.'.format(command[0]))
+                process.terminate()
+                while open_streams > 0:
+                    if output.get()[1] is None:
+                        open_streams -= 1
+            for pump in pumps:
+                pump.join()
+            process.wait()
+
+        self.returncode = process.returncode
+        self.ClamLog.debug('{} exited with code {}.'.format(command[0], self.returncode))
+        return self.returncode
 
     def __resolve_path(self, path: str) -> str:
         """ Resolve path string to absolute path.
@@ -0,0 +1,388 @@
+import logging
+import os
+import socket
+import struct
+import threading
+
+from . import exclusions
+
+
+class ClamD():
+    """ ClamAV daemon (clamd) client class. This is not a stand-alone scanner.
+    It depends on running clamd and used to perform scans without reloading
+    signatures database on every scan.
+
+    Available methods:
+        public: ping, version, reload, scan
+        private: __connect, __command, __session, __instream, __read_replies, __parse_reply, __parse_address
+
+    Required packages (dependencies):
+        built-in: logging, os, socket, struct, threading
+        3-d party: -
+
+    Talks to clamd over Unix or TCP socket using 'z' (null-terminated) commands.
+    Scan results are yielded in the same format clamscan does ('path: signature FOUND'),
+    so ClamD might be used instead of ClamAV class in scanning routines.
+
+    Address might be:
+        path to Unix socket ('/var/run/clamav/clamd.ctl' or 'unix:///var/run/clamav/clamd.ctl'),
+        TCP address ('tcp://127.0.0.1:3310', IPv6 host in brackets: 'tcp://[::1]:3310').
+
+    ClamAV official site (2018): www.clamav.net
+    clamd protocol description: see 'man clamd', section COMMANDS.
+    """
+
+    def __init__(self, address: str, timeout = 5, scan_timeout = 600, logging_level = 30):
+        """ ClamD class used to communicate with clamd.
+
+        'address' - clamd socket address (Unix socket path or tcp://host:port);
+        'timeout' - timeout (in seconds) for connection and control commands (PING, VERSION, RELOAD);
+        'scan_timeout' - time (in seconds) clamd may stay silent during scan (large archives take long),
+            scan is failed (exit code 2) if clamd does not reply in time;
+        'logging_level' - verbosity of logging:
+            0 - debug,
+            30 - warnings,
+            50 - critical.
+            See 'logging' docs;
+        """
+
+        logging.basicConfig(level = logging_level,
+                            filemode = 'a',
+                            format=f"%(asctime)s - [%(levelname)s] - %(name)s - (%(filename)s).%(funcName)s(%(lineno)d) - %(message)s",
+                            datefmt='%d.%m.%Y %H:%M:%S')
+
+        self.ClamdLog = logging.getLogger('ClamD')
+        self.ClamdLog.debug('Initializing class...')
+
+        self.address = address
+        self.timeout = timeout
+        self.scan_timeout = scan_timeout
+        self.chunk_size = 65536 # INSTREAM chunk size, should be less than clamd 'StreamMaxLength'.
+
+        self.ClamdLog.debug('Class initialized.')
+
+
+    def ping(self) -> bool:
+        """ Check if clamd is alive.
+
+        Return True if clamd replied 'PONG'.
+        Return False if clamd is not reachable or replied something else.
+        """
+
+        self.ClamdLog.debug('Sending PING...')
+        try:
+            reply = self.__command('PING')
+        except OSError as os_err:
+            self.ClamdLog.info('clamd is not reachable at {}.'.format(self.address))
+            self.ClamdLog.debug('OSError arguments: {}'.format(str(os_err.args)))
+            return False
+
+        self.ClamdLog.debug('PING reply: {}'.format(reply))
+        return reply == 'PONG'
+
+    def version(self) -> str:
+        """ Get clamd version.
+
+        Return version string, looks like 'ClamAV 0.103.8/26912/Mon May 22 07:27:43 2023'.
+        Raise OSError (ConnectionError) if clamd is not reachable.
+        """
+
+        self.ClamdLog.debug('Sending VERSION...')
+        return self.__command('VERSION')
+
+    def reload(self) -> bool:
+        """ Ask clamd to reload signatures database.
+        clamd reloads database in background and keeps serving scans meanwhile.
+
+        Return True if clamd replied 'RELOADING'.
+        Raise OSError (ConnectionError) if clamd is not reachable.
+        """
+
+        self.ClamdLog.info('Sending RELOAD...')
+        reply = self.__command('RELOAD')
+        self.ClamdLog.debug('RELOAD reply: {}'.format(reply))
+        return reply == 'RELOADING'
+
+    def scan(self, targets: list, exclude = None, mode = 'CONTSCAN') -> str:
+        """ Method used to perform a clamd scan.
+
+        'targets' - list of paths to be scanned;
+        'exclude' - list of paths (glob patterns, regular expressions) not to be scanned
+            or compiled exclusions.ExclusionMatcher;
+        'mode' - clamd scan command:
+            'SCAN' - stop scanning target at first detection,
+            'CONTSCAN' - scan target completely (default),
+            'MULTISCAN' - scan directory using clamd threads pool,
+            'INSTREAM' - send files content over socket
+                (used if clamd can not access files, for example, clamd is on remote host).
+
+        Yield 'path: signature FOUND' lines, same as ClamAV.scan does.
+        Return clamscan-like exit code (0 - no virus found, 1 - virus found, 2 - some errors occurred).
+        Raise ValueError if no targets to be scanned or unknown mode received.
+        Raise OSError (ConnectionError) if clamd is not reachable.
+        """
+
+        self.ClamdLog.debug('Starting scan.')
+
+        if mode not in ('SCAN', 'CONTSCAN', 'MULTISCAN', 'INSTREAM'):
+            self.ClamdLog.error('Unknown scan mode: {}'.format(mode))
+            raise ValueError('Unknown clamd scan mode!', mode)
+
+        if isinstance(exclude, exclusions.ExclusionMatcher) is False:
+            exclude = exclusions.ExclusionMatcher(exclude)
+
+        self.ClamdLog.debug('Checking targets...')
+        _targets = list()
+        for target in targets:
+            target = os.path.abspath(str(target).strip('\'\"'))
+            if os.path.exists(target) is False:
+                self.ClamdLog.info('{} does not exists, so could not be scanned.'.format(target))
+            elif exclude.match(target) is True:
+                self.ClamdLog.info('{} is in exclude list, so will not be scanned.'.format(target))
+            else:
+                self.ClamdLog.debug('{} added to scan list.'.format(target))
+                _targets.append(target)
+
+        if len(_targets) == 0:
+            self.ClamdLog.error('No targets to be scanned has been specified!')
+            raise ValueError('''
+                            No targets to be scanned has been specified!
+                            Maybe targets in exclude list or not exists?
+                        ''')
+
+        if mode == 'INSTREAM':
+            returncode = 0
+            for target in _targets:
+                for path in self.__walk(target, exclude):
+                    line = self.__instream(path)
+                    if line is False:
+                        returncode = 2
+                    elif line is not None:
+                        returncode = max(returncode, 1)
+                        yield line
+            return returncode
+        else:
+            return (yield from self.__session(mode, _targets))
+
+
+    def __session(self, mode: str, targets: list) -> str:
+        """ Send scan commands inside single IDSESSION.
+
+        'mode' - clamd scan command (SCAN, CONTSCAN, MULTISCAN);
+        'targets' - list of absolute paths to be scanned.
+
+        Commands are sent from separate thread, so clamd replies are read
+        while commands are still being sent (clamd may block if replies are not read).
+
+        Yield 'path: signature FOUND' lines.
+        Return clamscan-like exit code (see 'scan'), 2 if clamd did not reply in 'scan_timeout'.
+        """
+
+        self.ClamdLog.debug('Opening IDSESSION...')
+        connection = self.__connect(timeout = self.scan_timeout)
+
+        def __send_commands():
+            """ Send all scan commands and close session. """
+
+            try:
+                connection.sendall(b'zIDSESSION\0')
+                for target in targets:
+                    self.ClamdLog.debug('Sending {} {}'.format(mode, target))
+                    connection.sendall('z{} {}\0'.format(mode, target).encode('utf-8'))
+                connection.sendall(b'zEND\0')
+            except OSError as os_err:
+                self.ClamdLog.error('Failed to send commands to clamd.')
+                self.ClamdLog.debug('OSError arguments: {}'.format(str(os_err.args)))
+
+        sender = threading.Thread(target = __send_commands, daemon = True)
+        sender.start()
+
+        returncode = 0
+        try:
+            for reply in self.__read_replies(connection):
+                line = self.__parse_reply(reply, session = True)
+                if line is not None:
+                    returncode = max(returncode, 1)
+                    yield line
+                elif reply.endswith(' ERROR') is True:
+                    returncode = 2
+        except socket.timeout:
+            self.ClamdLog.error('clamd did not reply in {} seconds, session is closed.'.format(self.scan_timeout))
+            returncode = 2
+        finally:
+            connection.close()
+            sender.join()
+            self.ClamdLog.debug('IDSESSION closed.')
+
+        return returncode
+
+    def __instream(self, path: str) -> str:
+        """ Send file content to clamd using zINSTREAM.
+
+        'path' - path to file to be scanned.
+
+        Return 'path: signature FOUND' if file is infected.
+        Return None if file is clean.
+        Return False if file failed to be scanned (can\'t be read, clamd reset connection, replied error
+            or did not reply in 'scan_timeout').
+        Raise OSError (ConnectionError) if clamd is not reachable.
+        """
+
+        self.ClamdLog.debug('Streaming {}...'.format(path))
+        try:
+            file_ = open(path, 'rb')
+        except OSError as read_err: # Permissions denied, removed since walked, ...
+            self.ClamdLog.warning('Failed reading {}: {}'.format(path, read_err.strerror))
+            self.ClamdLog.debug('OSError arguments: {}'.format(str(read_err.args)))
+            return False
+
+        failed = False
+        with file_, self.__connect(timeout = self.scan_timeout) as connection:
+            try:
+                connection.sendall(b'zINSTREAM\0')
+                while True:
+                    data = file_.read(self.chunk_size)
+                    if not data:
+                        break
+                    connection.sendall(struct.pack('!L', len(data)) + data)
+                connection.sendall(struct.pack('!L', 0))
+            except OSError as stream_err: # Read error, connection reset (clamd drops stream over 'StreamMaxLength')...
+                self.ClamdLog.warning('Failed streaming {}: {}'.format(path, stream_err.strerror or str(stream_err)))
+                self.ClamdLog.debug('OSError arguments: {}'.format(str(stream_err.args)))
+                failed = True
+
+            try: # clamd might have replied before closing connection.
+                replies = list(self.__read_replies(connection))
+            except socket.timeout:
+                self.ClamdLog.warning('clamd did not reply on {} in {} seconds.'.format(path, self.scan_timeout))
+                replies = list()
+            except OSError as os_err:
+                self.ClamdLog.debug('OSError arguments: {}'.format(str(os_err.args)))
+                replies = list()
+
+        for reply in replies:
+            if reply.startswith('stream: '):
+                reply = '{}: {}'.format(path, reply[len('stream: '):])
+            line = self.__parse_reply(reply)
+            if line is not None:
+                return line
+            elif reply.endswith(' ERROR') is True:
+                failed = True
+
+        return False if failed is True or len(replies) == 0 else None
+
+    def __walk(self, target: str, exclude: exclusions.ExclusionMatcher) -> str:
+        """ Yield files to be streamed.
+
+        'target' - file or directory;
+        'exclude' - compiled exclude list, excluded dirs are not walked into.
+        """
+
+        if os.path.isfile(target) is True:
+            yield target
+            return
+
+        for root, dirs, files in os.walk(target):
+            dirs[:] = [directory for directory in dirs if exclude.match(os.path.join(root, directory)) is False]
+            for file_ in files:
+                path = os.path.join(root, file_)
+                if exclude.match(path) is False and os.path.isfile(path) is True:
+                    yield path
+
+
+    def __command(self, command: str) -> str:
+        """ Send single control command to clamd and return it\'s reply.
+
+        'command' - clamd command without prefix (PING, VERSION, RELOAD...).
+
+        Raise OSError (ConnectionError) if clamd is not reachable.
+        """
+
+        with self.__connect(timeout = self.timeout) as connection:
+            connection.sendall('z{}\0'.format(command).encode('utf-8'))
+            replies = list(self.__read_replies(connection))
+
+        return replies[0] if len(replies) > 0 else ''
+
+    def __read_replies(self, connection: socket.socket) -> str:
+        """ Read null-terminated replies until clamd closes connection.
+
+        Yield replies (str) without terminator.
+        """
+
+        buffer = b''
+        while True:
+            data = connection.recv(self.chunk_size)
+            if not data:
+                break
+            buffer += data
+            *replies, buffer = buffer.split(b'\0')
+            for reply in replies:
+                yield reply.decode('utf-8', errors = 'replace').strip()
+
+        if buffer.strip() != b'':
+            yield buffer.decode('utf-8', errors = 'replace').strip()
+
+    def __parse_reply(self, reply: str, session = False) -> str:
+        """ Translate clamd reply to clamscan-like line.
+
+        'reply' - clamd reply, looks like '[id: ]path: signature FOUND';
+        'session' - flag, if reply is prefixed with IDSESSION request id.
+
+        Return 'path: signature FOUND' if reply reports detection.
+        Return None otherwise (reply is logged).
+        """
+
+        if session is True and ': ' in reply:
+            request_id, _reply = reply.split(': ', 1)
+            if request_id.isdigit() is True:
+                reply = _reply
+
+        if reply.endswith(' FOUND') is True:
+            self.ClamdLog.warning('FOUND: {}'.format(reply))
+            return reply
+        elif reply.endswith(' ERROR') is True:
+            self.ClamdLog.warning('clamd error: {}'.format(reply))
+        elif reply.endswith(': OK') is True:
+            self.ClamdLog.debug('Clean: {}'.format(reply))
+        else:
+            self.ClamdLog.warning('unknown line: {}'.format(reply))
+        return None
+
+    def __connect(self, timeout = None) -> socket.socket:
+        """ Open connection to clamd.
+
+        'timeout' - connection and operation timeout; None - blocking socket.
+
+        Raise OSError (ConnectionError) if clamd is not reachable.
+        """
+
+        family, address = self.__parse_address(self.address)
+        self.ClamdLog.debug('Connecting to {}...'.format(address))
+
+        connection = socket.socket(family, socket.SOCK_STREAM)
+        connection.settimeout(self.timeout)
+        try:
+            connection.connect(address)
+        except OSError:
+            connection.close()
+            raise
+        connection.settimeout(timeout)
+        return connection
+
+    def __parse_address(self, address: str) -> tuple:
+        """ Parse clamd address.
+
+        Return tuple (socket family, address), suitable for socket.connect.
+        Raise ValueError if TCP address is malformed.
+        """
+
+        if address.startswith('tcp://') is True:
+            host, _, port = address[len('tcp://'):].rpartition(':')
+            if host.startswith('[') is True and host.endswith(']') is True: # IPv6: tcp://[::1]:3310
+                return socket.AF_INET6, (host[1:-1], int(port))
+            return socket.AF_INET, (host, int(port))
+        elif address.startswith('unix://') is True:
+            return socket.AF_UNIX, address[len('unix://'):]
+        else:
+            return socket.AF_UNIX, address
@@ -98,11 +98,12 @@ class Envyronment_Settings():
         """ Return ClamAV scanner and updater paths.
         Automatically resolve ClamAV paths;
 
-        Return dict with path to clamscan & freashclam;
+        Return dict with path to clamscan & freashclam (and clamd, if found);
         Looks like:
         {
             "Scanner": "/path/to/clamscan",
-            "Updater": "C:\\Some path\\to\\freshclam.exe"
+            "Updater": "C:\\Some path\\to\\freshclam.exe",
+            "Daemon": "/path/to/clamd"
         },
         All objects in dict are strings.
 
@@ -140,6 +141,11 @@ class Envyronment_Settings():
                     self.envySettings.debug('ClamAV updater path: {}'.format(str(paths[i].joinpath('freshclam'))))
                     self.envySettings.debug('Path priority: {}'.format(i))
                     clam_conf["Updater"] = str(paths[i].joinpath('freshclam'))
+                if os.path.exists(paths[i].joinpath('clamd')) is True:
+                    self.envySettings.info('ClamAV daemon detected;')
+                    self.envySettings.debug('ClamAV daemon path: {}'.format(str(paths[i].joinpath('clamd'))))
+                    self.envySettings.debug('Path priority: {}'.format(i))
+                    clam_conf["Daemon"] = str(paths[i].joinpath('clamd'))
 
         elif os.name == 'nt':
             self.envySettings.info('NT (Windows) OS detected.')
@@ -163,6 +169,11 @@ class Envyronment_Settings():
                     self.envySettings.debug('ClamAV updater path: {}'.format(str(paths[i].joinpath('freshclam.exe'))))
                     self.envySettings.debug('Path priority: {}'.format(i))
                     clam_conf["Updater"] = str(paths[i].joinpath('freshclam.exe'))
+                if os.path.exists(paths[i].joinpath('clamd.exe')) is True:
+                    self.envySettings.info('ClamAV daemon detected;')
+                    self.envySettings.debug('ClamAV daemon path: {}'.format(str(paths[i].joinpath('clamd.exe'))))
+                    self.envySettings.debug('Path priority: {}'.format(i))
+                    clam_conf["Daemon"] = str(paths[i].joinpath('clamd.exe'))
         else:
             self.envySettings.critical('unsupported platform detected;')
             raise OSError('Unsupported platform detected!') # Most suitable error, see docs;
@@ -174,6 +185,42 @@ class Envyronment_Settings():
             self.envySettings.info('ClamAV paths resolved.')
         return clam_conf
 
+    @property
+    def clamd_config(self) -> dict:
+        """ Return ClamAV scanning backend settings.
+
+        Backend is taken from 'ClamAVBackend' setting ('clamscan' or 'clamd'),
+        clamd address is taken from 'ClamdAddress' setting,
+        'ClamdManaged' setting defines if private clamd should be started by envySec.
+        If settings are not defined, 'clamscan' backend and OS default clamd address are used.
+
+        Return dict, looks like:
+        {
+            "Backend": "clamd",
+            "Address": "/var/run/clamav/clamd.ctl",
+            "Managed": False
+        }
+        """
+
+        self.envySettings.debug('Starting clamd_config...')
+        if os.name == 'nt':
+            default_address = 'tcp://127.0.0.1:3310'
+        else:
+            default_address = '/var/run/clamav/clamd.ctl'
+
+        clamd_conf = {
+            "Backend": self.settings.get("ClamAVBackend", "clamscan"),
+            "Address": self.settings.get("ClamdAddress", default_address),
+            "Managed": self.settings.get("ClamdManaged", False) is True
+        }
+
+        if clamd_conf["Backend"] not in ('clamscan', 'clamd'):
+            self.envySettings.warning('Unknown ClamAV backend {}, using clamscan.'.format(clamd_conf["Backend"]))
+            clamd_conf["Backend"] = 'clamscan'
+
+        self.envySettings.debug('clamd config: {}'.format(clamd_conf))
+        return clamd_conf
+
 
     def register_metadefender_api(self) -> str:
         """ Get Metadefender API key.
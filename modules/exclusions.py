@@ -0,0 +1,195 @@
+import fnmatch
+import logging
+import os
+import re
+
+
+class ExclusionMatcher():
+    """ Compiled exclude list. Used to check if path is excluded from scan.
+
+    Available methods:
+        public: add, match, is_pattern, clamscan_args
+        private: __split, __compile, __glob_to_posix, __posix_escape
+
+    Required packages (dependencies):
+        built-in: fnmatch, logging, os, re
+        3-d party: -
+
+    Exclusion might be:
+        path to file or dir - path and everything under it is excluded.
+            Paths are kept in prefix trie of path components, so check costs O(path depth)
+            whatever size of exclude list is;
+        glob pattern ('*.iso', '/srv/*/cache') - pattern without path separator is matched against
+            name of file (dir), pattern with separator is matched against full path;
+        regular expression, prefixed with 're:' ('re:/\\.git(/|$)') - searched in full path.
+    All glob patterns (and all regular expressions) are compiled into single regular expression.
+    """
+
+    REGEX_PREFIX = 're:'
+
+    def __init__(self, patterns = None, logging_level = 30):
+        """ Compile exclude list.
+
+        'patterns' - iterable of paths, glob patterns and regular expressions (see class docs);
+        'logging_level' - verbosity of logging:
+            0 - debug,
+            30 - warnings,
+            50 - critical.
+            See 'logging' docs;
+        """
+
+        logging.basicConfig(level = logging_level,
+                            filemode = 'a',
+                            format=f"%(asctime)s - [%(levelname)s] - %(name)s - (%(filename)s).%(funcName)s(%(lineno)d) - %(message)s",
+                            datefmt='%d.%m.%Y %H:%M:%S')
+
+        self.ExclusionLog = logging.getLogger('Exclusions')
+
+        self.paths = list() # Excluded paths, as added to trie
+        self.globs = list()
+        self.regexes = list()
+        self.__trie = dict() # Path component: subtree, None: True marks excluded path
+        self.__name_regex = None
+        self.__path_regex = None
+        self.__compiled = True
+
+        for pattern in patterns if patterns is not None else ():
+            self.add(pattern)
+
+    def __len__(self) -> int:
+        return len(self.paths) + len(self.globs) + len(self.regexes)
+
+
+    @staticmethod
+    def is_pattern(pattern: str) -> bool:
+        """ Check if exclusion is glob pattern or regular expression (not a path). """
+
+        return pattern.startswith(ExclusionMatcher.REGEX_PREFIX) or any(char in pattern for char in '*?[')
+
+    def add(self, pattern: str):
+        """ Add path, glob pattern or regular expression to exclude list.
+
+        Raise ValueError if regular expression is not valid.
+        """
+
+        pattern = str(pattern).strip('\'\"')
+        if pattern.startswith(self.REGEX_PREFIX) is True:
+            regex = pattern[len(self.REGEX_PREFIX):]
+            try:
+                re.compile(regex)
+            except re.error as regex_err:
+                self.ExclusionLog.error('Bad regular expression in exclude list: {}'.format(regex))
+                raise ValueError('Bad regular expression!', regex, regex_err.args)
+            self.regexes.append(regex)
+            self.__compiled = False
+        elif self.is_pattern(pattern) is True:
+            self.globs.append(os.path.normcase(os.path.expanduser(pattern)))
+            self.__compiled = False
+        else:
+            path = os.path.realpath(os.path.expanduser(pattern))
+            node = self.__trie
+            for component in self.__split(path):
+                node = node.setdefault(component, dict())
+            node[None] = True
+            self.paths.append(path)
+
+        self.ExclusionLog.debug('{} added to exclude list.'.format(pattern))
+
+    def match(self, path: str) -> bool:
+        """ Check if path is excluded.
+
+        'path' - path to file or dir (absolute paths are not resolved again).
+
+        Return True if path (or one of it\'s parent dirs) is in exclude list or path matches pattern
+        (paths under dir matching pattern are not checked, such dir is not walked into).
+        """
+
+        if self.__compiled is False:
+            self.__compile()
+
+        path = os.path.normcase(os.path.abspath(path))
+        node = self.__trie
+        for component in self.__split(path):
+            if None in node:
+                return True
+            node = node.get(component)
+            if node is None:
+                break
+        else:
+            if None in node:
+                return True
+
+        if self.__name_regex is not None and self.__name_regex.match(os.path.basename(path)) is not None:
+            return True
+        if self.__path_regex is not None and self.__path_regex.search(path) is not None:
+            return True
+        return False
+
+    def clamscan_args(self) -> list:
+        """ Translate exclude list to clamscan arguments ('--exclude' and '--exclude-dir' take POSIX regular expressions).
+
+        Return list of arguments, every exclusion is a separate argument.
+        """
+
+        args = list()
+        for path in self.paths:
+            regex = '^{}'.format(self.__posix_escape(path))
+            if os.path.isdir(path) is True:
+                args.append('--exclude-dir={}(/|$)'.format(regex))
+            else:
+                args.append('--exclude={}$'.format(regex))
+
+        for glob in self.globs:
+            regex = self.__glob_to_posix(glob)
+            regex = '^{}$'.format(regex) if os.sep in glob else '(^|/){}$'.format(regex)
+            args += ['--exclude={}'.format(regex), '--exclude-dir={}'.format(regex)]
+
+        for regex in self.regexes:
+            args += ['--exclude={}'.format(regex), '--exclude-dir={}'.format(regex)]
+
+        return args
+
+
+    def __split(self, path: str) -> list:
+        """ Split normalized absolute path into components. """
+
+        return [component for component in os.path.normcase(path).split(os.sep) if component != '']
+
+    def __compile(self):
+        """ Compile glob patterns and regular expressions into single regular expressions. """
+
+        name_globs = [fnmatch.translate(glob) for glob in self.globs if os.sep not in glob]
+        path_globs = [fnmatch.translate(glob) for glob in self.globs if os.sep in glob]
+        self.__name_regex = re.compile('|'.join(name_globs)) if len(name_globs) > 0 else None
+        self.__path_regex = re.compile('|'.join(['(?:{})'.format(regex) for regex in self.regexes] +
+                                                ['^(?:{})'.format(regex) for regex in path_globs])) if len(self.regexes) + len(path_globs) > 0 else None
+        self.__compiled = True
+        self.ExclusionLog.debug('{} glob patterns and {} regular expressions compiled.'.format(len(self.globs), len(self.regexes)))
+
+    def __glob_to_posix(self, glob: str) -> str:
+        """ Translate glob pattern to POSIX extended regular expression (without anchors). """
+
+        regex = str()
+        index = 0
+        while index < len(glob):
+            char = glob[index]
+            index += 1
+            if char == '*':
+                regex += '.*'
+            elif char == '?':
+                regex += '.'
+            elif char == '[' and ']' in glob[index + 1:]:
+                end = glob.index(']', index + 1)
+                class_ = glob[index:end]
+                if class_.startswith('!') is True:
+                    class_ = '^' + class_[1:]
+                regex += '[{}]'.format(class_)
+                index = end + 1
+            else:
+                regex += self.__posix_escape(char)
+        return regex
+
+    def __posix_escape(self, text: str) -> str:
+        """ Escape POSIX extended regular expression special chars. """
+
+        return ''.join('\\' + char if char in '\\.^$*+?()[]{}|' else char for char in text)
@@ -0,0 +1,301 @@
+import concurrent.futures
+import errno
+import hashlib
+import logging
+import mmap
+import os
+import threading
+
+
+class HashingService():
+    """ File hashing service. Used to calculate file digests for Metadefender lookups.
+
+    Available methods:
+        public: hash_file, hash_many, sha256, sha256_many, close
+        private: __feed, __advise, __recall, __remember, __refresh_state, __recall_state, __remember_state
+
+    Required packages (dependencies):
+        built-in: concurrent.futures, errno, hashlib, logging, mmap, os, threading
+        3-d party: -
+
+    Every file is read once and all digests ('md5', 'sha1', 'sha256' by default) are
+    calculated in the same pass, so any Metadefender lookup type might be served from one read.
+    Files are read in large chunks into reused buffer (or mapped, see 'use_mmap'),
+    hashlib releases GIL on large chunks, so 'hash_many' hashes files in parallel threads.
+
+    If 'drop_cache' is True and OS supports posix_fadvise, pages read are dropped from page cache
+    after file is hashed, so hashing does not evict page cache of other (production) applications.
+
+    If 'memo' is True, SHA-256 calculated by 'sha256' is kept in 'user.envysec.sha256' extended attribute
+    of file, stamped with file mtime (ns) and size, and trusted while stamp matches file.
+    If filesystem does not support extended attributes (or attribute might not be written),
+    digest is kept in 'FileState' table of 'state_db' (sql_management.FileStateDB) instead.
+    Extended attribute might be set by file owner to any value, so memoized digests
+    are used for Metadefender lookups only (see 'sha256').
+    Writing extended attribute changes file ctime, which is compared by ClamAV.scan to skip unchanged files,
+    so recorded state of file is refreshed with new ctime (see '__remember'), otherwise memoized file is rescanned.
+    """
+
+    XATTR = 'user.envysec.sha256'
+
+    def __init__(self, workers = None, chunk_size = 4 * 1024 * 1024, algorithms = ('md5', 'sha1', 'sha256'),
+                 use_mmap = False, drop_cache = True, memo = False, state_db = None, logging_level = 30):
+        """ Start hashing thread pool.
+
+        'workers' - number of hashing threads, None - number of CPU cores;
+        'chunk_size' - size (in bytes) of chunks file is read by;
+        'algorithms' - digests to be calculated (hashlib names);
+        'use_mmap' - flag to map files to memory instead of reading them
+            (note: file truncated while mapped crashes process with SIGBUS on POSIX);
+        'drop_cache' - flag to drop read pages from page cache (posix_fadvise DONTNEED);
+        'memo' - flag to memoize SHA-256 of files (see class docs);
+        'state_db' - file state index (sql_management.FileStateDB), used for memoization
+            if extended attributes are not supported, None - such files are not memoized
+            (and ctime of files is not refreshed, see class docs);
+        'logging_level' - verbosity of logging:
+            0 - debug,
+            30 - warnings,
+            50 - critical.
+            See 'logging' docs;
+        """
+
+        logging.basicConfig(level = logging_level,
+                            filemode = 'a',
+                            format=f"%(asctime)s - [%(levelname)s] - %(name)s - (%(filename)s).%(funcName)s(%(lineno)d) - %(message)s",
+                            datefmt='%d.%m.%Y %H:%M:%S')
+
+        self.HashLog = logging.getLogger('Hashing')
+        self.HashLog.debug('Initializing class...')
+
+        for algorithm in algorithms:
+            if algorithm not in hashlib.algorithms_available:
+                self.HashLog.error('Unknown hash algorithm: {}'.format(algorithm))
+                raise ValueError('Unknown hash algorithm!', algorithm)
+
+        if 'sha256' not in algorithms:
+            self.HashLog.error('SHA-256 is required for Metadefender lookups.')
+            raise ValueError('SHA-256 is required!', algorithms)
+
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.chunk_size = chunk_size
+        self.algorithms = tuple(algorithms)
+        self.use_mmap = use_mmap
+        self.drop_cache = drop_cache and hasattr(os, 'posix_fadvise')
+        self.memo = memo
+        self.state_db = state_db
+        self.memo_stats = {"Hits": 0, "Misses": 0}
+        self.__xattr = hasattr(os, 'getxattr') # Extended attributes are available on Linux only.
+        self.__stats_lock = threading.Lock()
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = 'Hashing')
+
+        self.HashLog.debug('Class initialized.')
+
+
+    def hash_file(self, target: str) -> dict:
+        """ Calculate digests of file in calling thread.
+
+        'target' - path to file.
+
+        Return dict, looks like {'md5': '...', 'sha1': '...', 'sha256': '...'} (lower case hex).
+        Raise PermissionError or FileNotFoundError if file might not be read.
+        """
+
+        self.HashLog.debug('Calculating hashes for {}'.format(target))
+        hashers = [hashlib.new(algorithm) for algorithm in self.algorithms]
+        with open(target, 'rb', buffering = 0) as file_:
+            self.__advise(file_, 'POSIX_FADV_SEQUENTIAL')
+            try:
+                self.__feed(file_, hashers)
+            finally:
+                if self.drop_cache is True:
+                    self.__advise(file_, 'POSIX_FADV_DONTNEED')
+
+        digests = {algorithm: hasher.hexdigest() for algorithm, hasher in zip(self.algorithms, hashers)}
+        self.HashLog.debug('Hashes for {}: {}'.format(target, digests))
+        return digests
+
+    def hash_many(self, targets: list) -> tuple:
+        """ Calculate digests of many files in thread pool.
+
+        'targets' - list of paths to files.
+
+        Yield tuples (target, digests) as soon as file is hashed (not in 'targets' order),
+        digests look like 'hash_file' ones, or None if file might not be read.
+        """
+
+        futures = {self.__executor.submit(self.hash_file, target): target for target in targets}
+        for future in concurrent.futures.as_completed(futures):
+            target = futures[future]
+            try:
+                yield target, future.result()
+            except OSError as read_err:
+                self.HashLog.warning('{} can\'t be read, skipped.'.format(target))
+                self.HashLog.debug('OSError arguments: {}'.format(str(read_err.args)))
+                yield target, None
+
+    def sha256(self, target: str, memo = None) -> str:
+        """ Get SHA-256 of file, memoized one if 'self.memo' is True and file is unchanged since it was hashed.
+
+        'target' - path to file;
+        'memo' - flag to use memoized SHA-256, None - 'self.memo'.
+            Memoized digest is kept in extended attribute, which file owner might set to any value,
+            so it is not used where digest is a security decision (see clamav.ClamAV.__dedup).
+
+        Return SHA-256 (lower case hex).
+        Raise PermissionError or FileNotFoundError if file might not be read.
+        """
+
+        if (self.memo if memo is None else memo) is False:
+            return self.hash_file(target)["sha256"]
+
+        stat = os.stat(target) # Taken before reading: if file is changed while hashed, stamp does not match later.
+        hashsum = self.__recall(target, stat)
+        with self.__stats_lock:
+            self.memo_stats["Hits" if hashsum is not None else "Misses"] += 1
+        if hashsum is not None:
+            self.HashLog.debug('Memoized SHA-256 for {}: {}'.format(target, hashsum))
+            return hashsum
+
+        hashsum = self.hash_file(target)["sha256"]
+        self.__remember(target, stat, hashsum)
+        return hashsum
+
+    def sha256_many(self, targets: list, memo = None) -> tuple:
+        """ Get SHA-256 of many files in thread pool (see 'sha256').
+
+        'targets' - list of paths to files;
+        'memo' - flag to use memoized SHA-256, None - 'self.memo' (see 'sha256').
+
+        Yield tuples (target, sha256) as soon as file is hashed (not in 'targets' order),
+        sha256 is None if file might not be read.
+        """
+
+        futures = {self.__executor.submit(self.sha256, target, memo): target for target in targets}
+        for future in concurrent.futures.as_completed(futures):
+            target = futures[future]
+            try:
+                yield target, future.result()
+            except OSError as read_err:
+                self.HashLog.warning('{} can\'t be read, skipped.'.format(target))
+                self.HashLog.debug('OSError arguments: {}'.format(str(read_err.args)))
+                yield target, None
+
+    def close(self):
+        """ Stop thread pool. """
+
+        self.__executor.shutdown(wait = True)
+        self.HashLog.debug('Thread pool stopped.')
+
+
+    def __feed(self, file_: 'file object', hashers: list):
+        """ Read file in 'self.chunk_size' chunks and update every hasher with every chunk.
+        Chunks are views of reused buffer (or of file mapping), so file content is not copied.
+        """
+
+        size = os.fstat(file_.fileno()).st_size
+        if self.use_mmap is True and size > 0:
+            with mmap.mmap(file_.fileno(), 0, access = mmap.ACCESS_READ) as mapping, memoryview(mapping) as view:
+                for start in range(0, len(view), self.chunk_size):
+                    with view[start:start + self.chunk_size] as chunk: # Views must be released before mapping is closed.
+                        for hasher in hashers:
+                            hasher.update(chunk)
+            return
+
+        buffer = bytearray(self.chunk_size)
+        with memoryview(buffer) as view:
+            while True:
+                read = file_.readinto(buffer)
+                if not read:
+                    break
+                with view[:read] as chunk:
+                    for hasher in hashers:
+                        hasher.update(chunk)
+
+    def __advise(self, file_: 'file object', advice: str):
+        """ Give page cache advice for whole file, if OS supports it. """
+
+        if hasattr(os, 'posix_fadvise') is False:
+            return
+        try:
+            os.posix_fadvise(file_.fileno(), 0, 0, getattr(os, advice))
+        except OSError as advise_err: # Not supported by filesystem, not critical.
+            self.HashLog.debug('posix_fadvise failed: {}'.format(str(advise_err.args)))
+
+    def __recall(self, target: str, stat: os.stat_result) -> str:
+        """ Get memoized SHA-256 of file.
+
+        Return SHA-256 if it is memoized and stamp matches file (mtime and size).
+        Return None otherwise.
+        """
+
+        if self.__xattr is False:
+            return self.__recall_state(stat)
+
+        try:
+            value = os.getxattr(target, self.XATTR).decode('ascii')
+        except OSError as xattr_err:
+            if xattr_err.errno in (errno.ENOTSUP, errno.EOPNOTSUPP):
+                return self.__recall_state(stat)
+            return None # No attribute (ENODATA) or it can't be read.
+        except UnicodeDecodeError:
+            return None
+
+        try:
+            mtime_ns, size, hashsum = value.split(':')
+            if (int(mtime_ns), int(size)) == (stat.st_mtime_ns, stat.st_size) and len(hashsum) == 64:
+                return hashsum
+        except ValueError:
+            self.HashLog.debug('Malformed {} attribute of {}: {}'.format(self.XATTR, target, value))
+        return None
+
+    def __remember(self, target: str, stat: os.stat_result, hashsum: str):
+        """ Memoize SHA-256 of file, stamped with file mtime and size (see '__recall').
+        Recorded state of file (see sql_management.FileStateDB) gets ctime changed by extended attribute.
+        """
+
+        if self.__xattr is True:
+            value = '{}:{}:{}'.format(stat.st_mtime_ns, stat.st_size, hashsum).encode('ascii')
+            try:
+                os.setxattr(target, self.XATTR, value)
+            except OSError as xattr_err: # Not supported by filesystem, read-only file, etc.
+                self.HashLog.debug('Failed to set {} attribute of {}: {}'.format(self.XATTR, target, str(xattr_err.args)))
+            else:
+                self.__refresh_state(target, stat)
+                return
+
+        self.__remember_state(stat, hashsum)
+
+    def __refresh_state(self, target: str, stat: os.stat_result):
+        """ Refresh ctime of recorded state after extended attribute is written, see '__remember'. """
+
+        if self.state_db is None:
+            return
+
+        try:
+            new_stat = os.stat(target)
+        except OSError as stat_err:
+            self.HashLog.debug('OSError arguments: {}'.format(str(stat_err.args)))
+            return
+        if (new_stat.st_dev, new_stat.st_ino, new_stat.st_size, new_stat.st_mtime_ns) != (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns):
+            return # File was changed meanwhile, it has to be rescanned anyway.
+        if new_stat.st_ctime_ns != stat.st_ctime_ns:
+            self.state_db.update_ctimes([(stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, new_stat.st_ctime_ns)])
+
+    def __recall_state(self, stat: os.stat_result) -> str:
+        """ Get SHA-256 memoized in file state index, see '__recall'. """
+
+        if self.state_db is None:
+            return None
+
+        state = self.state_db.get_states([(stat.st_dev, stat.st_ino)]).get((stat.st_dev, stat.st_ino))
+        if state is not None and state[:2] == (stat.st_size, stat.st_mtime_ns) and state[3] is not None:
+            return state[3]
+        return None
+
+    def __remember_state(self, stat: os.stat_result, hashsum: str):
+        """ Memoize SHA-256 in file state index, see '__remember'. """
+
+        if self.state_db is None:
+            return
+
+        self.state_db.update_hashes([(stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, hashsum)])
@@ -1,52 +1,96 @@
-import hashlib
+import asyncio
+import collections
+import concurrent.futures
+import heapq
 import json
 import os
+import queue
+import random
+import threading
 import time
 import logging
 
 try:
     import requests
+    import requests.adapters
 except (ModuleNotFoundError, ImportError):
     print('Failed to start secEnvyronment.')
     print('Check if all dependencies present or if application integrity is OK.')
     raise
 
+from . import hashing
+
+
+CachedResponse = collections.namedtuple('CachedResponse', ['status_code', 'text']) # Response served from report cache
+
 class Metadefender():
     """ OPSWAT Metadefender security scanner class.
     Receive Metadefender API key.
 
     Available methods:
-        public: scan_ip, scan_file, scan_hash
-        private: __request_file_scan_report, __check_response_data, __get_hash, __http_code_check, __parse_scan_report
+        public: scan_ip, scan_ip_bulk, scan_file, scan_files, poll_reports, poll_report, file_scan_report, scan_hash, scan_hash_bulk,
+                lookup_hashes, hash_file, close
+        private: __request, __cached_get, __cache_mode, __account, __sync_quota, __retry_after, __report_upload, __file_scan_progress, __check_response_data, __get_hash, __http_code_check, __parse_scan_report,
+                 __parse_bulk_hash_report, __parse_ip_report
 
     Required packages (dependencies): 
-        built-in: hashlib, os, time, json
+        built-in: collections, heapq, json, os, queue, random, threading, time
         3-d party: requests
+        local: hashing
 
     Use REST-API for communicate with Metadefender.
+    All requests are sent through single connection-pooled session (see '__request'),
+    so TCP and TLS handshakes are paid once per pooled connection, not per request.
+    Requests are throttled by TokenBucket (per-minute limit, paused by 429 replies)
+    and counted against daily quota (see sql_management.QuotaDB).
+    Hash, IP, domain and URL lookups are served from report cache when possible (see sql_management.CacheDB).
+    Every lookup receives 'cache' argument: 'use' (default), 'refresh' (skip cached response, cache new one)
+    or 'bypass' (do not use cache at all).
 
     OPSWAT official site (2018): www.opswat.com
     Metadefender official site (2018): metadefender.opswat.com
 
     Function relationship:
 
-        scan_ip
-
-        scan_file --> __request_file_scan_report -+
-            |                                     |
-            +-------> __check_response_data       |
-            |                                     |
-        scan_hash --> __get_hash                  |
-            |                                     |
-            +-------> __http_code_check <---------+
-            |                                     |
-            +-------> __parse_scan_report <-------+
+        scan_ip, scan_ip_bulk --> __parse_ip_report
+
+        scan_files --> scan_file --> poll_reports --> __file_scan_progress --+
+                         |  poll_report, file_scan_report --^            |
+                         |                                               |
+            +------------+                                               |
+            |                                                            |
+            +-------> __check_response_data                              |
+            |                                                            |
+        scan_hash --> __get_hash                                         |
+            |                                                            |
+            +-------> __http_code_check <--------------------------------+
+            |                                                            |
+            +-------> __parse_scan_report <------------------------------+
+
+        scan_hash_bulk --> hash_file --> __get_hash
+            |
+            +-------> lookup_hashes --> __http_code_check, __parse_bulk_hash_report
     """
 
-    def __init__(self, apikey, logging_level = 30):
+    def __init__(self, apikey, logging_level = 30, pool_size = 10, timeout = (5, 30), deadline = 120, retries = 3,
+                 rate_limit = 10, quota_db = None, daily_quota = None, cache_db = None, cache_ttl = None, poll_timeout = 600,
+                 hasher = None):
         """ API key might be found on official OPSWAT site: opswat.com
 
         'apikey' - Metadefender API key;
+        'pool_size' - max number of kept-alive connections to Metadefender;
+        'timeout' - tuple (connect timeout, read timeout) in seconds, applied to every request attempt;
+        'deadline' - max time (in seconds) single call might take, including all retries;
+        'retries' - max number of retries for idempotent (GET) requests;
+        'rate_limit' - max requests per minute (client-side token bucket), None - no limit;
+        'quota_db' - sql_management.QuotaDB used to share daily quota between runs, None - no accounting;
+        'daily_quota' - dict of daily limits per category ('hash', 'reputation', 'file'),
+            limits not set here are learned from Metadefender responses;
+        'cache_db' - sql_management.CacheDB used to cache lookup responses, None - no caching;
+        'cache_ttl' - dict of cache TTLs (in seconds) per type ('hash', 'hash_negative', 'ip', 'domain', 'url'),
+            overrides default ones;
+        'poll_timeout' - max time (in seconds) to wait for file scan reports;
+        'hasher' - hashing.HashingService used to calculate file hashes, None - default one;
         'logging_level' - verbosity of logging:
             0 - debug,
             30 - warnings,
@@ -70,6 +114,41 @@ class Metadefender():
             self.MetaLog.debug('Metadefender API key length is OK.')
             self.apikey = apikey
 
+        self.bulk_limit = 1000 # Max hashes per bulk lookup request
+        self.bulk_ip_limit = 1000 # Max IP addresses per bulk lookup request
+
+        self.timeout = tuple(timeout)
+        self.deadline = deadline
+        self.retries = retries
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size, max_retries = 0)
+        self.session.mount('https://', adapter)
+
+        self.rate_limiter = TokenBucket(rate_limit / 60 if rate_limit else None, capacity = rate_limit or 1)
+        self.quota_db = quota_db
+        self.daily_quota = daily_quota if daily_quota is not None else dict()
+
+        self.cache_db = cache_db
+        self.cache_mode = 'use' # Default cache mode for lookups, see '__cached_get'
+        self.cache_ttl = {
+            "hash": 7 * 86400,
+            "hash_negative": 3600, # Hash not found (404), file might be uploaded by someone soon
+            "ip": 86400,
+            "domain": 86400,
+            "url": 86400
+        }
+        if cache_ttl is not None:
+            self.cache_ttl.update(cache_ttl)
+
+        self.poll_timeout = poll_timeout
+        self.hasher = hasher if hasher is not None else hashing.HashingService(logging_level = logging_level)
+
+        self.max_upload_size = 200 * 1024 * 1024 # Metadefender file size limit, see error 400144
+        self.upload_chunk_size = 1024 * 1024
+        self.upload_stats = {"Files": 0, "Bytes": 0, "Seconds": 0} # Sent files, bytes and time spent on uploads
+        self.__stats_lock = threading.Lock()
+        self.poll_interval = (1, 30) # Min and max time (in seconds) between file scan report requests
+
         # Scan results response codes, see 'scan_result_i' or something like that.
         self._scan_result_keys = {
             -1: 'Scan not started',
@@ -321,9 +400,10 @@ class Metadefender():
         self.MetaLog.debug('Class initialized.')
 
 
-    def scan_ip(self, target: str) -> dict:
+    def scan_ip(self, target: str, cache = None) -> dict:
         """ Method send IP string to Metadefender and receive response in JSON.
         Method must receive IP string to scan ('target').
+        'cache' - cache mode ('use', 'refresh', 'bypass'), None - 'self.cache_mode'.
 
         If IP was never scanned or treat not detected, return empty dictionary;
         Else return dictionary with AV name and threat name.
@@ -360,7 +440,7 @@ class Metadefender():
         }
 
         self.MetaLog.debug('Sending request.')
-        response = requests.get(url, headers=header)
+        response = self.__cached_get('ip', target, cache, url, headers=header, quota = 'reputation')
         self.MetaLog.debug('Response: {}'.format(response))
         self.MetaLog.debug('Received data: {}'.format(response.text))
 
@@ -373,6 +453,92 @@ class Metadefender():
 
         data = json.loads(response.text)
 
+        scan_result, geo_data = self.__parse_ip_report(data, target)
+        self.MetaLog.info('IP scan succeed.')
+        return scan_result, geo_data
+
+    def scan_ip_bulk(self, targets: 'iterable', cache = None) -> tuple:
+        """ Send IP addresses to Metadefender using bulk IP lookup.
+        'targets' are consumed lazily and sent in chunks of 'self.bulk_ip_limit' addresses,
+        so large networks might be streamed without building full list of addresses.
+
+        'targets' - iterable of IP strings;
+        'cache' - cache mode ('use', 'refresh', 'bypass'), None - 'self.cache_mode'.
+
+        Yield tuples (ip, scan_data, geo_data) as soon as chunk results are received (cached ones first),
+        scan_data and geo_data look like 'scan_ip' ones.
+
+        Raise ConnectionError if error HTTP code received.
+
+        It uses a OPSWAT Metadefender APIv4 for perform scan.
+        (link: https://api.metadefender.com/v4/ip/, sends POST requests)
+        """
+
+        self.MetaLog.debug('Starting bulk IP scan.')
+
+        url = "https://api.metadefender.com/v4/ip"
+        header = {
+            'apikey': self.apikey,
+            'content-type': 'application/json'
+        }
+
+        cache = self.__cache_mode(cache)
+
+        def __send(batch: list) -> tuple:
+            """ Send single chunk and yield parsed results. """
+
+            if cache == 'use':
+                cached = self.cache_db.get_many('ip', batch)
+                for address, (status, report) in cached.items():
+                    scan_result, geo_data = self.__parse_ip_report(json.loads(report), address)
+                    yield address, scan_result, geo_data
+                batch = [address for address in batch if address not in cached]
+                if len(batch) == 0:
+                    return
+
+            self.MetaLog.debug('Sending request with {} addresses.'.format(len(batch)))
+            response = self.__request('POST', url, headers=header, data=json.dumps({"ip_addresses": batch}), quota = 'reputation', cost = len(batch))
+            self.MetaLog.debug('Response: {}'.format(response))
+            self.MetaLog.debug('Received data: {}'.format(response.text))
+
+            self.MetaLog.debug('checking HTTP {} code...'.format(response.status_code))
+            if self.__http_code_check(response.status_code) is False:
+                self.MetaLog.error('Bad HTTP {} code received!'.format(response.status_code))
+                raise ConnectionError('Bad HTTP {} code received!'.format(response.status_code), response.status_code, batch)
+
+            data = json.loads(response.text)
+            if isinstance(data, dict) is True:
+                data = data.get("data", list())
+
+            if cache != 'bypass':
+                self.cache_db.put_many('ip', {item.get("address", ""): (200, json.dumps(item)) for item in data}, self.cache_ttl["ip"])
+
+            for item in data:
+                address = item.get("address", "")
+                scan_result, geo_data = self.__parse_ip_report(item, address)
+                yield address, scan_result, geo_data
+
+        batch = list()
+        for target in targets:
+            batch.append(str(target))
+            if len(batch) >= self.bulk_ip_limit:
+                yield from __send(batch)
+                batch = list()
+        if len(batch) > 0:
+            yield from __send(batch)
+
+        self.MetaLog.info('Bulk IP scan succeed.')
+
+    def __parse_ip_report(self, data: dict, target: str) -> tuple:
+        """ Format IP lookup response.
+
+        'data' - IP lookup response (single address);
+        'target' - IP address, used for logging.
+
+        Return tuple (scan_result, geo_data), see 'scan_ip'.
+        Raise KeyError if bad data received.
+        """
+
         scan_result = {}
         geo_data = {}
         geo_data['Coordinates'] = {}
@@ -399,13 +565,13 @@ class Metadefender():
             self.MetaLog.error('Bad data received. Probably bad request sent.')
             self.MetaLog.debug('KeyError arguments: {}'.format(str(kerr.args)))
             raise
-        else:
-            self.MetaLog.info('IP scan succeed.')
-            return scan_result, geo_data
 
-    def scan_domain(self, target: str) -> dict:
+        return scan_result, geo_data
+
+    def scan_domain(self, target: str, cache = None) -> dict:
         """ Method send domain string to Metadefender and receive response in JSON.
         Method must receive domain-name string to scan ('target').
+        'cache' - cache mode ('use', 'refresh', 'bypass'), None - 'self.cache_mode'.
 
         If domain was never scanned or treat not detected, return empty dictionary;
         Else return dictionary with AV name and threat name.
@@ -433,7 +599,7 @@ class Metadefender():
         }
 
         self.MetaLog.debug('Sending request.')
-        response = requests.get(url, headers=header)
+        response = self.__cached_get('domain', target, cache, url, headers=header, quota = 'reputation')
         self.MetaLog.debug('Response: {}'.format(response))
         self.MetaLog.debug('Received data: {}'.format(response.text))
 
@@ -467,10 +633,11 @@ class Metadefender():
             self.MetaLog.info('IP scan succeed.')
             return scan_result
 
-    def scan_url(self, target: str) -> dict:
+    def scan_url(self, target: str, cache = None) -> dict:
         """ Method send URL string to Metadefender and receive response in JSON.
         Method must receive URL string to scan ('target').
         'target' must be URL-encoded string.
+        'cache' - cache mode ('use', 'refresh', 'bypass'), None - 'self.cache_mode'.
 
         If URL was never scanned or treat not detected, return empty dictionary;
         Else return dictionary with AV name and threat name.
@@ -499,7 +666,7 @@ class Metadefender():
         }
 
         self.MetaLog.debug('Sending request.')
-        response = requests.get(url, headers=header)
+        response = self.__cached_get('url', target, cache, url, headers=header, quota = 'reputation')
         self.MetaLog.debug('Response: {}'.format(response))
         self.MetaLog.debug('Received data: {}'.format(response.text))
 
@@ -534,19 +701,26 @@ class Metadefender():
             return scan_result
 
 
-    def scan_file(self, target: str) -> dict:
+    def scan_file(self, target: str, wait = True) -> dict:
         """ Send file\'s binary to Metadefender and receive response
         in JSON. Method must receive path to file ('target').
 
         It does not accept dir, only files.
 
+        'wait' - flag to wait for scan results. If False, return 'data_id' right after upload
+            (scan report might be requested later, see 'file_scan_report').
+
         Return 2 dictionaries:
             1st. Scan results. Looks like {'Antivirus': 'File_infection_status', ...},
             2nd. Scan details. Looks like {'Total_Scanners': 42, ...}.
         Return False if bad request were sent (and response code is not 200).
 
+        File is streamed from disk in 'self.upload_chunk_size' chunks as raw octet-stream body,
+        so memory usage does not depend on file size.
+
         Raise FileNotFound if file not exist.
         Raise PermissionError if failed to read file\'s binary.
+        Raise ValueError if file is larger than 'self.max_upload_size' (Metadefender error 400144), nothing is sent.
 
         It uses a OPSWAT Metadefender APIv4 for perform scan.
         (link: https://api.metadefender.com/v4/file/, sends GET requests)
@@ -569,24 +743,30 @@ class Metadefender():
         else:
             self.MetaLog.debug('file exists tests passed.')
 
+        size = os.path.getsize(target)
+        if size > self.max_upload_size:
+            self.MetaLog.error('{} is too large to be uploaded ({} bytes, max is {}), error 400144.'.format(target, size, self.max_upload_size))
+            raise ValueError('Metadefender: Exceeded maximum file size allowed (400144).', target, size)
+
         url = "https://api.metadefender.com/v4/file/"
         header = {
             "apikey": self.apikey,
-            "content-type": "application/octet-stream"
+            "content-type": "application/octet-stream",
+            "filename": os.path.basename(target)
         }
 
         try:
-            self.MetaLog.debug('Reading {} binnary.'.format(target))
-            files = {
-                os.path.basename(target): open(target, 'rb')
-            }
+            self.MetaLog.debug('Opening {} binnary.'.format(target))
+            stream = UploadStream(target, chunk_size = self.upload_chunk_size)
         except PermissionError as permdenied:
             self.MetaLog.critical('Failed reading {} binnary. Probably permissions denied.'.format(target))
             self.MetaLog.debug('PermissionError arguments: {}'.format(str(permdenied.args)))
             raise
 
         self.MetaLog.debug('Sending request.')
-        response = requests.post(url, headers=header, files = files)
+        with stream:
+            response = self.__request('POST', url, headers=header, data = stream, quota = 'file')
+        self.__report_upload(target, stream)
         self.MetaLog.debug('Received code: {}'.format(response))
         self.MetaLog.debug('Received data: {}'.format(response.text))
 
@@ -606,23 +786,273 @@ class Metadefender():
             return False
         else:
             self.MetaLog.info('Requests sent.')
-            self.MetaLog.debug('Calling for __request_file_scan_report with argument {}'.format(str(data["data_id"])))
-            return self.__request_file_scan_report(data["data_id"])
+            if wait is False:
+                return data["data_id"]
+            self.MetaLog.debug('Calling for poll_reports with argument {}'.format(str(data["data_id"])))
+            for data_id, report in self.poll_reports([data["data_id"]]):
+                return report
+
+    def scan_files(self, targets: list, timeout = None) -> tuple:
+        """ Upload files to Metadefender, then wait for all scan reports at once (see 'poll_reports').
+
+        'targets' - list of paths to files;
+        'timeout' - max time (in seconds) to wait for reports, None - 'self.poll_timeout'.
+
+        Yield tuples (target, report) as soon as report is ready (not in 'targets' order),
+        report is 2 dictionaries (see 'scan_file') or False if upload or scan failed.
+        Raise ConnectionRefusedError if daily quota is exceeded.
+        """
+
+        uploads = dict() # data_id: [targets]
+        for target in targets:
+            try:
+                data_id = self.scan_file(target, wait = False)
+            except ConnectionRefusedError:
+                raise
+            except (OSError, ValueError) as upload_err:
+                self.MetaLog.error('Failed to upload {}.'.format(target))
+                self.MetaLog.debug('Error arguments: {}'.format(str(upload_err.args)))
+                data_id = False
+
+            if data_id is False:
+                yield target, False
+            else:
+                uploads.setdefault(data_id, list()).append(target)
+
+        for data_id, report in self.poll_reports(list(uploads), timeout = timeout):
+            for target in uploads[data_id]:
+                yield target, report
 
-    def __request_file_scan_report(self, data_id: str, timer = 5) -> dict:
-        """ Lookup for scan results.
-        Send 'data_id' to Metadefender to check if scan was complete.
+    def poll_reports(self, data_ids: list, timeout = None, source = None) -> tuple:
+        """ Wait for scan reports of many uploaded files at once.
 
-        'data_id' - is a string with about 36 chars, received from Metadefender.
-        'timer' - time to wait after each attempt.
+        'data_ids' - list of 'data_id', received from Metadefender (see 'scan_file');
+        'timeout' - max time (in seconds) to wait for every report, None - 'self.poll_timeout';
+        'source' - queue.Queue of more 'data_id' to be polled, None means end of queue.
+            If set, polling lasts till None is received and all reports are done.
 
-        Call for __parse_scan_report and return formated scan results. 
-        Else return False.
+        Every 'data_id' is polled on it\'s own schedule (see 'poll_report'): interval is estimated from reported progress
+        (time left till 100%), if progress did not change, interval is doubled.
+        Intervals are limited by 'self.poll_interval' (min, max).
+
+        Yield tuples (data_id, report) as soon as report is ready,
+        report is 2 dictionaries (see 'scan_file') or False if bad HTTP code received or timeout exceeded.
 
         It uses a OPSWAT Metadefender APIv4 for perform scan.
         (link: https://api.metadefender.com/v4/file/, sends GET requests)
         """
 
+        min_interval = self.poll_interval[0]
+        timeout = self.poll_timeout if timeout is None else timeout
+        schedule = list() # (time to poll, data_id)
+        state = dict() # data_id: (progress, time, interval, deadline)
+
+        def __add(data_id: str):
+            """ Start polling 'data_id'. """
+
+            now = time.monotonic()
+            state[data_id] = (0, now, min_interval, now + timeout)
+            heapq.heappush(schedule, (now + min_interval, data_id))
+
+        for data_id in data_ids:
+            __add(data_id)
+        self.MetaLog.debug('Polling {} reports.'.format(len(schedule)))
+
+        source_open = source is not None
+        while len(schedule) > 0 or source_open is True:
+            if source_open is True: # Take new data_ids while waiting for next poll.
+                try:
+                    wait = None if len(schedule) == 0 else max(0, schedule[0][0] - time.monotonic())
+                    data_id = source.get(timeout = wait)
+                except queue.Empty:
+                    pass
+                else:
+                    if data_id is None:
+                        source_open = False
+                    else:
+                        __add(data_id)
+                    continue
+
+            due, data_id = heapq.heappop(schedule)
+            time.sleep(max(0, due - time.monotonic()))
+
+            report, state[data_id], delay = self.poll_report(data_id, state[data_id])
+            if report is None:
+                heapq.heappush(schedule, (time.monotonic() + delay, data_id))
+            else:
+                yield data_id, report
+
+    def poll_report(self, data_id: str, state = None, timeout = None) -> tuple:
+        """ Request scan report once and schedule next request (single step of 'poll_reports').
+
+        'data_id' - is a string with about 36 chars, received from Metadefender (see 'scan_file');
+        'state' - polling state returned by previous call, None - polling starts now;
+        'timeout' - max time (in seconds) to wait for report, used if 'state' is None, None - 'self.poll_timeout'.
+
+        Return tuple (report, state, delay):
+            report - 2 dictionaries (see 'scan_file') if scan is done,
+                False if bad HTTP code received or timeout exceeded, None if scan is not done yet;
+            state - to be passed to next call;
+            delay - time (in seconds) to wait before next call.
+        """
+
+        min_interval, max_interval = self.poll_interval
+        if state is None:
+            now = time.monotonic()
+            state = (0, now, min_interval, now + (self.poll_timeout if timeout is None else timeout))
+
+        try:
+            progress, data = self.__file_scan_progress(data_id)
+        except (ConnectionError, ValueError) as poll_err:
+            self.MetaLog.error('Failed to request scan report for {}.'.format(data_id))
+            self.MetaLog.debug('Error arguments: {}'.format(str(poll_err.args)))
+            progress, data = False, None
+
+        now = time.monotonic()
+        last_progress, last_time, interval, deadline = state
+        if progress is False:
+            return False, state, 0
+        elif progress >= 100:
+            self.MetaLog.info('Scan seccessfully done.')
+            self.MetaLog.debug('Calling for __parse_scan_report.')
+            return self.__parse_scan_report(data), state, 0
+        elif now >= deadline:
+            self.MetaLog.error('Scan report for {} is not ready in time ({}%), giving up.'.format(data_id, progress))
+            return False, state, 0
+
+        if progress > last_progress:
+            speed = (progress - last_progress) / max(now - last_time, 0.001) # Percents per second
+            interval = (100 - progress) / speed
+        else:
+            interval = interval * 2
+        interval = min(max(interval, min_interval), max_interval)
+
+        self.MetaLog.debug('Scan {} is not done yet, {}% currently, next check in {:.1f} seconds.'.format(data_id, progress, interval))
+        return None, (progress, now, interval, deadline), min(now + interval, deadline) - now
+
+    def file_scan_report(self, data_id: str) -> dict:
+        """ Request scan report once.
+
+        'data_id' - is a string with about 36 chars, received from Metadefender (see 'scan_file').
+
+        Return 2 dictionaries (see 'scan_file') if scan is done.
+        Return None if scan is not done yet.
+        Return False if bad HTTP code received.
+
+        It uses a OPSWAT Metadefender APIv4 for perform scan.
+        (link: https://api.metadefender.com/v4/file/, sends GET requests)
+        """
+
+        progress, data = self.__file_scan_progress(data_id)
+        if progress is False:
+            return False
+        elif progress < 100:
+            return None
+        else:
+            self.MetaLog.info('Scan seccessfully done.')
+            self.MetaLog.debug('Calling for __parse_scan_report.')
+            return self.__parse_scan_report(data)
+
+    def close(self):
+        """ Close pooled connections and stop hashing threads. """
+
+        self.MetaLog.debug('Closing session.')
+        self.session.close()
+        self.hasher.close()
+
+    def __request(self, method: str, url: str, quota = None, cost = 1, **kwargs) -> 'requests.Response':
+        """ Send HTTP request using pooled session.
+
+        'method' - HTTP method ('GET', 'POST');
+        'url' - request URL;
+        'quota' - daily quota category request is counted against ('hash', 'reputation', 'file'), None - not counted;
+        'cost' - number of quota units request takes (number of items in bulk request);
+        'kwargs' - arguments to be sent to requests (headers, data, ...).
+
+        Every attempt waits for rate limiter token and is limited by 'self.timeout' and by the rest of 'self.deadline'.
+        GET requests are idempotent, so they are retried (up to 'self.retries' times)
+        on connection errors, timeouts and 5XX codes, with exponential backoff and full jitter.
+        Throttled requests (429001, 429002) are not processed by Metadefender, so they are resent
+        after 'Retry-After' pause, while deadline allows.
+
+        Return requests.Response.
+        Raise ConnectionRefusedError if daily quota is exceeded (request is not sent).
+        Raise ConnectionError if request failed or deadline exceeded.
+        """
+
+        if quota is not None and self.__account(quota, cost) is False:
+            raise ConnectionRefusedError('Metadefender: daily {} quota exceeded.'.format(quota), url)
+
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self.rate_limiter.acquire(timeout = remaining) is False:
+                    self.MetaLog.error('{} {}: deadline of {} seconds exceeded.'.format(method, url, self.deadline))
+                    raise ConnectionError('Metadefender: request deadline exceeded.', url)
+
+                remaining = deadline - time.monotonic()
+                timeout = (min(self.timeout[0], remaining), min(self.timeout[1], remaining))
+                retry = method == 'GET' and attempt < self.retries
+                if isinstance(kwargs.get('data'), UploadStream) is True: # Resent request must upload whole file again.
+                    kwargs['data'].rewind()
+                try:
+                    response = self.session.request(method, url, timeout = timeout, **kwargs)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as request_err:
+                    self.MetaLog.warning('{} {} failed: {}'.format(method, url, type(request_err).__name__))
+                    self.MetaLog.debug('Error arguments: {}'.format(str(request_err.args)))
+                    if retry is False:
+                        raise ConnectionError('Metadefender: request failed.', url, str(request_err))
+                else:
+                    if quota is not None:
+                        self.__sync_quota(quota, response)
+
+                    if response.status_code == 429:
+                        pause = self.__retry_after(response)
+                        if pause is None:
+                            self.MetaLog.warning('{} {}: daily quota exceeded.'.format(method, url))
+                            if quota is not None and self.quota_db is not None:
+                                self.quota_db.exhaust(self.apikey, quota)
+                            return response
+                        self.rate_limiter.pause(pause)
+                        if time.monotonic() + pause >= deadline:
+                            self.MetaLog.warning('{} {}: throttled for {} seconds, deadline is closer.'.format(method, url, pause))
+                            return response
+                        self.MetaLog.warning('{} {}: throttled, waiting for {} seconds.'.format(method, url, pause))
+                        continue
+                    elif retry is False or response.status_code not in (500, 502, 503, 504):
+                        return response
+                    self.MetaLog.warning('{} {}: HTTP {} received, retrying.'.format(method, url, response.status_code))
+
+                attempt += 1
+                backoff = random.uniform(0, min(30, 0.5 * 2 ** attempt)) # Full jitter
+                time.sleep(max(0, min(backoff, deadline - time.monotonic())))
+        except ConnectionError:
+            if quota is not None:
+                self.__account(quota, -cost) # Request was not processed, return quota.
+            raise
+
+    def __report_upload(self, target: str, stream: 'UploadStream'):
+        """ Log upload throughput and add it to 'self.upload_stats'. """
+
+        seconds = stream.elapsed()
+        self.MetaLog.info('{}: {} bytes sent in {:.2f} seconds ({:.1f} KiB/s).'.format(
+                            target, stream.sent, seconds, stream.sent / 1024 / seconds if seconds > 0 else 0))
+        with self.__stats_lock:
+            self.upload_stats["Files"] += 1
+            self.upload_stats["Bytes"] += stream.sent
+            self.upload_stats["Seconds"] += seconds
+
+    def __file_scan_progress(self, data_id: str) -> tuple:
+        """ Request scan report and get scan progress.
+
+        'data_id' - is a string with about 36 chars, received from Metadefender (see 'scan_file').
+
+        Return tuple (progress, report data), progress is percentage (0 if file is queued or unknown).
+        Return (False, None) if bad HTTP code received.
+        """
+
         self.MetaLog.debug('Requesting scan report for {}'.format(data_id))
         url = "https://api.metadefender.com/v4/file/{}".format(data_id)
         header = {
@@ -630,51 +1060,128 @@ class Metadefender():
         }
 
         self.MetaLog.debug('Sending request.')
-        response = requests.get(url, headers=header)
+        response = self.__request('GET', url, headers=header)
         self.MetaLog.debug('Received code: {}'.format(response.status_code))
         self.MetaLog.debug('Received data: {}'.format(response.text))
 
         self.MetaLog.debug('checking HTTP {} code...'.format(response.status_code))
         if self.__http_code_check(response.status_code) is False:
             self.MetaLog.info('Bad HTTP {} code received!'.format(response.status_code))
-            return False
+            return False, None
         else:
             self.MetaLog.debug('OK HTTP {} code.'.format(response.status_code))
 
         self.MetaLog.debug('Loads received JSON data.')
         data = json.loads(response.text)
 
-        def __check_done(response: dict) -> bool:
-            """ Check if scan done. """
+        self.MetaLog.debug('Check if scan complete...')
+        try:
+            return data["scan_results"]["progress_percentage"], data
+        except (KeyError, TypeError) as kerr:
+            self.MetaLog.warning('Scan progress is not reported yet.')
+            self.MetaLog.debug('Error arguments: {}'.format(str(kerr.args)))
+            return 0, data
+
+    def __cached_get(self, type_: str, key: str, cache: str, url: str, **kwargs) -> 'requests.Response':
+        """ Send GET request (see '__request') or take response from report cache.
+
+        'type_' - cache type ('hash', 'ip', 'domain', 'url');
+        'key' - cache key (hash, address...);
+        'cache' - cache mode:
+            'use' - return cached response if it is not expired, cache received one,
+            'refresh' - send request and cache received response,
+            'bypass' - send request, do not touch cache,
+            None - use 'self.cache_mode';
+        'url', 'kwargs' - request arguments (see '__request').
+
+        Successful (200) responses are cached for 'self.cache_ttl[type_]' seconds,
+        unknown hashes (404) for 'self.cache_ttl["hash_negative"]' seconds.
+
+        Return requests.Response or CachedResponse (both have 'status_code' and 'text').
+        """
 
-            self.MetaLog.debug('Check if scan complete...')
-            try:
-                if response["scan_results"]["progress_percentage"] == 100:
-                    self.MetaLog.debug('Scan complete.')
-                    return True
-                else:
-                    self.MetaLog.debug('Scan is not done yet, {}% currently'.format(response["scan_results"]["progress_percentage"]))
-                    return False
-            except KeyError as kerr:
-                self.MetaLog.error('Bad data received. Probably bad request sent.')
-                self.MetaLog.debug('KeyError arguments: {}'.format(str(kerr.args)))
-                return False
+        cache = self.__cache_mode(cache)
+        if cache == 'use':
+            cached = self.cache_db.get_many(type_, [key])
+            if key in cached:
+                self.MetaLog.debug('{} {} found in cache.'.format(type_, key))
+                return CachedResponse(*cached[key])
+
+        response = self.__request('GET', url, **kwargs)
+        if cache != 'bypass':
+            if response.status_code == 200:
+                self.cache_db.put_many(type_, {key: (200, response.text)}, self.cache_ttl[type_])
+            elif response.status_code == 404 and type_ == 'hash':
+                self.cache_db.put_many(type_, {key: (404, response.text)}, self.cache_ttl["hash_negative"])
+        return response
+
+    def __cache_mode(self, cache: str) -> str:
+        """ Resolve cache mode of single call.
+
+        Return 'bypass' if cache is not configured.
+        Raise ValueError if unknown mode received.
+        """
 
-        while __check_done(data) is False:
-            self.MetaLog.debug('Awaiting results...')
-            time.sleep(timer)
-            return self.__request_file_scan_report(data_id, timer)
-        else:
-            self.MetaLog.info('Scan seccessfully done.')
-            self.MetaLog.debug('Calling for __parse_scan_report.')
-            return self.__parse_scan_report(data)
+        if cache is None:
+            cache = self.cache_mode
+        if cache not in ('use', 'refresh', 'bypass'):
+            self.MetaLog.error('Unknown cache mode: {}'.format(cache))
+            raise ValueError('Unknown cache mode!', cache)
+        return cache if self.cache_db is not None else 'bypass'
+
+    def __account(self, quota: str, cost: int) -> bool:
+        """ Take 'cost' units from daily 'quota' (return them if 'cost' is negative).
+
+        Return False if daily quota is exceeded.
+        """
+
+        if self.quota_db is None:
+            return True
+        return self.quota_db.consume(self.apikey, quota, cost, self.daily_quota.get(quota))
+
+    def __sync_quota(self, quota: str, response: 'requests.Response'):
+        """ Record daily limit reported by Metadefender ('X-RateLimit-Limit', 'X-RateLimit-Remaining' headers). """
+
+        if self.quota_db is None:
+            return
+        try:
+            limit = int(response.headers["X-RateLimit-Limit"])
+            remaining = int(response.headers["X-RateLimit-Remaining"])
+        except (KeyError, ValueError, TypeError):
+            return
+        self.quota_db.sync(self.apikey, quota, limit, remaining)
+
+    def __retry_after(self, response: 'requests.Response') -> float:
+        """ Get pause (in seconds) for throttled (429) response.
 
+        Pause is taken from 'Retry-After' or 'X-RateLimit-Reset-In' headers,
+        otherwise default pause for received error code is used.
 
-    def scan_hash(self, target: str, __send: bool = False) -> dict:
+        Return None if daily quota is exceeded (429000), so retry makes no sense.
+        """
+
+        try:
+            code = str(json.loads(response.text)["error"]["code"])
+        except (ValueError, KeyError, TypeError):
+            code = None
+        self.MetaLog.debug('429 error code: {}'.format(code))
+        if code == '429000':
+            return None
+
+        for header in ('Retry-After', 'X-RateLimit-Reset-In'):
+            try:
+                return max(float(response.headers[header]), 0)
+            except (KeyError, ValueError, TypeError):
+                continue
+        return 5 if code == '429002' else 60
+
+    def scan_hash(self, target: str, __send: bool = False, cache = None) -> dict:
         """ Perform SHA-256 calculation, send file hash to Metadefender
         and receive response in JSON. Method must receive path to file ('target').
         If '__send' is True, in case of error HTTP code received, 'scan_file' with same target
         will be called.
+        'cache' - cache mode ('use', 'refresh', 'bypass'), None - 'self.cache_mode'.
+            Unknown hashes (404) are cached for shorter time.
 
         Return 2 dictionaries:
             1st. Scan results. Looks like {'Antivirus': 'File_infection_status', ...},
@@ -683,6 +1190,7 @@ class Metadefender():
 
         If target is not found, raise FileNotFound.
         Raise ConnectionError if error HTTP code received (skiped if '__send' is True).
+        Raise ConnectionRefusedError if rate limit or daily quota is exceeded (file is not sent even if '__send' is True).
 
         It uses a OPSWAT Metadefender APIv4 for perform scan.
         (link: https://api.metadefender.com/v4/hash/, sends GET requests)
@@ -708,14 +1216,16 @@ class Metadefender():
         }
 
         self.MetaLog.debug('Sending request.')
-        response = requests.get(url, headers=header)
+        response = self.__cached_get('hash', hashsum.upper(), cache, url, headers=header, quota = 'hash')
         self.MetaLog.debug('Received code: {}'.format(response))
         self.MetaLog.debug('Received data: {}'.format(response.text))
 
         self.MetaLog.debug('checking HTTP {} code...'.format(response.status_code))
         if self.__http_code_check(response.status_code) is False:
             self.MetaLog.error('Bad HTTP {} code received!'.format(response.status_code))
-            if __send is True:
+            if response.status_code == 429: # Uploading file would take even more quota.
+                raise ConnectionRefusedError('Metadefender: rate limit or quota exceeded.', response.status_code, target, hashsum)
+            elif __send is True:
                 self.MetaLog.info('Trying to send file\'s binnary...')
                 return self.scan_file(target)
             else:
@@ -735,9 +1245,129 @@ class Metadefender():
             self.MetaLog.debug('Scan complete.')
             return self.__parse_scan_report(data)
 
+    def scan_hash_bulk(self, targets: list, cache = None) -> dict:
+        """ Perform SHA-256 calculation for every file in 'targets' and look all hashes up
+        using Metadefender bulk hash lookup (see 'lookup_hashes').
+        Files with the same content are looked up once, cached hashes are not sent.
+
+        'targets' - list of paths to files;
+        'cache' - cache mode ('use', 'refresh', 'bypass'), None - 'self.cache_mode'.
+
+        Return dict, looks like:
+        {
+            'path/to/file': (scan_result, scan_details), # See 'scan_hash'
+            'path/to/unknown/file': False # Hash is unknown to Metadefender or file can\'t be read
+        }
+
+        Raise ConnectionError if error HTTP code received.
+        Raise ConnectionRefusedError if rate limit or daily quota is exceeded.
+        """
+
+        self.MetaLog.debug('Starting bulk hash lookup for {} files.'.format(len(targets)))
+
+        hashes = dict() # hash: [paths]
+        results = dict()
+        for target, hashsum in self.hasher.sha256_many(targets): # Files are hashed in parallel, memoized hashes are reused.
+            if hashsum is None:
+                results[target] = False
+                continue
+            hashes.setdefault(hashsum.upper(), list()).append(target)
+
+        for hashsum, result in self.lookup_hashes(list(hashes), cache = cache).items():
+            for target in hashes[hashsum]:
+                results[target] = result
+
+        self.MetaLog.info('Bulk hash lookup complete: {} files, {} unique hashes.'.format(len(targets), len(hashes)))
+        return results
+
+    def lookup_hashes(self, hashes: list, cache = None) -> dict:
+        """ Look SHA-256 hashes up using Metadefender bulk hash lookup
+        (one request per 'self.bulk_limit' hashes). Cached hashes are not sent.
+
+        'hashes' - list of SHA-256 hashes (upper case, see 'hash_file');
+        'cache' - cache mode ('use', 'refresh', 'bypass'), None - 'self.cache_mode'.
+
+        Return dict, looks like:
+        {
+            'HASH': (scan_result, scan_details), # See 'scan_hash'
+            'UNKNOWN_HASH': False # Hash is unknown to Metadefender
+        }
+
+        Raise ConnectionError if error HTTP code received.
+        Raise ConnectionRefusedError if rate limit or daily quota is exceeded.
+
+        It uses a OPSWAT Metadefender APIv4 for perform scan.
+        (link: https://api.metadefender.com/v4/hash/, sends POST requests)
+        """
+
+        url = "https://api.metadefender.com/v4/hash"
+        header = {
+            "apikey": str(self.apikey),
+            "content-type": "application/json",
+            "include_scan_details": "1"
+        }
+
+        results = dict()
+        cache = self.__cache_mode(cache)
+        hash_list = list(dict.fromkeys(hashes))
+        if cache == 'use':
+            cached = self.cache_db.get_many('hash', hash_list)
+            for hashsum, (status, report) in cached.items():
+                results[hashsum] = self.__parse_bulk_hash_report(json.loads(report), hashsum) if status == 200 else False
+            hash_list = [hashsum for hashsum in hash_list if hashsum not in cached]
+
+        for start in range(0, len(hash_list), self.bulk_limit):
+            batch = hash_list[start:start + self.bulk_limit]
+
+            self.MetaLog.debug('Sending request with {} hashes.'.format(len(batch)))
+            response = self.__request('POST', url, headers=header, data=json.dumps({"hash": batch}), quota = 'hash', cost = len(batch))
+            self.MetaLog.debug('Received code: {}'.format(response))
+            self.MetaLog.debug('Received data: {}'.format(response.text))
+
+            self.MetaLog.debug('checking HTTP {} code...'.format(response.status_code))
+            if self.__http_code_check(response.status_code) is False:
+                self.MetaLog.error('Bad HTTP {} code received!'.format(response.status_code))
+                if response.status_code == 429:
+                    raise ConnectionRefusedError('Metadefender: rate limit or quota exceeded.', response.status_code, batch)
+                raise ConnectionError('Bad HTTP {} code received!'.format(response.status_code), response.status_code, batch)
+
+            data = json.loads(response.text)
+            if isinstance(data, dict) is True:
+                data = data.get("data", list())
+
+            found = dict()
+            for item in data:
+                hashsum = str(item.get("hash", "")).upper()
+                if hashsum in results or hashsum not in batch:
+                    continue
+                results[hashsum] = self.__parse_bulk_hash_report(item, hashsum)
+                found[hashsum] = (200 if results[hashsum] is not False else 404, json.dumps(item))
+
+            if cache != 'bypass':
+                for hashsum in batch: # Hashes not mentioned in response are unknown.
+                    found.setdefault(hashsum, (404, '{}'))
+                self.cache_db.put_many('hash', {hashsum: entry for hashsum, entry in found.items() if entry[0] == 200}, self.cache_ttl["hash"])
+                self.cache_db.put_many('hash', {hashsum: entry for hashsum, entry in found.items() if entry[0] == 404}, self.cache_ttl["hash_negative"])
+
+        for hashsum in hashes: # Hashes not mentioned in response are unknown.
+            results.setdefault(hashsum, False)
+
+        self.MetaLog.debug('{} hashes looked up, {} sent.'.format(len(results), len(hash_list)))
+        return results
+
+    def hash_file(self, target: str) -> str:
+        """ Calculate SHA-256 of file, Metadefender uses it for file identification.
+
+        Return hash (upper case).
+        If file is unavailable or might not be accessed, raise PermissionError or FileNotFound error.
+        """
+
+        return self.__get_hash(target).upper()
+
     def __get_hash(self, target: str) -> str:
         """ Calculate SHA-256.
-        It reads file\'s ('target') binnary and calculate it\'s hash.
+        It reads file\'s ('target') binnary and calculate it\'s hash (see hashing.HashingService),
+        hash memoized for unchanged file is returned without reading it.
 
         Return file hash if calculated success.
         If file is unavailable or might not be accessed, raise PermissionError or FileNotFound error.
@@ -747,13 +1377,7 @@ class Metadefender():
 
         self.MetaLog.debug('Calculating hash for {}'.format(str(target)))
         try:
-            with open(target, 'rb') as file_:
-                process = hashlib.sha256()
-                while True:
-                    data = file_.read(8192)
-                    if not data:
-                        break
-                    process.update(data)
+            calculated_hash = self.hasher.sha256(target)
         except PermissionError as permissions_denied:
             self.MetaLog.critical('Failed reading  {} binnary. Probably permissions denied.'.format(target))
             self.MetaLog.debug('PermissionError arguments: {}'.format(str(permissions_denied.args)))
@@ -763,7 +1387,6 @@ class Metadefender():
             self.MetaLog.debug('FileNotFoundError arguments: {}'.format(str(file_not_found_err.args)))
             raise
         else:
-            calculated_hash = str(process.hexdigest())
             self.MetaLog.debug('Complete hash calculating. Hash for {} is {}'.format(target, calculated_hash))
             return calculated_hash
 
@@ -821,6 +1444,34 @@ class Metadefender():
             return scan_result, scan_details
 
 
+    def __parse_bulk_hash_report(self, data: dict, target: str) -> tuple:
+        """ Format single bulk hash lookup item.
+
+        'data' - item of bulk lookup response;
+        'target' - path to file, used for logging.
+
+        Return tuple (scan_result, scan_details), same as '__parse_scan_report' does.
+        Return False if hash is unknown to Metadefender.
+        """
+
+        if "error" in data or (data.get("scan_result_i") is None and "scan_results" not in data):
+            self.MetaLog.info('{} hash is not known to Metadefender.'.format(target))
+            return False
+
+        if "scan_results" in data:
+            data.setdefault("file_info", dict()).setdefault("display_name", target)
+            return self.__parse_scan_report(data)
+
+        # Lookup without scan details: only overall verdict is available.
+        scan_details = {
+            'TotalAV': data.get("total_avs", 0),
+            'TotalDetections': data.get("total_detected_avs", 0),
+            'TotalRecognized': data.get("scan_all_result_a", self._scan_result_keys.get(data["scan_result_i"], 'Unknown')),
+            'TimeSpent': data.get("total_time", 0)
+        }
+        self.MetaLog.info('{} recognized: {}'.format(target, scan_details['TotalRecognized']))
+        return dict(), scan_details
+
     def __check_response_data(self, data: str, http_code: int) -> bool:
         """ Check for Error signs in received data.
         Check for:
@@ -886,7 +1537,8 @@ class Metadefender():
         If code is 2XX (200, 204, ...), return True;
         If code is 3XX (301, ...), return True;
         If code is 4XX (400, 401, ...), return False;
-        If code is 5XX (500, 501, ...), raise ConnectionRefusedError.
+        If code is 5XX (500, 501, ...), raise ConnectionError
+            (not ConnectionRefusedError, which means refused due to rate limit or daily quota).
 
         If code is not defined in '_http_status_codes', then raise ValueError.
 
@@ -920,8 +1572,606 @@ class Metadefender():
                 return False
             elif 500 <= http_code:
                 self.MetaLog.error('Server-side problem detected.')
-                raise ConnectionRefusedError('Metadefender: Server-side problem detected, please, try again later.')
+                raise ConnectionError('Metadefender: Server-side problem detected, please, try again later.', http_code)
 
         else:
             self.MetaLog.error('{} HTTP code is not in list;'.format(http_code))
             raise ValueError('Metadefender: Unknown HTTP response received: {} !'.format(http_code))
+
+
+
+class UploadStream():
+    """ File body for streamed upload.
+
+    Available methods:
+        public: rewind, elapsed, close
+        private: -
+
+    Required packages (dependencies):
+        built-in: os, time
+        3-d party: -
+
+    Iterating over object yields file content in 'chunk_size' chunks, so requests sends
+    file straight from disk. File size is known ('len'), so request has Content-Length
+    and is not chunk-encoded. Sent bytes are counted in 'sent'.
+    Object is a context manager, file is closed on exit.
+    """
+
+    def __init__(self, path: str, chunk_size = 1024 * 1024):
+        """ Open file to be sent.
+
+        'path' - path to file;
+        'chunk_size' - size (in bytes) of chunks file is read by.
+
+        Raise PermissionError if file can\'t be read.
+        """
+
+        self.path = path
+        self.chunk_size = chunk_size
+        self.sent = 0
+        self.started = None
+        self.finished = None
+        self.__file = open(path, 'rb')
+        self.__size = os.fstat(self.__file.fileno()).st_size
+
+    def __len__(self) -> int:
+        return self.__size
+
+    def __iter__(self) -> bytes:
+        self.started = time.monotonic()
+        while True:
+            chunk = self.__file.read(self.chunk_size)
+            if not chunk:
+                break
+            self.sent += len(chunk)
+            yield chunk
+        self.finished = time.monotonic()
+
+    def __enter__(self) -> 'UploadStream':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def rewind(self):
+        """ Start sending from the beginning (used when request is resent). """
+
+        self.__file.seek(0)
+        self.sent = 0
+        self.started = None
+        self.finished = None
+
+    def elapsed(self) -> float:
+        """ Return time (in seconds) spent on sending file. """
+
+        if self.started is None:
+            return 0
+        return (self.finished if self.finished is not None else time.monotonic()) - self.started
+
+    def close(self):
+        """ Close file. """
+
+        self.__file.close()
+
+
+
+class TokenBucket():
+    """ Thread-safe token bucket rate limiter.
+
+    Available methods:
+        public: acquire, pause
+        private: __refill
+
+    Required packages (dependencies):
+        built-in: threading, time
+        3-d party: -
+
+    Bucket holds up to 'capacity' tokens and is refilled with 'rate' tokens per second.
+    Every request takes one token. 'pause' empties bucket and blocks it for given time
+    (used when Metadefender throttles requests).
+    """
+
+    def __init__(self, rate: float, capacity = 1):
+        """ Create full bucket.
+
+        'rate' - tokens per second, None - no limit;
+        'capacity' - max tokens (max burst size);
+        """
+
+        self.rate = rate
+        self.capacity = capacity
+        self.__tokens = capacity
+        self.__updated = time.monotonic()
+        self.__paused_until = 0
+        self.__lock = threading.Lock()
+
+
+    def acquire(self, timeout = None) -> bool:
+        """ Take token, wait for it if bucket is empty or paused.
+
+        'timeout' - max time (in seconds) to wait, None - wait as long as needed.
+
+        Return True if token taken.
+        Return False if token would not be available in 'timeout' (bucket is not changed).
+        """
+
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__refill(now)
+                if now >= self.__paused_until and (self.rate is None or self.__tokens >= 1):
+                    if self.rate is not None:
+                        self.__tokens -= 1
+                    return True
+                wait = max(self.__paused_until - now, 0 if self.rate is None else (1 - self.__tokens) / self.rate)
+
+            if end is not None and now + wait > end:
+                return False
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """ Empty bucket and block it for 'seconds'. """
+
+        with self.__lock:
+            self.__tokens = 0
+            self.__updated = time.monotonic()
+            self.__paused_until = max(self.__paused_until, self.__updated + seconds)
+
+
+    def __refill(self, now: float):
+        """ Add tokens for time passed since last refill. """
+
+        if self.rate is not None:
+            self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+
+
+class VerificationPipeline():
+    """ Verify files using Metadefender in stages:
+    hash --> bulk lookup (with cache) --> upload unknown files --> poll reports.
+
+    Available methods:
+        public: add, close
+        private: __hash_stage, __lookup_stage, __upload_stage, __poll_stage, __lookup, __finish_upload, __deliver
+
+    Required packages (dependencies):
+        built-in: queue, threading, time
+        3-d party: -
+
+    Every stage runs in it\'s own thread(s), stages are connected by bounded queues,
+    so files are hashed while previous batch is looked up and unknown files are uploaded
+    while reports of previous uploads are polled. 'add' blocks if hash queue is full.
+
+    Hashes are sent in batches: batch is sent when 'batch_size' hashes are collected
+    or 'window' seconds passed since the first hash of batch was received, whichever comes first.
+    Only hashes reported unknown by Metadefender are uploaded, every content is uploaded once
+    (copies of the same file receive the same report). If lookup fails, files of batch fail (nothing is uploaded).
+
+    Results are sent to 'callback' one by one: callback(path, result) (or callback(path, result, hashsum), see 'with_hash'),
+    where result is (scan_result, scan_details), False if file can\'t be verified (including Metadefender server errors)
+    or None if lookup or upload was refused due to rate limit or daily quota.
+    Callback calls are serialized (never run concurrently).
+    Unexpected errors fail single file or batch, every stage sends end-of-stream sentinels
+    to the next one on exit, so 'close' always returns.
+    """
+
+    def __init__(self, metadefender: Metadefender, callback: 'function', batch_size = 100, window = 5,
+                 hash_workers = 2, upload_workers = 2, queue_size = 1000, with_hash = False, logging_level = 30):
+        """ Start pipeline threads.
+
+        'metadefender' - Metadefender object used for verification;
+        'callback' - function to receive results;
+        'batch_size' - max hashes in bulk lookup;
+        'window' - max time (in seconds) hash waits in batch;
+        'hash_workers' - number of hashing threads;
+        'upload_workers' - number of concurrent uploads;
+        'queue_size' - max number of items waiting between stages;
+        'with_hash' - flag to send SHA-256 of file (upper case, None if file can\'t be read) to callback as third argument;
+        'logging_level' - verbosity of logging:
+            0 - debug,
+            30 - warnings,
+            50 - critical.
+            See 'logging' docs;
+        """
+
+        self.PipeLog = logging.getLogger('Metadefender Pipeline')
+        self.PipeLog.debug('Initializing class...')
+
+        self.metadefender = metadefender
+        self.callback = callback
+        self.batch_size = batch_size
+        self.window = window
+        self.hash_workers = hash_workers
+        self.upload_workers = upload_workers
+        self.with_hash = with_hash
+
+        self.__hash_queue = queue.Queue(maxsize = queue_size) # (path, [copies])
+        self.__lookup_queue = queue.Queue(maxsize = queue_size) # (path, hash)
+        self.__upload_queue = queue.Queue(maxsize = queue_size) # hash
+        self.__poll_queue = queue.Queue(maxsize = queue_size) # data_id
+
+        self.__uploads = dict() # hash: [paths waiting for upload result]
+        self.__uploaded = dict() # hash: upload result, for copies found after upload is done
+        self.__data_ids = dict() # data_id: hash
+        self.__state_lock = threading.Lock()
+        self.__callback_lock = threading.Lock()
+
+        self.__threads = [threading.Thread(target = self.__hash_stage, daemon = True) for _ in range(hash_workers)]
+        self.__threads.append(threading.Thread(target = self.__lookup_stage, daemon = True))
+        self.__threads.extend(threading.Thread(target = self.__upload_stage, daemon = True) for _ in range(upload_workers))
+        self.__threads.append(threading.Thread(target = self.__poll_stage, daemon = True))
+        for thread in self.__threads:
+            thread.start()
+
+        self.PipeLog.debug('Class initialized.')
+
+
+    def add(self, target: str, copies = None):
+        """ Add file to be verified.
+
+        'target' - path to file;
+        'copies' - list of paths to files with the same content (hardlinks, copies),
+            they are not hashed and receive result of 'target'.
+        """
+
+        self.__hash_queue.put((target, list(copies) if copies is not None else list()))
+
+    def close(self):
+        """ Process remaining files and wait for all results. """
+
+        for _ in range(self.hash_workers):
+            self.__hash_queue.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.PipeLog.debug('Pipeline closed.')
+
+
+    def __hash_stage(self):
+        """ Hashing thread: path --> (path, hash). """
+
+        try:
+            while True:
+                item = self.__hash_queue.get()
+                if item is None:
+                    return
+
+                target, copies = item
+                try:
+                    hashsum = self.metadefender.hash_file(target)
+                except Exception as hash_err: # Any failure is file\'s failure, stage goes on.
+                    self.PipeLog.warning('{} can\'t be read, skipped.'.format(target))
+                    self.PipeLog.debug('Error arguments: {}'.format(repr(hash_err)))
+                    self.__deliver([target] + copies, False, None)
+                else:
+                    for path in [target] + copies:
+                        self.__lookup_queue.put((path, hashsum))
+        finally: # Next stage waits for sentinel of every hashing thread.
+            self.__lookup_queue.put(None)
+
+    def __lookup_stage(self):
+        """ Lookup thread: collect batch of hashes, look them up, send unknown ones to upload. """
+
+        batch = list()
+        batch_started = None
+        finished = 0
+        try:
+            while finished < self.hash_workers:
+                timeout = None if len(batch) == 0 else max(0, batch_started + self.window - time.monotonic())
+                try:
+                    item = self.__lookup_queue.get(timeout = timeout)
+                except queue.Empty:
+                    item = False # Window passed
+
+                if item is None:
+                    finished += 1
+                elif item is not False:
+                    if len(batch) == 0:
+                        batch_started = time.monotonic()
+                    batch.append(item)
+
+                if len(batch) > 0 and (item is False or len(batch) >= self.batch_size or finished == self.hash_workers):
+                    try:
+                        self.__lookup(batch)
+                    except Exception as lookup_err: # Single batch failure must not stop the stage.
+                        self.PipeLog.error('Failed to process batch of {} hashes.'.format(len(batch)))
+                        self.PipeLog.debug('Error arguments: {}'.format(repr(lookup_err)))
+                    batch = list()
+        finally: # Upload and poll stages (and 'close') wait for sentinels.
+            for _ in range(self.upload_workers):
+                self.__upload_queue.put(None)
+
+    def __lookup(self, batch: list):
+        """ Look batch of (path, hash) up, deliver known results and queue unknown hashes for upload. """
+
+        hashes = dict() # hash: [paths]
+        for target, hashsum in batch:
+            hashes.setdefault(hashsum, list()).append(target)
+
+        self.PipeLog.debug('Looking up {} hashes.'.format(len(hashes)))
+        try:
+            results = self.metadefender.lookup_hashes(list(hashes))
+        except ConnectionRefusedError as quota_err: # Uploading unknown files would take even more quota.
+            self.PipeLog.error('Rate limit or quota exceeded, files are reported as not verified.')
+            self.PipeLog.debug('Error arguments: {}'.format(str(quota_err.args)))
+            results = {hashsum: None for hashsum in hashes}
+        except Exception as lookup_err: # Server error (5XX), connection failure, bad response, ...
+            self.PipeLog.error('Bulk lookup failed, files are reported as not verified (failed).')
+            self.PipeLog.debug('Error arguments: {}'.format(repr(lookup_err)))
+            for hashsum, targets in hashes.items(): # Uploading them would hit failing server N times and take upload quota.
+                self.__deliver(targets, False, hashsum)
+            return
+
+        for hashsum, targets in hashes.items():
+            result = results.get(hashsum, False) # False - hash is unknown to Metadefender, file is uploaded.
+            if result is not False:
+                self.__deliver(targets, result, hashsum)
+                continue
+
+            upload = False
+            with self.__state_lock:
+                if hashsum in self.__uploaded: # Copy of already uploaded file.
+                    result = self.__uploaded[hashsum]
+                elif hashsum in self.__uploads: # Copy of file being uploaded.
+                    self.__uploads[hashsum].extend(targets)
+                    continue
+                else:
+                    self.__uploads[hashsum] = list(targets)
+                    upload = True
+
+            if upload is True:
+                self.PipeLog.info('{} is unknown to Metadefender, uploading...'.format(targets[0]))
+                self.__upload_queue.put(hashsum)
+            else:
+                self.__deliver(targets, result, hashsum)
+
+    def __upload_stage(self):
+        """ Upload thread: hash --> data_id. """
+
+        try:
+            while True:
+                hashsum = self.__upload_queue.get()
+                if hashsum is None:
+                    return
+
+                with self.__state_lock:
+                    target = self.__uploads[hashsum][0]
+                try:
+                    data_id = self.metadefender.scan_file(target, wait = False)
+                except ConnectionRefusedError as quota_err:
+                    self.PipeLog.error('Rate limit or quota exceeded, {} is not uploaded.'.format(target))
+                    self.PipeLog.debug('Error arguments: {}'.format(str(quota_err.args)))
+                    data_id = None
+                except Exception as upload_err: # Server error (5XX), unreadable file, bad response, ...
+                    self.PipeLog.error('Failed to upload {}.'.format(target))
+                    self.PipeLog.debug('Error arguments: {}'.format(repr(upload_err)))
+                    data_id = False
+
+                if data_id is None or data_id is False:
+                    self.__finish_upload(hashsum, data_id)
+                else:
+                    with self.__state_lock:
+                        self.__data_ids[data_id] = hashsum
+                    self.__poll_queue.put(data_id)
+        finally:
+            self.__poll_queue.put(None)
+
+    def __poll_stage(self):
+        """ Polling thread: data_id --> report. """
+
+        source = queue.Queue() # Polling is ended by single None, upload threads send one each.
+        def __forward():
+            """ Forward data_ids to poller, end when all upload threads are done. """
+
+            finished = 0
+            while finished < self.upload_workers:
+                data_id = self.__poll_queue.get()
+                if data_id is None:
+                    finished += 1
+                else:
+                    source.put(data_id)
+            source.put(None)
+
+        forwarder = threading.Thread(target = __forward, daemon = True)
+        forwarder.start()
+        try:
+            for data_id, report in self.metadefender.poll_reports(list(), source = source):
+                with self.__state_lock:
+                    hashsum = self.__data_ids.pop(data_id)
+                self.__finish_upload(hashsum, report)
+        except Exception as poll_err:
+            self.PipeLog.error('Polling failed, reports of uploaded files are not received.')
+            self.PipeLog.debug('Error arguments: {}'.format(repr(poll_err)))
+        forwarder.join()
+
+        with self.__state_lock: # Polling failed or data_id was not polled: every file must receive result.
+            pending = list(self.__data_ids.values())
+            self.__data_ids.clear()
+        for hashsum in pending:
+            self.__finish_upload(hashsum, False)
+
+    def __finish_upload(self, hashsum: str, result):
+        """ Deliver upload result to every file with the same content. """
+
+        with self.__state_lock:
+            targets = self.__uploads.pop(hashsum)
+            self.__uploaded[hashsum] = result
+        self.__deliver(targets, result, hashsum)
+
+    def __deliver(self, targets: list, result, hashsum: str):
+        """ Send result of every target to callback. """
+
+        with self.__callback_lock:
+            for target in targets:
+                try:
+                    if self.with_hash is True:
+                        self.callback(target, result, hashsum)
+                    else:
+                        self.callback(target, result)
+                except Exception as callback_err: # Pipeline threads must survive callback errors
+                    self.PipeLog.error('Failed to handle result for {}.'.format(target))
+                    self.PipeLog.debug('Error arguments: {}'.format(repr(callback_err)))
+
+
+
+class AsyncMetadefender():
+    """ asyncio front-end for Metadefender class.
+    Receive Metadefender object.
+
+    Available methods:
+        public: scan_ip, scan_domain, scan_url, scan_hash, scan_hash_bulk, scan_file, file_scan_report, scan_many, close
+        private: __call, __guard
+
+    Required packages (dependencies):
+        built-in: asyncio, concurrent.futures
+        3-d party: -
+
+    Every coroutine runs blocking Metadefender request in thread pool of 'concurrency' workers,
+    so up to 'concurrency' requests are in flight at once over Metadefender pooled session
+    (session pool size should not be less than 'concurrency').
+    File scan reports are polled with asyncio.sleep, so waiting for report does not hold worker.
+    Requests itself are blocking (requests library), event loop only schedules them and waits.
+
+    Coroutines might be awaited from any event loop; 'scan_many' runs a batch from synchronous code:
+
+        for target, result in AsyncMetadefender(metadef).scan_many('scan_url', urls):
+            ...
+    """
+
+    def __init__(self, metadefender: Metadefender, concurrency = 10, logging_level = 30):
+        """ Start thread pool.
+
+        'metadefender' - Metadefender object used for requests (file scan reports are polled
+            with it\'s 'poll_interval' and 'poll_timeout');
+        'concurrency' - max requests in flight;
+        'logging_level' - verbosity of logging:
+            0 - debug,
+            30 - warnings,
+            50 - critical.
+            See 'logging' docs;
+        """
+
+        self.AsyncLog = logging.getLogger('Metadefender Async')
+        self.AsyncLog.debug('Initializing class...')
+
+        if concurrency < 1:
+            self.AsyncLog.error('Concurrency must be positive, received: {}'.format(concurrency))
+            raise ValueError('Concurrency must be positive.', concurrency)
+
+        self.metadefender = metadefender
+        self.concurrency = concurrency
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers = concurrency, thread_name_prefix = 'Metadefender')
+
+        self.AsyncLog.debug('Class initialized.')
+
+
+    async def scan_ip(self, target: str) -> dict:
+        """ See Metadefender.scan_ip. """
+
+        return await self.__call(self.metadefender.scan_ip, target)
+
+    async def scan_domain(self, target: str) -> dict:
+        """ See Metadefender.scan_domain. """
+
+        return await self.__call(self.metadefender.scan_domain, target)
+
+    async def scan_url(self, target: str) -> dict:
+        """ See Metadefender.scan_url. """
+
+        return await self.__call(self.metadefender.scan_url, target)
+
+    async def scan_hash(self, target: str) -> dict:
+        """ See Metadefender.scan_hash. """
+
+        return await self.__call(self.metadefender.scan_hash, target)
+
+    async def scan_hash_bulk(self, targets: list) -> dict:
+        """ See Metadefender.scan_hash_bulk. """
+
+        return await self.__call(self.metadefender.scan_hash_bulk, targets)
+
+    async def file_scan_report(self, data_id: str) -> dict:
+        """ See Metadefender.file_scan_report. """
+
+        return await self.__call(self.metadefender.file_scan_report, data_id)
+
+    async def scan_file(self, target: str, timeout = None) -> dict:
+        """ Upload file and wait for scan report (see Metadefender.scan_file).
+
+        'timeout' - max time (in seconds) to wait for report, None - Metadefender 'poll_timeout'.
+
+        Report is polled on the same schedule as Metadefender.poll_reports (see Metadefender.poll_report),
+        waits between requests are asyncio.sleep, so waiting does not hold worker.
+
+        Return 2 dictionaries (see Metadefender.scan_file).
+        Return False if upload or report request failed or timeout exceeded.
+        """
+
+        data_id = await self.__call(self.metadefender.scan_file, target, False)
+        if data_id is False:
+            return False
+
+        report, state, delay = None, None, self.metadefender.poll_interval[0]
+        while report is None:
+            self.AsyncLog.debug('Awaiting results for {} ({:.1f} seconds)...'.format(target, delay))
+            await asyncio.sleep(delay)
+            report, state, delay = await self.__call(self.metadefender.poll_report, data_id, state, timeout)
+        return report
+
+    def scan_many(self, method: str, targets: list) -> tuple:
+        """ Run coroutine 'method' for every target concurrently in private event loop.
+
+        'method' - name of coroutine to be called ('scan_url', 'scan_file', ...);
+        'targets' - list of targets.
+
+        Yield tuples (target, result) as soon as results are ready (not in 'targets' order).
+        If call failed, result is exception raised by call.
+        Pending calls are cancelled if generator is closed.
+        Raise AttributeError if 'method' is unknown.
+        """
+
+        coroutine = getattr(self, method)
+        loop = asyncio.new_event_loop()
+        pending = set()
+        try:
+            tasks = dict()
+            for target in targets:
+                tasks[loop.create_task(self.__guard(coroutine, target))] = target
+            pending = set(tasks)
+            self.AsyncLog.debug('Running {} for {} targets.'.format(method, len(tasks)))
+
+            while len(pending) > 0:
+                done, pending = loop.run_until_complete(asyncio.wait(pending, return_when = asyncio.FIRST_COMPLETED))
+                for task in done:
+                    yield tasks[task], task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            if len(pending) > 0:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions = True))
+            loop.close()
+
+    def close(self):
+        """ Wait for running requests and stop thread pool. """
+
+        self.__executor.shutdown(wait = True)
+        self.AsyncLog.debug('Thread pool stopped.')
+
+
+    async def __call(self, function: 'function', *args):
+        """ Run blocking 'function' in thread pool. """
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.__executor, function, *args)
+
+    async def __guard(self, coroutine: 'coroutine function', target):
+        """ Return exception instead of raising it, so single failure does not stop 'scan_many'. """
+
+        try:
+            return await coroutine(target)
+        except (OSError, ValueError, LookupError) as call_err:
+            self.AsyncLog.error('Request for {} failed.'.format(target))
+            self.AsyncLog.debug('Error arguments: {}'.format(str(call_err.args)))
+            return call_err
@@ -0,0 +1,161 @@
+import atexit
+import datetime
+import json
+import logging
+import sys
+import threading
+
+
+class OutputWriter():
+    """ Buffered writer of scan results. Used by command line interface instead of print().
+
+    Available methods:
+        public: record, message, flush, close
+        private: __write
+
+    Required packages (dependencies):
+        built-in: atexit, datetime, json, logging, sys, threading
+        3-d party: -
+
+    Every verdict (file, IP, URL, domain) is written as single self-describing record
+    as soon as it is known. Output formats:
+        'text' - human readable text (default);
+        'ndjson' - one JSON object per line, suitable for SIEM ingestion and 'tail -f';
+        'json' - JSON array of records, streamed (array is closed by 'close').
+
+    Records are buffered and written when 'buffer_size' chars are collected or 'flush_interval' seconds
+    passed since first record of buffer, so large scans do not pay for unbuffered writes to pipe
+    (output to terminal is not buffered).
+    In 'json' and 'ndjson' formats messages (progress, warnings) are written to stderr,
+    so stdout contains records only (or written as 'message' records, see 'message_records').
+    """
+
+    FORMATS = ('text', 'json', 'ndjson')
+
+    def __init__(self, format_ = 'text', stream = None, buffer_size = 65536, flush_interval = 1, message_records = False, logging_level = 30):
+        """ Create writer.
+
+        'format_' - output format ('text', 'json' or 'ndjson');
+        'stream' - text stream records are written to, None - stdout;
+        'buffer_size' - max number of chars buffered before write;
+        'flush_interval' - max time (in seconds) record waits in buffer;
+        'message_records' - flag to write messages as {"type": "message"} records in 'json' and 'ndjson' formats
+            instead of stderr (used by service.py, where every job has it\'s own stream);
+        'logging_level' - verbosity of logging:
+            0 - debug,
+            30 - warnings,
+            50 - critical.
+            See 'logging' docs;
+
+        Raise ValueError if unknown format received.
+        """
+
+        logging.basicConfig(level = logging_level,
+                            filemode = 'a',
+                            format=f"%(asctime)s - [%(levelname)s] - %(name)s - (%(filename)s).%(funcName)s(%(lineno)d) - %(message)s",
+                            datefmt='%d.%m.%Y %H:%M:%S')
+
+        self.OutputLog = logging.getLogger('Output')
+
+        if format_ not in self.FORMATS:
+            self.OutputLog.error('Unknown output format: {}'.format(format_))
+            raise ValueError('Unknown output format!', format_)
+
+        self.format = format_
+        self.stream = stream if stream is not None else sys.stdout
+        try:
+            self.buffer_size = buffer_size if self.stream.isatty() is False else 0
+        except (AttributeError, ValueError): # Not a file-like stream, or it is closed.
+            self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.message_records = message_records
+        self.records = 0
+
+        self.__buffer = list()
+        self.__buffered = 0
+        self.__timer = None # Flushes buffer 'flush_interval' seconds after first record is buffered.
+        self.__closed = False
+        self.__lock = threading.RLock() # Records are written from pipeline threads too.
+
+        atexit.register(self.close) # JSON array must be closed even if scan is interrupted.
+
+
+    def record(self, record: dict, text = None):
+        """ Write record.
+
+        'record' - JSON-serializable dict, should have 'type' and 'target' keys
+            ('time' is added if missing);
+        'text' - text representation of record, used in 'text' format
+            (None - record is written as 'key: value' lines).
+        """
+
+        record.setdefault("time", datetime.datetime.now().isoformat())
+        if self.format == 'text':
+            if text is None:
+                text = '\n'.join('{}: {}'.format(key, value) for key, value in record.items())
+            line = text + '\n'
+        else:
+            line = json.dumps(record, default = str, ensure_ascii = False)
+
+        with self.__lock:
+            if self.format == 'json':
+                line = ('[\n' if self.records == 0 else ',\n') + line
+            elif self.format == 'ndjson':
+                line += '\n'
+            self.records += 1
+            self.__write(line)
+
+    def message(self, text: str):
+        """ Write human readable message (progress, warning).
+        It is written to output stream in 'text' format and to stderr otherwise
+        (or as 'message' record, if 'self.message_records' is True).
+        """
+
+        if self.format == 'text':
+            with self.__lock:
+                self.__write(text + '\n')
+        elif self.message_records is True:
+            self.record({"type": "message", "target": None, "text": text})
+        else:
+            print(text, file = sys.stderr, flush = True)
+
+    def flush(self):
+        """ Write buffered records. """
+
+        with self.__lock:
+            if self.__timer is not None:
+                self.__timer.cancel()
+                self.__timer = None
+            if len(self.__buffer) > 0:
+                self.stream.write(''.join(self.__buffer))
+                self.__buffer.clear()
+                self.__buffered = 0
+            self.stream.flush()
+
+    def close(self):
+        """ Write buffered records and close JSON array. Stream itself is not closed. """
+
+        with self.__lock:
+            if self.__closed is True:
+                return
+            self.__closed = True
+            atexit.unregister(self.close) # Writers of service jobs are closed long before exit.
+            if self.format == 'json':
+                self.__write('[]\n' if self.records == 0 else '\n]\n')
+            try:
+                self.flush()
+            except (OSError, ValueError) as write_err: # Stream closed (broken pipe, interpreter shutdown).
+                self.OutputLog.debug('Failed to flush output: {}'.format(str(write_err.args)))
+
+
+    def __write(self, text: str):
+        """ Buffer text, write buffer if it is full. Otherwise buffer is written by timer. """
+
+        self.__buffer.append(text)
+        self.__buffered += len(text)
+        if self.__buffered >= self.buffer_size:
+            self.flush()
+        elif self.__timer is None:
+            self.__timer = threading.Timer(self.flush_interval, self.flush)
+            self.__timer.daemon = True
+            self.__timer.start()
@@ -0,0 +1,121 @@
+import concurrent.futures
+import logging
+import time
+
+
+class CommandScheduler():
+    """ Runs independent command groups concurrently. Used by command line interface,
+    so combined invocation ('-U -I ... -u ... -F ...') takes as long as it\'s longest chain of commands,
+    not as all of them together.
+
+    Available methods:
+        public: add, run
+        private: __timed, __ready
+
+    Required packages (dependencies):
+        built-in: concurrent.futures, logging, time
+        3-d party: -
+
+    Every command is run in it\'s own thread as soon as all commands it depends on ('after') are done.
+    If command fails, commands depending on it are not run (others are), errors are kept in 'self.errors'.
+    Commands write results to shared output.OutputWriter, which writes every record at once,
+    so output streams of commands are merged record by record.
+    Commands share objects they are bound to (see envysec.ConsoleInterface), so such objects must be thread-safe;
+    commands, which are not, must be ordered by 'after'.
+    """
+
+    def __init__(self, logging_level = 30):
+        """ Create empty schedule.
+
+        'logging_level' - verbosity of logging:
+            0 - debug,
+            30 - warnings,
+            50 - critical.
+            See 'logging' docs;
+        """
+
+        logging.basicConfig(level = logging_level,
+                            filemode = 'a',
+                            format=f"%(asctime)s - [%(levelname)s] - %(name)s - (%(filename)s).%(funcName)s(%(lineno)d) - %(message)s",
+                            datefmt='%d.%m.%Y %H:%M:%S')
+
+        self.SchedulerLog = logging.getLogger('Scheduler')
+
+        self.results = dict() # Command name: returned value.
+        self.errors = dict() # Command name: raised exception.
+        self.skipped = list() # Commands not run, because command they depend on failed.
+        self.times = dict() # Command name: run time (in seconds).
+        self.__commands = dict() # Command name: (function, args, kwargs, names of commands it depends on).
+
+
+    def add(self, name: str, function, *args, after = (), **kwargs):
+        """ Add command to schedule.
+
+        'name' - unique command name;
+        'function' - callable to be run with 'args' and 'kwargs';
+        'after' - names of commands to be done before this one
+            (commands not added to schedule are ignored, so dependencies are declared unconditionally).
+
+        Raise ValueError if command with the same name is already added.
+        """
+
+        if name in self.__commands:
+            raise ValueError('Command is already scheduled!', name)
+
+        after = tuple(command for command in after if command in self.__commands) # Added before, so schedule has no cycles.
+        self.__commands[name] = (function, args, kwargs, after)
+        self.SchedulerLog.debug('{} scheduled after {}.'.format(name, after))
+
+    def run(self) -> bool:
+        """ Run all commands, wait for them to finish.
+
+        Return True if all commands are done without errors.
+        """
+
+        pending = dict(self.__commands)
+        running = dict() # Future: command name.
+        with concurrent.futures.ThreadPoolExecutor(max_workers = max(len(pending), 1), thread_name_prefix = 'Command') as executor:
+            while len(pending) > 0 or len(running) > 0:
+                for name in [name for name in pending if self.__ready(pending[name][3]) is not None]:
+                    function, args, kwargs, after = pending.pop(name)
+                    if self.__ready(after) is False:
+                        self.SchedulerLog.warning('{} is not run, because {} failed.'.format(name, [command for command in after if command not in self.results]))
+                        self.skipped.append(name)
+                        continue
+                    self.SchedulerLog.info('Starting {}.'.format(name))
+                    running[executor.submit(self.__timed, name, function, *args, **kwargs)] = name
+
+                done, _ = concurrent.futures.wait(running, return_when = concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                        self.SchedulerLog.info('{} done in {:.2f} seconds.'.format(name, self.times[name]))
+                    except Exception as command_err:
+                        self.SchedulerLog.error('{} failed: {}'.format(name, repr(command_err)))
+                        self.errors[name] = command_err
+
+        return len(self.errors) == 0 and len(self.skipped) == 0
+
+
+    def __timed(self, name: str, function, *args, **kwargs):
+        """ Run command, keep it\'s run time. """
+
+        start = time.monotonic()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.times[name] = time.monotonic() - start
+
+    def __ready(self, after: tuple) -> bool:
+        """ Check if commands 'after' are finished.
+
+        Return True if all of them are done, False if any of them failed (or skipped).
+        Return None if some of them are still pending or running.
+        """
+
+        if any(command in self.errors or command in self.skipped for command in after) is True:
+            return False
+        if all(command in self.results for command in after) is True:
+            return True
+        return None
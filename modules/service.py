@@ -0,0 +1,434 @@
+import collections
+import http.server
+import json
+import logging
+import os
+import queue
+import signal
+import socketserver
+import threading
+import time
+import urllib.parse
+import uuid
+
+from . import output
+
+
+class ScanJob():
+    """ Single job submitted to ScanService.
+    Used as output stream of job (see output.OutputWriter), so records are kept as soon as they are written.
+
+    Available methods:
+        public: write, flush, isatty, status, set_state, wait
+        private: -
+
+    Required packages (dependencies):
+        built-in: json, threading, time, uuid
+        3-d party: -
+
+    Job states: 'queued' -> 'running' -> 'done' or 'failed'.
+    """
+
+    def __init__(self, command: str, targets: list, options: dict):
+        """ Create queued job.
+
+        'command' - one of ScanService.COMMANDS;
+        'targets' - list of targets (paths, IP addresses, URLs, domains);
+        'options' - command options ('full', 'workers', 'cache').
+        """
+
+        self.id = uuid.uuid4().hex
+        self.command = command
+        self.targets = targets
+        self.options = options
+        self.state = 'queued'
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.records = list()
+
+        self.__partial = str()
+        self.__condition = threading.Condition()
+
+
+    def write(self, text: str) -> int:
+        """ Receive ndjson lines from output.OutputWriter, wake up waiting readers. """
+
+        with self.__condition:
+            *lines, self.__partial = (self.__partial + text).split('\n')
+            for line in lines:
+                if line.strip() != '':
+                    self.records.append(json.loads(line))
+            self.__condition.notify_all()
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self) -> bool:
+        return False
+
+    def status(self) -> dict:
+        """ Return job status (JSON-serializable dict). """
+
+        return {"id": self.id, "command": self.command, "targets": self.targets, "options": self.options,
+                "state": self.state, "error": self.error, "records": len(self.records),
+                "submitted": self.submitted, "started": self.started, "finished": self.finished}
+
+    def set_state(self, state: str, error = None):
+        """ Change job state, wake up waiting readers. """
+
+        with self.__condition:
+            self.state = state
+            self.error = error
+            if state == 'running':
+                self.started = time.time()
+            elif state in ('done', 'failed'):
+                self.finished = time.time()
+            self.__condition.notify_all()
+
+    def wait(self, index = None, timeout = None) -> bool:
+        """ Wait until job is finished or record number 'index' is written.
+
+        'index' - number of record to wait for, None - wait until job is finished;
+        'timeout' - max time (in seconds) to wait, None - no limit.
+
+        Return True if job is finished (or record is written), False on timeout.
+        """
+
+        def __ready():
+            return self.finished is not None or (index is not None and len(self.records) > index)
+
+        with self.__condition:
+            return self.__condition.wait_for(__ready, timeout = timeout)
+
+
+class ScanService():
+    """ Long-running envySec service. Keeps ClamAV, Metadefender client, caches and databases
+    of ConsoleInterface warm and runs submitted jobs through them.
+
+    Available methods:
+        public: submit, job, jobs, start, serve_forever, shutdown
+        private: __worker, __run, __evict
+
+    Required packages (dependencies):
+        built-in: collections, http.server, json, logging, os, queue, signal, socketserver, threading, time, urllib.parse, uuid
+        3-d party: -
+
+    API is served over localhost HTTP and Unix socket (the same endpoints):
+        GET  /health - service status;
+        POST /jobs - submit job, body: {"command": "scan_file", "targets": ["/srv"], "options": {"full": false}},
+            reply 202 with job status;
+        GET  /jobs - statuses of kept jobs;
+        GET  /jobs/<id> - job status;
+        GET  /jobs/<id>/result - job status and records ('?wait=1' - reply when job is finished);
+        GET  /jobs/<id>/events - records as Server-Sent Events, as soon as they are written,
+            'state' event is sent when job is finished.
+    Records are the same --output ndjson ones (see output.py), messages are 'message' records.
+
+    Jobs are run one by one in submission order: they share one scanner, one Metadefender rate limiter
+    and one report cache, so parallel jobs would compete for the same quota anyway.
+
+    No authentication is performed: HTTP is bound to loopback address and Unix socket is
+    accessible by owner only, do not expose service to network.
+    """
+
+    COMMANDS = ('scan_file', 'scan_ip', 'scan_url', 'scan_domain', 'update',
+                'add_exception', 'remove_exception', 'get_exceptions')
+
+    def __init__(self, interface, address = '127.0.0.1', port = 8765, socket_path = None, max_jobs = 1000, logging_level = 30):
+        """ Create service (servers are started by 'start').
+
+        'interface' - envysec.ConsoleInterface, jobs are run by it\'s methods;
+        'address' - HTTP address, None - HTTP is not served;
+        'port' - HTTP port;
+        'socket_path' - path to Unix socket, None - Unix socket is not served;
+        'max_jobs' - max number of kept jobs, oldest finished ones are dropped;
+        'logging_level' - verbosity of logging:
+            0 - debug,
+            30 - warnings,
+            50 - critical.
+            See 'logging' docs;
+
+        Raise ValueError if neither HTTP address nor Unix socket specified.
+        """
+
+        logging.basicConfig(level = logging_level,
+                            filemode = 'a',
+                            format=f"%(asctime)s - [%(levelname)s] - %(name)s - (%(filename)s).%(funcName)s(%(lineno)d) - %(message)s",
+                            datefmt='%d.%m.%Y %H:%M:%S')
+
+        self.ServiceLog = logging.getLogger('Service')
+        self.ServiceLog.debug('Initializing class...')
+
+        if address is None and socket_path is None:
+            self.ServiceLog.error('Neither HTTP address nor Unix socket specified.')
+            raise ValueError('Nothing to serve on!')
+
+        self.interface = interface
+        self.address = address
+        self.port = port
+        self.socket_path = socket_path
+        self.max_jobs = max_jobs
+        self.servers = list()
+
+        self.__jobs = collections.OrderedDict() # Job id: ScanJob, in submission order.
+        self.__jobs_lock = threading.Lock()
+        self.__queue = queue.Queue()
+        self.__stopped = threading.Event()
+        self.__threads = list()
+
+        self.ServiceLog.debug('Class initialized.')
+
+
+    def submit(self, command: str, targets = None, options = None) -> ScanJob:
+        """ Queue job.
+
+        'command' - one of 'COMMANDS';
+        'targets' - list of targets, not used by 'update' and 'get_exceptions';
+        'options' - dict of command options:
+            'full' - scan all files (scan_file),
+            'workers' - number of scanner workers (scan_file),
+            'cache' - Metadefender cache mode: 'use', 'refresh', 'bypass'.
+
+        Return queued job.
+        Raise ValueError if command is unknown or targets are required, but not specified.
+        """
+
+        targets = list(targets) if targets is not None else list()
+        options = dict(options) if options is not None else dict()
+        if command not in self.COMMANDS:
+            raise ValueError('Unknown command!', command)
+        if len(targets) == 0 and command not in ('update', 'get_exceptions'):
+            raise ValueError('No targets specified!', command)
+        if any(isinstance(target, str) is False for target in targets):
+            raise ValueError('Targets must be strings!', targets)
+        if options.get("cache", 'use') not in ('use', 'refresh', 'bypass'):
+            raise ValueError('Unknown cache mode!', options["cache"])
+
+        job = ScanJob(command, targets, options)
+        with self.__jobs_lock:
+            self.__jobs[job.id] = job
+            self.__evict()
+        self.__queue.put(job)
+        self.ServiceLog.info('Job {} queued: {} {}'.format(job.id, command, targets))
+        return job
+
+    def job(self, id_: str) -> ScanJob:
+        """ Return job by id, None if there is no such job. """
+
+        with self.__jobs_lock:
+            return self.__jobs.get(id_)
+
+    def jobs(self) -> list:
+        """ Return list of kept jobs, in submission order. """
+
+        with self.__jobs_lock:
+            return list(self.__jobs.values())
+
+    def start(self):
+        """ Start job worker and servers in background threads.
+
+        Raise OSError if address is in use (or socket might not be created).
+        """
+
+        if self.address is not None:
+            server = http.server.ThreadingHTTPServer((self.address, self.port), _ServiceHandler)
+            self.servers.append(server)
+            self.ServiceLog.info('Serving HTTP on {}:{}'.format(*server.server_address[:2]))
+
+        if self.socket_path is not None:
+            if os.path.exists(self.socket_path) is True: # Left by killed service.
+                os.remove(self.socket_path)
+            umask = os.umask(0o177) # Socket is created accessible by owner only.
+            try:
+                server = _UnixHTTPServer(self.socket_path, _ServiceHandler)
+            finally:
+                os.umask(umask)
+            self.servers.append(server)
+            self.ServiceLog.info('Serving on Unix socket {}'.format(self.socket_path))
+
+        for server in self.servers:
+            server.service = self
+            server.daemon_threads = True
+            self.__threads.append(threading.Thread(target = server.serve_forever, name = 'ServiceServer', daemon = True))
+        self.__threads.append(threading.Thread(target = self.__worker, name = 'ServiceWorker', daemon = True))
+        for thread in self.__threads:
+            thread.start()
+
+    def serve_forever(self):
+        """ Start service (see 'start') and block until 'shutdown' is called, KeyboardInterrupt or SIGTERM received. """
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.__stopped.set())
+        self.start()
+        try:
+            while self.__stopped.wait(timeout = 1) is False:
+                pass
+        except KeyboardInterrupt:
+            self.ServiceLog.info('Interrupted.')
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """ Stop servers, wait for running job to finish. Queued jobs are not run. """
+
+        self.__stopped.set()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        if self.socket_path is not None and os.path.exists(self.socket_path) is True:
+            os.remove(self.socket_path)
+        self.servers.clear()
+
+        self.__queue.put(None)
+        for thread in self.__threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self.__threads.clear()
+        self.ServiceLog.info('Service stopped.')
+
+
+    def __worker(self):
+        """ Run queued jobs one by one. """
+
+        while True:
+            job = self.__queue.get()
+            if job is None or self.__stopped.is_set() is True:
+                break
+            self.__run(job)
+
+    def __run(self, job: ScanJob):
+        """ Run job by ConsoleInterface methods, records are written to job. """
+
+        self.ServiceLog.info('Job {} started.'.format(job.id))
+        job.set_state('running')
+
+        writer = output.OutputWriter('ndjson', stream = job, buffer_size = 0, message_records = True)
+        cli_output, cache_mode = self.interface.output, self.interface.metadef.cache_mode
+        self.interface.output = writer
+        self.interface.metadef.cache_mode = job.options.get("cache", 'use')
+        try:
+            if job.command == 'scan_file':
+                self.interface.file_scanner(job.targets, workers = job.options.get("workers"), full = job.options.get("full", False) is True)
+            elif job.command == 'scan_ip':
+                self.interface.ip_scanner(job.targets, geo = True)
+            elif job.command == 'scan_url':
+                self.interface.url_scanner(job.targets)
+            elif job.command == 'scan_domain':
+                self.interface.domain_scanner(job.targets)
+            elif job.command == 'update':
+                self.interface.update(verbose = job.options.get("verbose", False) is True)
+            elif job.command == 'add_exception':
+                self.interface.add_exception(job.targets)
+            elif job.command == 'remove_exception':
+                self.interface.remove_exception(job.targets)
+            elif job.command == 'get_exceptions':
+                self.interface.get_exclude(get_date = True)
+        except Exception as job_err: # Service must survive any job.
+            self.ServiceLog.warning('Job {} failed: {}'.format(job.id, repr(job_err)))
+            writer.close()
+            job.set_state('failed', error = repr(job_err))
+        else:
+            writer.close()
+            job.set_state('done')
+            self.ServiceLog.info('Job {} done.'.format(job.id))
+        finally:
+            self.interface.output, self.interface.metadef.cache_mode = cli_output, cache_mode
+
+    def __evict(self):
+        """ Drop oldest finished jobs while more than 'self.max_jobs' jobs are kept. Called under jobs lock. """
+
+        for id_ in [id_ for id_, job in self.__jobs.items() if job.finished is not None]:
+            if len(self.__jobs) <= self.max_jobs:
+                break
+            del self.__jobs[id_]
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ HTTP server on Unix socket. """
+
+    daemon_threads = True
+
+
+class _ServiceHandler(http.server.BaseHTTPRequestHandler):
+    """ ScanService API requests handler (serves both HTTP and Unix socket), see ScanService docs. """
+
+    protocol_version = 'HTTP/1.0' # Connection is closed after reply, so events are streamed until job is finished.
+    server_version = 'envySec'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        parts = [part for part in url.path.split('/') if part != '']
+        service = self.server.service
+
+        if parts == ['health']:
+            jobs = service.jobs()
+            return self.__reply(200, {"status": 'ok', "jobs": len(jobs),
+                                      "queued": sum(1 for job in jobs if job.state == 'queued')})
+        if parts == ['jobs']:
+            return self.__reply(200, [job.status() for job in service.jobs()])
+        if len(parts) in (2, 3) and parts[0] == 'jobs':
+            job = service.job(parts[1])
+            if job is None:
+                return self.__reply(404, {"error": 'No such job.'})
+            if len(parts) == 2:
+                return self.__reply(200, job.status())
+            if parts[2] == 'result':
+                if query.get('wait', ['0'])[0] not in ('0', 'false'):
+                    job.wait()
+                return self.__reply(200, dict(job.status(), results = list(job.records)))
+            if parts[2] == 'events':
+                return self.__events(job)
+        return self.__reply(404, {"error": 'Not found.'})
+
+    def do_POST(self):
+        parts = [part for part in urllib.parse.urlsplit(self.path).path.split('/') if part != '']
+        if parts != ['jobs']:
+            return self.__reply(404, {"error": 'Not found.'})
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            job = self.server.service.submit(body.get("command"), body.get("targets"), body.get("options"))
+        except (ValueError, TypeError, AttributeError) as request_err: # Bad JSON or bad job.
+            return self.__reply(400, {"error": str(request_err.args)})
+        return self.__reply(202, job.status())
+
+    def log_message(self, format_, *args):
+        self.server.service.ServiceLog.debug('{} {}'.format(self.client_address or 'unix', format_ % args))
+
+
+    def __reply(self, code: int, body):
+        data = json.dumps(body, default = str, ensure_ascii = False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def __events(self, job: ScanJob):
+        """ Stream job records as Server-Sent Events until job is finished (or client disconnects). """
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        index = 0
+        try:
+            while True:
+                job.wait(index = index, timeout = 15)
+                records = job.records[index:]
+                for record in records:
+                    self.wfile.write('event: record\ndata: {}\n\n'.format(json.dumps(record, default = str, ensure_ascii = False)).encode('utf-8'))
+                index += len(records)
+                if job.finished is not None and index == len(job.records):
+                    self.wfile.write('event: state\ndata: {}\n\n'.format(json.dumps(job.status(), default = str)).encode('utf-8'))
+                    break
+                if len(records) == 0:
+                    self.wfile.write(b': keep-alive\n\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.service.ServiceLog.debug('Events client of job {} disconnected.'.format(job.id))
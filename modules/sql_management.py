@@ -1,23 +1,91 @@
 import datetime
+import hashlib
 import logging
 import os
 import pathlib
+import queue
 import sqlite3
-import shlex
+import threading
+import time
+
+from . import exclusions
 
 
 class DBManager():
     """ Used to control databases.
 
     Available methods:
-        public: execute_db
-        private: __connect_db, __close_db, __create_db
+        public: execute_db, query_db, stream_db, execute_many_db, modify_db, modify_many_db, close
+        private: __connect_db, __close_db, __migrate
 
     Dependencies:
-        built-in: logging, os, pathlib, sqlite3, shlex
+        built-in: logging, os, pathlib, sqlite3, threading
         3-d party: -
+
+    Every DBManager keeps single connection to database, opened on first use and kept until 'close'.
+    Database is used in WAL mode, so readers are not blocked by writer (other DBManager or process),
+    statements of the same DBManager are serialized, so it might be shared between threads.
+    Large results should be read with 'stream_db' and large writes done with 'execute_many_db' or 'modify_many_db'
+    (single transaction), so neither rows nor commits scale with table size.
+
+    Schema of every table is versioned ('PRAGMA user_version'),
+    older databases are upgraded in place by migrations (see 'MIGRATIONS').
+    Every database has it\'s own schema: 'MIGRATIONS' of DBManager are schema of './modules/exclude.db'
+    (shared by ExcludeDB, StatisticDB, FileStateDB and QuotaDB), CacheDB overrides them for './modules/cache.db'.
     """
 
+    # Schema migrations of './modules/exclude.db', migration N upgrades database from version N to N + 1.
+    MIGRATIONS = [
+        # 1: typed tables, unique exclusion paths.
+        ["""CREATE TABLE IF NOT EXISTS Exclusion (Path, Date);""",
+         """CREATE TABLE IF NOT EXISTS Statistic (Found, Date, TotalReports);""",
+         """CREATE TABLE ExclusionTyped (
+                Id INTEGER PRIMARY KEY,
+                Path TEXT NOT NULL,
+                Date TEXT NOT NULL);""",
+         """INSERT INTO ExclusionTyped (Path, Date) SELECT CAST(Path AS TEXT), MIN(CAST(Date AS TEXT))
+                FROM Exclusion WHERE Path IS NOT NULL GROUP BY CAST(Path AS TEXT);""",
+         """DROP TABLE Exclusion;""",
+         """ALTER TABLE ExclusionTyped RENAME TO Exclusion;""",
+         """CREATE UNIQUE INDEX ExclusionPath ON Exclusion (Path);""",
+         """CREATE TABLE StatisticTyped (
+                Id INTEGER PRIMARY KEY,
+                Found TEXT NOT NULL,
+                Date TEXT NOT NULL,
+                TotalReports INTEGER NOT NULL DEFAULT 0);""",
+         """INSERT INTO StatisticTyped (Found, Date, TotalReports) SELECT CAST(Found AS TEXT), CAST(Date AS TEXT), CAST(COALESCE(TotalReports, 0) AS INTEGER)
+                FROM Statistic WHERE Found IS NOT NULL AND Date IS NOT NULL;""",
+         """DROP TABLE Statistic;""",
+         """ALTER TABLE StatisticTyped RENAME TO Statistic;"""],
+        # 2: file state index (see FileStateDB) and quota accounting (see QuotaDB).
+        # Earlier versions created them on first use, so they might exist already.
+        ["""CREATE TABLE IF NOT EXISTS FileState (
+                Device INTEGER NOT NULL,
+                Inode INTEGER NOT NULL,
+                Size INTEGER NOT NULL,
+                MtimeNs INTEGER NOT NULL,
+                CtimeNs INTEGER NOT NULL,
+                Hash TEXT,
+                SignatureVersion INTEGER NOT NULL,
+                Date TEXT NOT NULL,
+                PRIMARY KEY (Device, Inode));""",
+         """CREATE TABLE IF NOT EXISTS Quota (
+                Key TEXT NOT NULL,
+                Day TEXT NOT NULL,
+                Category TEXT NOT NULL,
+                Used INTEGER NOT NULL,
+                QuotaLimit INTEGER,
+                Date TEXT NOT NULL,
+                PRIMARY KEY (Key, Day, Category));"""],
+        # 3: detection details and indexes for history lookups (see StatisticDB).
+        ["""ALTER TABLE Statistic ADD COLUMN Signature TEXT;""",
+         """ALTER TABLE Statistic ADD COLUMN Hash TEXT;""",
+         """ALTER TABLE Statistic ADD COLUMN Verified TEXT;""",
+         """CREATE INDEX StatisticHash ON Statistic (Hash, Date);""",
+         """CREATE INDEX StatisticFound ON Statistic (Found, Date);""",
+         """CREATE INDEX StatisticDate ON Statistic (Date);"""],
+    ]
+
     def __init__(self, logging_level = 30, database = './modules/exclude.db'):
         """ Manage SQL database.
 
@@ -27,6 +95,8 @@ class DBManager():
             30 - warnings,
             50 - critical.
             See 'logging' docs;
+
+        Raise FileNotFoundError if database might not be opened (or created).
         """
 
         logging.basicConfig(level = logging_level,
@@ -39,243 +109,800 @@ class DBManager():
 
         self.DBManager.debug('Checking database existence...')
         self.database = pathlib.Path('.').resolve().joinpath(database)
+        self.exclude_connect = None
+        self.fetch_size = 1000 # Rows fetched at once by 'stream_db'
+        self.__lock = threading.RLock()
         if self.database.exists() is True:
             self.DBManager.info('Database found.')
-        elif self.__create_db() is False:
-            self.DBManager.critical('Database path {} not found!'.format(self.database))
-            raise FileNotFoundError('Database path {} not found!'.format(self.database))
         else:
-            self.DBManager.error('Database path {} not found!'.format(self.database))
-            self.DBManager.info('{} database created.'.format(self.database))
+            self.DBManager.info('Database {} not found, creating...'.format(self.database))
+
+        if self.__connect_db() is False or self.__migrate() is False:
+            self.DBManager.critical('Database {} might not be opened!'.format(self.database))
+            raise FileNotFoundError('Database {} might not be opened!'.format(self.database))
 
         self.DBManager.debug('Class initialized.')
 
 
-    def __connect_db(self) -> bool:
-        """ Connect to secEnvyronment database.
-        To close connection use '__close_db';
+    def close(self):
+        """ Close connection to database. It is reopened on next statement. """
 
-        Default database filename is 'exclude.db' (./modules/exclude.db).
-        Default exclude.db have table 'Exclusion', 'Statistic'.
+        with self.__lock:
+            if self.exclude_connect is not None:
+                self.DBManager.debug('Closing database...')
+                self.exclude_connect.close()
+                self.exclude_connect = None
 
-        Note: this method cant be used to initialize database.
-        """
 
-        self.DBManager.info('Connecting to Exclude database...')
-        self.DBManager.debug('Trying {} ...'.format(str(self.database)))
+    def __connect_db(self) -> bool:
+        """ Connect to secEnvyronment database, if not connected yet.
+        Connection is kept open and reused by following statements (see 'close').
 
-        if self.database.exists() is True:
-            try:
-                self.exclude_connect = sqlite3.connect(str(self.database))
-                self.dbcursor = self.exclude_connect.cursor()
+        Database is switched to WAL mode: readers are not blocked by writer
+        and commits do not wait for whole database to be synced.
+        """
 
-            except sqlite3.NotSupportedError as sql_bad_db_err:
-                self.DBManager.warning('Wrong database type detected!')
-                self.DBManager.debug('Database error log: {}'.format(str(sql_bad_db_err.args)))
-                return False
-            except sqlite3.DataError as sql_data_err:
-                self.DBManager.warning('Database error occurred!')
-                self.DBManager.debug('Database error log: {}'.format(str(sql_data_err.args)))
-                return False
-            except sqlite3.IntegrityError as sql_broken_db_err:
-                self.DBManager.warning('Database integrity compromised.')
-                self.DBManager.debug('Database error log: {}'.format(str(sql_broken_db_err.args)))
-                return False
-            except sqlite3.OperationalError as sql_operation_err:
-                self.DBManager.warning('Database integrity compromised.')
-                self.DBManager.debug('Database error log: {}'.format(str(sql_operation_err.args)))
-                return False
-            except PermissionError as permissions_denied:
-                self.DBManager.warning('Permissions denied.')
-                self.DBManager.debug('Database error log: {}'.format(str(permissions_denied.args)))
-                return False
-        else:
+        if self.exclude_connect is not None:
+            return True
 
-            self.__create_db()
+        self.DBManager.info('Connecting to database...')
+        self.DBManager.debug('Trying {} ...'.format(str(self.database)))
 
-            self.DBManager.warning('Database does not exist or permissions denied.')
-            self.DBManager.debug('Can\'t connect to {}'.format(str(self.database)))
+        try:
+            self.exclude_connect = sqlite3.connect(str(self.database), timeout = 30, check_same_thread = False) # Statements are serialized by lock
+            self.exclude_connect.execute("PRAGMA journal_mode = WAL;") # SQL
+            self.exclude_connect.execute("PRAGMA synchronous = NORMAL;") # SQL, safe in WAL mode
+        except sqlite3.DatabaseError as sql_err: # Wrong database type, integrity compromised, locked...
+            self.DBManager.warning('Failed to open database.')
+            self.DBManager.debug('Database error log: {}'.format(str(sql_err.args)))
+            self.exclude_connect = None
+            return False
+        except PermissionError as permissions_denied:
+            self.DBManager.warning('Permissions denied.')
+            self.DBManager.debug('Database error log: {}'.format(str(permissions_denied.args)))
+            self.exclude_connect = None
             return False
 
         self.DBManager.debug('Connected.')
         return True
 
-    def __close_db(self) -> bool:
-        """ Close connection to secEnvyronment database.
-        To open connection use __connect_db;
+    def __close_db(self, rollback = False) -> bool:
+        """ End statement: commit (or roll back) it\'s transaction. Connection is kept open.
 
-        Default database filename is 'exclude.db' (./modules/exclude.db).
-        Default exclude.db have table 'Exclusion', 'Statistic'.
+        'rollback' - flag to roll transaction back.
         """
 
-        self.DBManager.info('Closing Database connection...')
-
         try:
+            if rollback is True:
+                self.DBManager.debug('Rolling back...')
+                self.exclude_connect.rollback()
+                return False
             self.DBManager.debug('Commiting...')
             self.exclude_connect.commit()
-            self.DBManager.debug('Closing database...')
-            self.dbcursor.close()
-        except sqlite3.ProgrammingError as sql_programming_err:
-            self.DBManager.warning('Programming error occurred!')
-            self.DBManager.debug('Database error log: {}'.format(str(sql_programming_err.args)))
-            return False
-        except sqlite3.OperationalError as sql_bad_operation_err:
-            self.DBManager.warning('Operational error occurred!')
-            self.DBManager.debug('Database error log: {}'.format(str(sql_bad_operation_err.args)))
+        except (sqlite3.ProgrammingError, sqlite3.OperationalError) as sql_err:
+            self.DBManager.warning('Failed to commit!')
+            self.DBManager.debug('Database error log: {}'.format(str(sql_err.args)))
             return False
 
-        self.DBManager.debug('Complete.')
         return True
 
+    def __migrate(self) -> bool:
+        """ Upgrade database schema to the last version (see 'MIGRATIONS').
+        Every migration is applied in it\'s own transaction, 'PRAGMA user_version' is the current version.
+
+        Return True if database is up to date.
+        """
 
-    def __create_db(self, structure = {'Exclusion': ['Path', 'Date'], 'Statistic': ['Found', 'Date', 'TotalReports']}) -> bool:
-        """ Create database.
+        with self.__lock:
+            try:
+                while True:
+                    self.exclude_connect.execute("BEGIN IMMEDIATE;") # SQL, other connections wait until migration is done
+                    version = self.exclude_connect.execute("PRAGMA user_version;").fetchone()[0] # SQL
+                    if version >= len(self.MIGRATIONS):
+                        self.exclude_connect.rollback()
+                        return True
+
+                    self.DBManager.info('Upgrading database schema to version {}...'.format(version + 1))
+                    for command in self.MIGRATIONS[version]:
+                        self.exclude_connect.execute(command) # SQL
+                    self.exclude_connect.execute("PRAGMA user_version = {};".format(version + 1)) # SQL
+                    self.exclude_connect.commit()
+            except sqlite3.DatabaseError as sql_err:
+                self.DBManager.error('Database schema upgrade failed.')
+                self.DBManager.debug('Database error log: {}'.format(str(sql_err.args)))
+                self.exclude_connect.rollback()
+                return False
 
-        Used to create sqlite database.
+    def execute_db(self, command: str, values: tuple = None) -> bool:
+        """ Execute SQL command.
 
-        Create database in 'self.database' path.
-        The database structure is defined in 'structure'.
-        Default structure is consist of 2 tables:
+        Default database structure is consist of 2 tables:
         'Exclusion', used to control user exclude list,
         'Statistic', used to store scan statistic.
 
         Table 'Exclusion' have 2 columns:
-        'Path' - is a path to file or dir to be excluded from scan,
+        'Path' - is a path to file or dir to be excluded from scan (unique),
         'Date' - is a date exclusion were added.
 
-        Table 'Statistic' have 3 columns:
+        Table 'Statistic' have 6 columns (see StatisticDB):
         'Found' - is a path to file or dir to infected file,
         'Date' - is a date infected file were found,
-        'TotalReports' - is a number of infected file reports.
+        'TotalReports' - is a number of infected file reports (Metadefender detections),
+        'Signature' - is a ClamAV signature,
+        'Hash' - is a SHA-256 of infected file,
+        'Verified' - is a date Metadefender verdict were received.
 
-        If database is already exists, return False.
-        If database created but may not be connected, return False.
-        If database created and available to connection, return True.
+        Return flattened list of received rows.
+        Return empty list if database error occurred.
         """
 
-        self.DBManager.debug('Initialize __create_db...')
+        self.DBManager.info('Executing...')
+        if values is not None and type(values) != tuple:
+            self.DBManager.critical('Cant execute command!')
+            self.DBManager.error('Bad SQL values received: {}, turple should be received!'.format(values))
+            raise TypeError('Bad SQL command arguments type!')
+
+        with self.__lock:
+            if self.__connect_db() is False:
+                return []
 
-        def __create_command(structure: dict) -> str:
-            """ Create SQL command to create structure.
+            output = []
+            try:
+                self.DBManager.debug('Executing {} with arguments {}'.format(command, values))
+                for out in self.exclude_connect.execute(command, values if values is not None else ()): # SQL
+                    output += out
+                self.DBManager.debug('Executed;')
+            except (sqlite3.ProgrammingError, sqlite3.OperationalError, sqlite3.IntegrityError) as sql_err:
+                self.DBManager.warning('Failed execute SQL command.')
+                self.DBManager.debug('Database error log: {}'.format(str(sql_err.args)))
+                self.__close_db(rollback = True)
+                return []
+
+            self.DBManager.debug('Database management complete.')
+            return output if self.__close_db() is True else []
+
+    def query_db(self, command: str, values: tuple = ()) -> list:
+        """ Execute SQL query and return rows.
+        Unlike 'execute_db', rows are not flattened.
 
-            Structure is a dict, where:
-            Keys are table names to be created,
-            Values are columns to be created.
+        'command' - SQL query;
+        'values' - tuple of query parameters.
 
-            Return command string to be sent to SQL exec.
-            """
+        Return list of rows (tuples).
+        Return empty list if database error occurred.
+        """
 
-            self.DBManager.debug('Creating command, received structure: {}'.format(structure))
-            for table in structure:
-                command = 'CREATE TABLE IF NOT EXISTS'
-                command += ' {} ('.format(shlex.quote(table))
-                for column in structure[table]:
-                    command += '{} VARCHAR (255) NOT NULL, '.format(shlex.quote(column))
-                command += 'PRIMARY KEY ({})); '.format(structure[table][0])
-                self.DBManager.debug('Created command: {}'.format(shlex.quote(command)))
-                yield command
+        self.DBManager.debug('Querying {} with arguments {}'.format(command, values))
+        with self.__lock:
+            if self.__connect_db() is False:
+                return []
 
-        self.DBManager.debug('Checking database existence.')
-        if os.path.exists(self.database) is False:
-            self.DBManager.info('Database is not found!')
-            self.DBManager.debug('Trying to create database:')
-            self.DBManager.debug('Connecting...')
             try:
-                db_connection = sqlite3.connect(self.database)
-            except FileExistsError:
-                self.DBManager.warning('Filename {} already taken.'.format(self.database))
-                return False
-            except PermissionError:
-                self.DBManager.warning('Can\'t create database, permissions denied.')
+                rows = self.exclude_connect.execute(command, values).fetchall() # SQL
+            except (sqlite3.ProgrammingError, sqlite3.OperationalError) as sql_err:
+                self.DBManager.warning('Failed execute SQL command.')
+                self.DBManager.debug('Database error log: {}'.format(str(sql_err.args)))
+                rows = []
+            finally:
+                self.__close_db()
+
+        self.DBManager.debug('Received {} rows.'.format(len(rows)))
+        return rows
+
+    def stream_db(self, command: str, values: tuple = (), fetch_size = None) -> tuple:
+        """ Execute SQL query and yield rows as they are fetched.
+        Query is run on separate read-only connection, so other statements are not blocked
+        while rows are consumed, and rows are read from consistent snapshot (WAL).
+
+        'command' - SQL query;
+        'values' - tuple of query parameters;
+        'fetch_size' - number of rows fetched at once, None - 'self.fetch_size'.
+
+        Yield rows (tuples). Nothing is yielded after database error.
+        """
+
+        fetch_size = fetch_size if fetch_size is not None else self.fetch_size
+        self.DBManager.debug('Streaming {} with arguments {}'.format(command, values))
+        try:
+            connection = sqlite3.connect('{}?mode=ro'.format(self.database.as_uri()), uri = True, timeout = 30)
+        except sqlite3.DatabaseError as sql_err:
+            self.DBManager.warning('Failed to open database.')
+            self.DBManager.debug('Database error log: {}'.format(str(sql_err.args)))
+            return
+
+        try:
+            cursor = connection.execute(command, values) # SQL
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if len(rows) == 0:
+                    break
+                yield from rows
+        except (sqlite3.ProgrammingError, sqlite3.OperationalError) as sql_err:
+            self.DBManager.warning('Failed execute SQL command.')
+            self.DBManager.debug('Database error log: {}'.format(str(sql_err.args)))
+        finally:
+            connection.close()
+
+    def execute_many_db(self, command: str, values: 'iterable') -> bool:
+        """ Execute SQL command for every tuple in 'values' in single transaction.
+
+        'command' - SQL command;
+        'values' - iterable of tuples with command parameters.
+
+        Return True if command executed and committed.
+        Return False if database error occurred (nothing is committed).
+        """
+
+        self.DBManager.debug('Executing {} for many values.'.format(command))
+        with self.__lock:
+            if self.__connect_db() is False:
                 return False
 
-            self.DBManager.debug('Init cursor...')
-            db_cursor = db_connection.cursor()
-            self.DBManager.debug('Creating table...')
             try:
-                for command in __create_command(structure):
-                    db_cursor.execute(command) # SQL, insecure
-                    db_connection.commit()
-                    db_connection.close()
-            except sqlite3.ProgrammingError: #?
-                self.DBManager.warning('Programming error, trying to continue...')
-            else:
-                self.DBManager.debug('Done without errors.')
-        else:
-            self.DBManager.info('Database is already exists.')
+                self.exclude_connect.executemany(command, values) # SQL
+            except (sqlite3.ProgrammingError, sqlite3.OperationalError, sqlite3.IntegrityError) as sql_err:
+                self.DBManager.warning('Failed execute SQL command.')
+                self.DBManager.debug('Database error log: {}'.format(str(sql_err.args)))
+                return self.__close_db(rollback = True)
+
+            return self.__close_db()
+
+    def modify_db(self, command: str, values: tuple = ()) -> int:
+        """ Execute data-modifying SQL command (INSERT, UPDATE, DELETE).
+
+        'command' - SQL command;
+        'values' - tuple of command parameters.
+
+        Return number of modified rows.
+        Return -1 if database error occurred (nothing is committed).
+        """
+
+        self.DBManager.debug('Executing {} with arguments {}'.format(command, values))
+        with self.__lock:
+            if self.__connect_db() is False:
+                return -1
+
+            try:
+                rowcount = self.exclude_connect.execute(command, values).rowcount # SQL
+            except (sqlite3.ProgrammingError, sqlite3.OperationalError, sqlite3.IntegrityError) as sql_err:
+                self.DBManager.warning('Failed execute SQL command.')
+                self.DBManager.debug('Database error log: {}'.format(str(sql_err.args)))
+                self.__close_db(rollback = True)
+                return -1
+
+            if self.__close_db() is False:
+                return -1
+            return rowcount
+
+    def modify_many_db(self, command: str, values: 'iterable') -> int:
+        """ Execute data-modifying SQL command for every tuple in 'values' in single transaction.
+        'values' might be generator, it is consumed while command is executed.
+
+        'command' - SQL command (INSERT, UPDATE, DELETE);
+        'values' - iterable of tuples with command parameters.
+
+        Return total number of modified rows.
+        Return -1 if database error occurred (nothing is committed).
+        """
+
+        self.DBManager.debug('Executing {} for many values.'.format(command))
+        with self.__lock:
+            if self.__connect_db() is False:
+                return -1
+
+            try:
+                rowcount = self.exclude_connect.executemany(command, values).rowcount # SQL
+            except (sqlite3.ProgrammingError, sqlite3.OperationalError, sqlite3.IntegrityError) as sql_err:
+                self.DBManager.warning('Failed execute SQL command.')
+                self.DBManager.debug('Database error log: {}'.format(str(sql_err.args)))
+                self.__close_db(rollback = True)
+                return -1
+
+            if self.__close_db() is False:
+                return -1
+            return rowcount
+
+
+
+class FileStateDB(DBManager):
+    """ Used to manage 'FileState' table in database.
+    'FileState' keeps state of files, found clean by last scan,
+    so unchanged files might be skipped by following scans (see ClamAV.scan).
+    It also keeps SHA-256 of files on filesystems without extended attributes (see hashing.HashingService).
+
+    Available methods:
+        public: get_states, update_states, update_hashes, update_ctimes
+        private: -
+
+    Dependencies:
+        built-in: datetime, logging, sqlite3
+        3-d party: -
+    """
+
+    def __init__(self, logging_level = 30, database = './modules/exclude.db'):
+        """ Manage file state index.
+        File state index is located in './modules/exclude.db', in table 'FileState'.
+        (Device, Inode) is a primary key in 'FileState' table.
+
+        'database' - path to database.
+        'logging_level' - verbosity of logging:
+            0 - debug,
+            30 - warnings,
+            50 - critical.
+            See 'logging' docs;
+        """
+
+        DBManager.__init__(self, logging_level, database)
+
+        self.FileStateDB = logging.getLogger('FileStateDB')
+        self.FileStateDB.debug('Initializing class...')
+
+        self.batch_size = 400 # (Device, Inode) pairs per query, keeps query under SQLite variables limit.
+
+        self.FileStateDB.debug('Class initialized.')
+
+
+    def get_states(self, keys: list) -> dict:
+        """ Get recorded states of files.
+
+        'keys' - list of (Device, Inode) tuples.
+
+        Return dict, looks like:
+        {
+            (Device, Inode): (Size, MtimeNs, CtimeNs, Hash, SignatureVersion),
+            ...
+        }
+        Files without recorded state are not in dict.
+        """
+
+        self.FileStateDB.debug('Getting {} file states...'.format(len(keys)))
+        states = dict()
+        for start in range(0, len(keys), self.batch_size):
+            batch = keys[start:start + self.batch_size]
+            command = """SELECT Device, Inode, Size, MtimeNs, CtimeNs, Hash, SignatureVersion FROM FileState
+                        WHERE (Device, Inode) IN (VALUES {});""".format(', '.join(['(?, ?)'] * len(batch)))
+            values = tuple(value for key in batch for value in key)
+            for row in self.query_db(command, values): # SQL
+                states[(row[0], row[1])] = row[2:]
+
+        self.FileStateDB.debug('{} file states found.'.format(len(states)))
+        return states
+
+    def update_states(self, states: list) -> bool:
+        """ Record states of clean files.
+        If Hash is None, recorded hash (see 'update_hashes') is kept while file is unchanged.
+
+        'states' - list of tuples (Device, Inode, Size, MtimeNs, CtimeNs, Hash, SignatureVersion).
+
+        Return True if states recorded.
+        """
+
+        self.FileStateDB.info('Recording {} file states...'.format(len(states)))
+        date = str(datetime.datetime.now())
+        return self.execute_many_db("""INSERT INTO FileState
+                                    (Device, Inode, Size, MtimeNs, CtimeNs, Hash, SignatureVersion, Date)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                                    ON CONFLICT (Device, Inode) DO UPDATE SET
+                                        Hash = CASE WHEN excluded.Hash IS NULL AND (Size, MtimeNs, CtimeNs) = (excluded.Size, excluded.MtimeNs, excluded.CtimeNs)
+                                               THEN Hash ELSE excluded.Hash END,
+                                        Size = excluded.Size, MtimeNs = excluded.MtimeNs, CtimeNs = excluded.CtimeNs,
+                                        SignatureVersion = excluded.SignatureVersion, Date = excluded.Date;""", (state + (date,) for state in states)) # SQL
+
+    def update_hashes(self, hashes: list) -> bool:
+        """ Record SHA-256 of files.
+        Hash-only records are never treated as clean (SignatureVersion is -1),
+        clean state of file is kept only if file is unchanged since it was recorded.
+
+        'hashes' - list of tuples (Device, Inode, Size, MtimeNs, CtimeNs, Hash).
+
+        Return True if hashes recorded.
+        """
+
+        self.FileStateDB.debug('Recording {} file hashes...'.format(len(hashes)))
+        date = str(datetime.datetime.now())
+        return self.execute_many_db("""INSERT INTO FileState
+                                    (Device, Inode, Size, MtimeNs, CtimeNs, Hash, SignatureVersion, Date)
+                                    VALUES (?, ?, ?, ?, ?, ?, -1, ?)
+                                    ON CONFLICT (Device, Inode) DO UPDATE SET
+                                        SignatureVersion = CASE WHEN (Size, MtimeNs, CtimeNs) = (excluded.Size, excluded.MtimeNs, excluded.CtimeNs)
+                                                           THEN SignatureVersion ELSE -1 END,
+                                        Size = excluded.Size, MtimeNs = excluded.MtimeNs, CtimeNs = excluded.CtimeNs,
+                                        Hash = excluded.Hash, Date = excluded.Date;""", (hash_ + (date,) for hash_ in hashes)) # SQL
+
+    def update_ctimes(self, changes: list) -> bool:
+        """ Refresh ctime of recorded states, changed by envySec itself (see hashing.HashingService).
+        State is refreshed only if it matches file before the change, so changed files are not turned unchanged.
+
+        'changes' - list of tuples (Device, Inode, Size, MtimeNs, old CtimeNs, new CtimeNs).
+
+        Return True if states refreshed.
+        """
+
+        self.FileStateDB.debug('Refreshing ctime of {} file states...'.format(len(changes)))
+        return self.execute_many_db("""UPDATE FileState SET CtimeNs = ?
+                                    WHERE Device = ? AND Inode = ? AND Size = ? AND MtimeNs = ? AND CtimeNs = ?;""",
+                                    ((change[5],) + change[:5] for change in changes)) # SQL
+
+
+
+class QuotaDB(DBManager):
+    """ Used to manage 'Quota' table in database.
+    'Quota' counts Metadefender requests per API key, per category and per day (UTC),
+    so concurrent and following runs share one daily budget (see Metadefender.__request).
+
+    Available methods:
+        public: consume, sync, exhaust
+        private: __today
+
+    Dependencies:
+        built-in: datetime, hashlib, logging
+        3-d party: -
+
+    API keys are not stored, SHA-256 of key is used instead.
+    """
+
+    def __init__(self, logging_level = 30, database = './modules/exclude.db'):
+        """ Manage daily quota accounting.
+        Quota accounting is located in './modules/exclude.db', in table 'Quota'.
+        (Key, Day, Category) is a primary key in 'Quota' table.
+
+        'database' - path to database.
+        'logging_level' - verbosity of logging:
+            0 - debug,
+            30 - warnings,
+            50 - critical.
+            See 'logging' docs;
+        """
+
+        DBManager.__init__(self, logging_level, database)
+
+        self.QuotaDB = logging.getLogger('QuotaDB')
+        self.QuotaDB.debug('Initializing class...')
+        self.QuotaDB.debug('Class initialized.')
+
+
+    def consume(self, apikey: str, category: str, amount = 1, limit = None) -> bool:
+        """ Take 'amount' requests from today\'s quota.
+        Check and update are done by single UPDATE, so concurrent runs can\'t overspend quota.
+
+        'apikey' - Metadefender API key;
+        'category' - quota category ('hash', 'reputation', 'file');
+        'amount' - number of requests (negative amount returns requests to quota);
+        'limit' - configured daily limit, None - limit is known only from Metadefender responses (see 'sync').
+
+        Return True if quota is enough (or database is unavailable, so accounting is skipped).
+        Return False if quota is exceeded.
+        """
+
+        key = hashlib.sha256(apikey.encode('utf-8')).hexdigest()
+        day = self.__today()
+        date = str(datetime.datetime.now())
+        self.modify_db("""INSERT OR IGNORE INTO Quota (Key, Day, Category, Used, QuotaLimit, Date)
+                        VALUES (?, ?, ?, 0, NULL, ?);""", (key, day, category, date)) # SQL
+        rowcount = self.modify_db("""UPDATE Quota SET Used = MAX(Used + ?, 0), Date = ?
+                                    WHERE Key = ? AND Day = ? AND Category = ?
+                                    AND (? <= 0 OR ((? IS NULL OR Used + ? <= ?) AND (QuotaLimit IS NULL OR Used + ? <= QuotaLimit)));""",
+                                    (amount, date, key, day, category, amount, limit, amount, limit, amount)) # SQL
+
+        if rowcount == 0:
+            self.QuotaDB.warning('Daily {} quota exceeded.'.format(category))
             return False
+        elif rowcount < 0:
+            self.QuotaDB.error('Failed to account {} quota, accounting skipped.'.format(category))
+        return True
 
-        self.DBManager.debug('Checking database.')
-        if self.__connect_db() is True:
-            self.DBManager.debug('Database check passed witout errors, closing.')
-            self.__close_db()
-            self.DBManager.debug('Database closed.')
-        else:
-            self.DBManager.error('Cannot connect database!')
+    def sync(self, apikey: str, category: str, limit: int, remaining: int) -> bool:
+        """ Update today\'s quota using limits reported by Metadefender
+        ('X-RateLimit-Limit' and 'X-RateLimit-Remaining' headers).
+
+        Return True if quota updated.
+        """
+
+        key = hashlib.sha256(apikey.encode('utf-8')).hexdigest()
+        self.QuotaDB.debug('{} quota reported: {} of {} remaining.'.format(category, remaining, limit))
+        return self.modify_db("""INSERT INTO Quota (Key, Day, Category, Used, QuotaLimit, Date) VALUES (?, ?, ?, ?, ?, ?)
+                                ON CONFLICT (Key, Day, Category) DO UPDATE SET
+                                Used = MAX(Used, excluded.Used), QuotaLimit = excluded.QuotaLimit, Date = excluded.Date;""",
+                                (key, self.__today(), category, max(limit - remaining, 0), limit, str(datetime.datetime.now()))) > 0 # SQL
+
+    def exhaust(self, apikey: str, category: str) -> bool:
+        """ Mark today\'s quota as exceeded (Metadefender replied 429000).
+
+        Return True if quota updated.
+        """
+
+        key = hashlib.sha256(apikey.encode('utf-8')).hexdigest()
+        self.QuotaDB.warning('Metadefender reported daily {} quota exceeded.'.format(category))
+        return self.modify_db("""UPDATE Quota SET QuotaLimit = Used, Date = ?
+                                WHERE Key = ? AND Day = ? AND Category = ?;""",
+                                (str(datetime.datetime.now()), key, self.__today(), category)) > 0 # SQL
+
+
+    def __today(self) -> str:
+        """ Return current UTC date, Metadefender resets quotas daily. """
+
+        return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')
+
+
+
+class CacheDB(DBManager):
+    """ Used to manage 'ReportCache' table in database.
+    'ReportCache' keeps Metadefender responses, so repeated lookups of the same
+    hash, IP, domain or URL do not take time and API quota (see Metadefender.__cached_get).
+
+    Available methods:
+        public: get_many, put_many, stats
+        private: __evict
+
+    Dependencies:
+        built-in: logging, sqlite3, threading, time
+        3-d party: -
+
+    Entries expire after TTL given on 'put_many'.
+    Cache is limited to 'max_entries', least recently used entries are evicted first.
+    Cache database has it\'s own schema versions (see 'MIGRATIONS').
+    """
+
+    # Schema migrations of './modules/cache.db', see DBManager.MIGRATIONS.
+    MIGRATIONS = [
+        # 1: report cache. Earlier versions created it on first use, so it might exist already.
+        ["""CREATE TABLE IF NOT EXISTS ReportCache (
+                Type TEXT NOT NULL,
+                Key TEXT NOT NULL,
+                Status INTEGER NOT NULL,
+                Report TEXT NOT NULL,
+                Expires REAL NOT NULL,
+                LastUsed REAL NOT NULL,
+                PRIMARY KEY (Type, Key));"""],
+        # 2: eviction order index (see '__evict').
+        ["""CREATE INDEX IF NOT EXISTS ReportCacheLastUsed ON ReportCache (LastUsed);"""],
+    ]
+
+    def __init__(self, logging_level = 30, database = './modules/cache.db', max_entries = 100000):
+        """ Manage report cache.
+        Report cache is located in './modules/cache.db', in table 'ReportCache'.
+        (Type, Key) is a primary key in 'ReportCache' table.
+
+        'database' - path to database;
+        'max_entries' - max number of cached responses;
+        'logging_level' - verbosity of logging:
+            0 - debug,
+            30 - warnings,
+            50 - critical.
+            See 'logging' docs;
+        """
+
+        DBManager.__init__(self, logging_level, database)
+
+        self.CacheDB = logging.getLogger('CacheDB')
+        self.CacheDB.debug('Initializing class...')
+
+        self.max_entries = max_entries
+        self.batch_size = 400 # Keys per query, keeps query under SQLite variables limit.
+        self.hits = dict() # Type: number of cache hits
+        self.misses = dict() # Type: number of cache misses
+        self.__stats_lock = threading.Lock() # Cache is shared by concurrent commands and lookup threads.
+
+        self.CacheDB.debug('Class initialized.')
+
+
+    def get_many(self, type_: str, keys: list) -> dict:
+        """ Get cached responses.
+
+        'type_' - response type ('hash', 'ip', 'domain', 'url');
+        'keys' - list of keys (hashes, addresses...).
+
+        Return dict, looks like:
+        {
+            key: (HTTP status, response text),
+            ...
+        }
+        Keys without cached response (or with expired one) are not in dict.
+        """
+
+        now = time.time()
+        cached = dict()
+        for start in range(0, len(keys), self.batch_size):
+            batch = keys[start:start + self.batch_size]
+            command = """SELECT Key, Status, Report FROM ReportCache
+                        WHERE Type = ? AND Expires > ? AND Key IN ({});""".format(', '.join(['?'] * len(batch)))
+            for row in self.query_db(command, (type_, now) + tuple(batch)): # SQL
+                cached[row[0]] = (row[1], row[2])
+
+        if len(cached) > 0:
+            self.execute_many_db("UPDATE ReportCache SET LastUsed = ? WHERE Type = ? AND Key = ?;",
+                                 ((now, type_, key) for key in cached)) # SQL
+
+        with self.__stats_lock:
+            self.hits[type_] = self.hits.get(type_, 0) + len(cached)
+            self.misses[type_] = self.misses.get(type_, 0) + len(keys) - len(cached)
+        self.CacheDB.debug('{}: {} of {} keys found in cache.'.format(type_, len(cached), len(keys)))
+        return cached
+
+    def put_many(self, type_: str, entries: dict, ttl: float) -> bool:
+        """ Cache responses.
+
+        'type_' - response type ('hash', 'ip', 'domain', 'url');
+        'entries' - dict, looks like {key: (HTTP status, response text)};
+        'ttl' - time (in seconds) responses are valid.
+
+        Return True if responses cached.
+        """
+
+        if len(entries) == 0:
+            return True
+
+        now = time.time()
+        self.CacheDB.debug('{}: caching {} responses for {} seconds.'.format(type_, len(entries), ttl))
+        if self.execute_many_db("""INSERT OR REPLACE INTO ReportCache (Type, Key, Status, Report, Expires, LastUsed)
+                                VALUES (?, ?, ?, ?, ?, ?);""",
+                                ((type_, key, status, report, now + ttl, now) for key, (status, report) in entries.items())) is False: # SQL
             return False
+        return self.__evict()
+
+    def stats(self) -> dict:
+        """ Return cache hit/miss counters, looks like {'hash': {'Hits': 10, 'Misses': 2}, ...}. """
+
+        with self.__stats_lock:
+            return {type_: {"Hits": self.hits.get(type_, 0), "Misses": self.misses.get(type_, 0)}
+                    for type_ in set(self.hits) | set(self.misses)}
+
+
+    def __evict(self) -> bool:
+        """ Remove expired entries, then least recently used ones above 'self.max_entries'. """
 
-        self.DBManager.debug('Database created.')
+        self.modify_db("DELETE FROM ReportCache WHERE Expires <= ?;", (time.time(),)) # SQL
+        rows = self.query_db("SELECT COUNT(*) FROM ReportCache;") # SQL
+        excess = rows[0][0] - self.max_entries if len(rows) > 0 else 0
+        if excess > 0:
+            self.CacheDB.debug('Evicting {} least recently used entries.'.format(excess))
+            return self.modify_db("""DELETE FROM ReportCache WHERE rowid IN
+                                    (SELECT rowid FROM ReportCache ORDER BY LastUsed LIMIT ?);""", (excess,)) >= 0 # SQL
         return True
 
-    def execute_db(self, command: str, values: tuple = None) -> bool:
-        """ Execute SQL command.
 
-        Default database structure is consist of 2 tables:
-        'Exclusion', used to control user exclude list,
-        'Statistic', used to store scan statistic.
 
-        By default, table 'Exclusion' have 2 columns:
-        'Path' - is a path to file or dir to be excluded from scan,
-        'Date' - is a date exclusion were added.
+class StatisticDB(DBManager):
+    """ Used to manage 'Statistic' table in database.
+    'Statistic' keeps history of ClamAV detections and their Metadefender verdicts.
 
-        By default, table 'Statistic' have 3 columns:
-        'Found' - is a path to file or dir to infected file,
-        'Date' - is a date infected file were found,
-        'TotalReports' - is a number of infected file reports.
+    Available methods:
+        public: record, flush, close, seen, history
+        private: __writer
+
+    Dependencies:
+        built-in: datetime, logging, queue, sqlite3, threading
+        3-d party: -
+
+    Detections are written by background thread in batches ('batch_size' rows or every 'flush_interval' seconds),
+    so 'record' never waits for database. Rows are indexed by hash, path and date (see DBManager.MIGRATIONS).
+    """
+
+    def __init__(self, logging_level = 30, database = './modules/exclude.db', batch_size = 500, flush_interval = 2):
+        """ Manage detections history.
+        Detections history is located in './modules/exclude.db', in table 'Statistic'.
+
+        'database' - path to database;
+        'batch_size' - max rows written in single transaction;
+        'flush_interval' - max time (in seconds) recorded detection waits to be written;
+        'logging_level' - verbosity of logging:
+            0 - debug,
+            30 - warnings,
+            50 - critical.
+            See 'logging' docs;
         """
 
-        self.DBManager.info('Executing...')
-        if self.__connect_db() is True:
-            try:
-                self.DBManager.info('Adding exception to database.') # TODO: make it yield output
-                self.DBManager.debug('Verifying path...')
-
-                output = []
-                if values != None and type(values) == tuple:
-                    self.DBManager.debug('Executing {} with arguments {}'.format(command, values))
-                    for out in self.dbcursor.execute(command, values): # SQL
-                        output += out
-                    self.DBManager.debug('Executed;')
-                elif values == None:
-                    self.DBManager.debug('Executing {} with no arguments.'.format(command))
-                    for out in self.dbcursor.execute(command): # SQL
-                        self.DBManager.debug('Received: {};'.format(out))
-                        output += out
-                    self.DBManager.debug('Executed;')
-                elif type(values) != tuple:
-                    self.DBManager.critical('Cant execute command!')
-                    self.DBManager.error('Bad SQL values received: {}, turple should be received!'.format(values))
-                    raise TypeError('Bad SQL command arguments type!')
-                else:
-                    self.DBManager.error('Error occured, wont execute SQL command.')
-                    self.DBManager.debug('Bad SQL command: {}.'.format(command))
+        DBManager.__init__(self, logging_level, database)
 
-            except (sqlite3.ProgrammingError, sqlite3.OperationalError) as sql_err:
-                self.DBManager.warning('Failed execute SQL command.')
-                self.DBManager.debug('Database error log: {}'.format(str(sql_err.args)))
-                if self.__close_db() is True:
-                    self.DBManager.debug('Database closed secessfully.')
-                    return []
-                else:
-                    raise
-            finally:
-                self.DBManager.debug('Database management complete.')
-                if self.__close_db() is True:
-                    return output
-                else:
-                    return []
-        else:
-            return []
+        self.StatisticDB = logging.getLogger('StatisticDB')
+        self.StatisticDB.debug('Initializing class...')
+
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.__queue = queue.Queue() # Unbounded: recording must not block scan.
+        self.__writer_thread = None
+        self.__writer_lock = threading.Lock()
+
+        self.StatisticDB.debug('Class initialized.')
+
+
+    def record(self, found: str, signature = None, hashsum = None, total_reports = None, detected = None, verified = None):
+        """ Queue detection to be written.
+
+        'found' - path to infected file;
+        'signature' - ClamAV signature;
+        'hashsum' - SHA-256 of file;
+        'total_reports' - number of Metadefender engines detected file, None - not verified;
+        'detected' - date file were found (datetime), None - now;
+        'verified' - date Metadefender verdict were received (datetime), None - not verified.
+        """
+
+        with self.__writer_lock:
+            if self.__writer_thread is None:
+                self.__writer_thread = threading.Thread(target = self.__writer, daemon = True)
+                self.__writer_thread.start()
+
+        detected = detected if detected is not None else datetime.datetime.now()
+        self.__queue.put((found, str(detected), total_reports if total_reports is not None else 0, signature, hashsum,
+                          str(verified) if verified is not None else None))
+
+    def flush(self):
+        """ Wait until all recorded detections are written. """
+
+        self.__queue.join()
+
+    def close(self):
+        """ Write recorded detections, stop writer thread and close database. """
+
+        with self.__writer_lock:
+            if self.__writer_thread is not None:
+                self.__queue.put(None)
+                self.__writer_thread.join()
+                self.__writer_thread = None
+        DBManager.close(self)
+
+    def seen(self, hashsum = None, found = None) -> dict:
+        """ Check if file (content) was detected before.
+
+        'hashsum' - SHA-256 of file;
+        'found' - path to file (used if 'hashsum' is None).
+
+        Return dict, looks like {'Count': 3, 'First': '2023-05-01 10:00:00.000000', 'Last': '2023-05-20 12:00:00.000000'},
+        'First' and 'Last' are None if file was never detected.
+        """
+
+        column, value = ('Hash', hashsum) if hashsum is not None else ('Found', found)
+        rows = self.query_db("SELECT COUNT(*), MIN(Date), MAX(Date) FROM Statistic WHERE {} = ?;".format(column), (value,)) # SQL
+        count, first, last = rows[0] if len(rows) > 0 else (0, None, None)
+        return {"Count": count, "First": first, "Last": last}
+
+    def history(self, hashsum = None, found = None, since = None, fetch_size = None) -> tuple:
+        """ Yield recorded detections, newest first, without loading them into memory.
+
+        'hashsum' - SHA-256 of file, None - any;
+        'found' - path to file, None - any;
+        'since' - min detection date (datetime or str), None - any;
+        'fetch_size' - number of rows fetched at once (see DBManager.stream_db).
+
+        Yield tuples (Found, Date, Signature, Hash, TotalReports, Verified).
+        """
+
+        conditions = list()
+        values = tuple()
+        for column, value in (('Hash = ?', hashsum), ('Found = ?', found), ('Date >= ?', since)):
+            if value is not None:
+                conditions.append(column)
+                values += (str(value),)
+
+        command = "SELECT Found, Date, Signature, Hash, TotalReports, Verified FROM Statistic {} ORDER BY Date DESC;".format(
+                  'WHERE ' + ' AND '.join(conditions) if len(conditions) > 0 else '')
+        yield from self.stream_db(command, values, fetch_size = fetch_size) # SQL
+
+
+    def __writer(self):
+        """ Write queued detections in batches until None is received. """
+
+        stop = False
+        while stop is False:
+            batch = list()
+            try:
+                item = self.__queue.get() # Wait for first row of batch.
+                deadline = time.monotonic() + self.flush_interval
+                while item is not None:
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    item = self.__queue.get(timeout = max(0, deadline - time.monotonic()))
+                stop = item is None
+            except queue.Empty:
+                pass
+
+            if len(batch) > 0 and self.execute_many_db("""INSERT INTO Statistic (Found, Date, TotalReports, Signature, Hash, Verified)
+                                                          VALUES (?, ?, ?, ?, ?, ?);""", batch) is False: # SQL
+                self.StatisticDB.error('Failed to record {} detections.'.format(len(batch)))
+            self.StatisticDB.debug('{} detections recorded.'.format(len(batch)))
+            for _ in range(len(batch) + (1 if stop is True else 0)):
+                self.__queue.task_done()
 
 
 
@@ -283,8 +910,8 @@ class ExcludeDB(DBManager):
     """ Used to manage 'Exclusion' table in database.
 
     Available methods:
-        public: add_exception, remove_exception, get_exceptions
-        private: -
+        public: add_exception, add_exceptions, remove_exception, remove_exceptions, get_exceptions, iter_exceptions
+        private: __resolve_path
 
     Dependencies:
         built-in: datetime, logging, os, pathlib, sqlite3
@@ -294,7 +921,7 @@ class ExcludeDB(DBManager):
     def __init__(self, logging_level = 30, database = './modules/exclude.db'):
         """ Manage exclude list.
         Exclude list is located in './modules/exclude.db', in table 'Exclusion'.
-        'Path' is a primary key in 'Exclusion' table.
+        'Path' is unique in 'Exclusion' table.
 
         'database' - path to database with exclusions.
         'logging_level' - verbosity of logging:
@@ -313,18 +940,6 @@ class ExcludeDB(DBManager):
 
         self.ExcludeDB = logging.getLogger('ExcludeDB')
         self.ExcludeDB.debug('Initializing class...')
-
-        self.ExcludeDB.debug('Checking database existence...')
-        self.database = pathlib.Path('.').resolve().joinpath(database)
-        if self.database.exists() is True:
-            self.ExcludeDB.info('database found.')
-        elif DBManager.__create_db(self) is False:
-            self.ExcludeDB.critical('database path {} not found!'.format(self.database))
-            raise FileNotFoundError('Database path {} not found!'.format(self.database))
-        else:
-            self.ExcludeDB.error('database path {} not found!'.format(self.database))
-            self.ExcludeDB.info('{} database created.'.format(self.database))
-
         self.ExcludeDB.debug('Class initialized.')
 
 
@@ -332,21 +947,23 @@ class ExcludeDB(DBManager):
         """ Add path to exclude list.
         Exclude list is located in './modules/exclude.db', in table 'Exclusion'.
 
-        'path' - is a path to file or folder to be added to exclude list.
+        'path' - is a path to file or folder to be added to exclude list,
+            glob pattern or regular expression ('re:' prefix), see exclusions.ExclusionMatcher.
 
-        Used to connect and add path to 'exclude.db'.
+        Used to connect and add path to 'exclude.db'. Patterns are added as is.
         If 'Path' added, date will be automatically appended into table.
         """
 
         self.ExcludeDB.info('Adding exception...')
-        path = self.__resolve_path(path)
+        if exclusions.ExclusionMatcher.is_pattern(path) is False:
+            path = self.__resolve_path(path)
 
         try:
             self.ExcludeDB.info('Adding exception to database.')
             self.ExcludeDB.debug('Verifying path...')
-            if os.path.exists(path) is True:
+            if os.path.exists(path) is True or exclusions.ExclusionMatcher.is_pattern(path) is True:
                 self.ExcludeDB.debug('Add exception: {}'.format(path))
-                self.execute_db(command = "INSERT INTO Exclusion VALUES (?, ?)", values = (path, datetime.datetime.now(),)) # SQL
+                self.execute_db(command = "INSERT INTO Exclusion (Path, Date) VALUES (?, ?) ON CONFLICT (Path) DO NOTHING;", values = (path, str(datetime.datetime.now()),)) # SQL
             else:
                 self.ExcludeDB.warning('{} does not exists;'.format(path))
                 return False
@@ -369,7 +986,8 @@ class ExcludeDB(DBManager):
         """
 
         self.ExcludeDB.info('Removing exception...')
-        path = self.__resolve_path(path)
+        if exclusions.ExclusionMatcher.is_pattern(path) is False:
+            path = self.__resolve_path(path)
 
         try:
             self.ExcludeDB.info('Removing {} from database.'.format(path))
@@ -384,28 +1002,72 @@ class ExcludeDB(DBManager):
             self.ExcludeDB.debug('Database management complete.')
             return True
 
+    def add_exceptions(self, paths: 'iterable') -> int:
+        """ Add many paths (patterns) to exclude list in single transaction, see 'add_exception'.
+        'paths' might be generator (lines of file), it is consumed while rows are inserted.
+
+        'paths' - iterable of paths to files or folders, glob patterns or regular expressions.
+
+        Return number of added exceptions (paths already in exclude list are not counted).
+        Return -1 if database error occurred (nothing is added).
+        """
+
+        self.ExcludeDB.info('Adding exceptions...')
+        date = str(datetime.datetime.now())
+
+        def __rows():
+            """ Yield (Path, Date) of existing paths and patterns. """
+
+            for path in paths:
+                if exclusions.ExclusionMatcher.is_pattern(path) is False:
+                    path = self.__resolve_path(path)
+                    if os.path.exists(path) is False:
+                        self.ExcludeDB.warning('{} does not exists;'.format(path))
+                        continue
+                yield path, date
+
+        added = self.modify_many_db("INSERT INTO Exclusion (Path, Date) VALUES (?, ?) ON CONFLICT (Path) DO NOTHING;", __rows()) # SQL
+        self.ExcludeDB.info('{} exceptions added.'.format(added))
+        return added
+
+    def remove_exceptions(self, paths: 'iterable') -> int:
+        """ Remove many paths (patterns) from exclude list in single transaction, see 'remove_exception'.
+
+        'paths' - iterable of paths to files or folders, glob patterns or regular expressions.
+
+        Return number of removed exceptions.
+        Return -1 if database error occurred (nothing is removed).
+        """
+
+        self.ExcludeDB.info('Removing exceptions...')
+        removed = self.modify_many_db("DELETE FROM Exclusion WHERE Path = ?;", # SQL
+                                      ((path if exclusions.ExclusionMatcher.is_pattern(path) is True else self.__resolve_path(path),) for path in paths))
+        self.ExcludeDB.info('{} exceptions removed.'.format(removed))
+        return removed
+
     def get_exceptions(self) -> dict:
         """ Get all items from exclude database.
 
         Used to connect and get list from 'exclude.db'.
 
-        Return None if database error occurred.
+        Return dict, looks like {'path': 'date added', ...}.
+        Return empty dict if database error occurred.
         """
 
         self.ExcludeDB.info('Getting exceptions...')
-        exclude_list = {}
+        exclude_list = dict(self.iter_exceptions())
+        self.ExcludeDB.debug('Total exclude list: {}'.format(len(exclude_list)))
+        return exclude_list
 
-        try:
-            self.ExcludeDB.debug('Getting exclude list;')
-            exclude_list = dict(zip(self.execute_db(command = "SELECT Path FROM Exclusion;"), self.execute_db(command = "SELECT Date FROM Exclusion;"))) # SQL
-            self.ExcludeDB.debug('Total exclude list: {}'.format(exclude_list))
-        except (sqlite3.ProgrammingError, sqlite3.OperationalError) as sql_err:
-            self.ExcludeDB.warning('Failed execute SQL command.')
-            self.ExcludeDB.debug('Database error log: {}'.format(str(sql_err.args)))
-            return {}
-        finally:
-            self.ExcludeDB.debug('Database management complete.')
-            return exclude_list
+    def iter_exceptions(self, fetch_size = None) -> tuple:
+        """ Yield exclude list without loading it into memory.
+
+        'fetch_size' - number of rows fetched at once, None - default one (see DBManager.stream_db).
+
+        Yield tuples (path, date added), ordered by path.
+        """
+
+        yield from self.stream_db("SELECT Path, Date FROM Exclusion ORDER BY Path;", fetch_size = fetch_size) # SQL
 
     def __resolve_path(self, path: str) -> str:
         """ Resolve path string to absolute path.
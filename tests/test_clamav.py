@@ -0,0 +1,236 @@
+import hashlib
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules import clamav
+from modules import clamd
+from modules import hashing
+from modules import sql_management
+
+
+FAKE_CLAMSCAN = """#!{python}
+import sys
+if '--version' in sys.argv:
+    print('ClamAV 1.0.0/27000/Thu Oct  1 07:00:00 2026')
+    sys.exit(0)
+paths = list()
+for arg in sys.argv[1:]:
+    if arg.startswith('--file-list='):
+        paths += [path for path in open(arg.split('=', 1)[1]).read().split('\\n') if path != '']
+    elif arg.startswith('-') is False:
+        paths.append(arg)
+found = False
+for path in paths:
+    with open(path, 'rb') as file_:
+        if b'EVIL' in file_.read():
+            print(path + ': Eicar-Test-Signature FOUND') # Printed as is, like clamscan does.
+            found = True
+sys.exit(1 if found is True else 0)
+"""
+
+FAKE_CLAMD = """#!{python}
+import socket
+import sys
+config = open(sys.argv[1].split('=', 1)[1]).read().splitlines()
+server = socket.socket(socket.AF_UNIX)
+server.bind([line.split(' ', 1)[1] for line in config if line.startswith('LocalSocket ')][0])
+server.listen()
+while True:
+    connection = server.accept()[0]
+    if connection.recv(1024).startswith(b'zPING') is True:
+        connection.sendall(b'PONG\\0')
+    connection.close()
+"""
+
+
+class ShardedScanTest(unittest.TestCase):
+    """ Sharded clamscan runs against fake clamscan. """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        scanner = os.path.join(self.root, 'clamscan')
+        with open(scanner, 'w') as scanner_f:
+            scanner_f.write(FAKE_CLAMSCAN.format(python = sys.executable))
+        os.chmod(scanner, 0o700)
+        self.clam = clamav.ClamAV({"Scanner": scanner, "Updater": scanner})
+
+        self.target = os.path.join(self.root, 'target')
+        os.mkdir(self.target)
+        for name, content in (('clean', b'clean'), ('evil', b'EVIL'), ('hidden\nevil', b'EVIL'), ('hidden\nclean', b'clean')):
+            with open(os.path.join(self.target, name), 'wb') as file_:
+                file_.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_newline_paths_are_scanned(self):
+        found = sorted(self.clam.scan([self.target], workers = 2))
+
+        self.assertEqual(found, sorted('{}: Eicar-Test-Signature FOUND'.format(os.path.join(self.target, name))
+                                       for name in ('evil', 'hidden\nevil')))
+        self.assertEqual(self.clam.scan_stats["Scanned"], 4)
+        self.assertEqual(self.clam.returncode, 1)
+
+    def test_clean_states_keep_hashes(self):
+        for name in ('copy', 'twin'): # Same content, hashed by dedup.
+            with open(os.path.join(self.target, name), 'wb') as file_:
+                file_.write(b'clone')
+        state_db = sql_management.FileStateDB(database = os.path.join(self.root, 'state.db'))
+        try:
+            list(self.clam.scan([self.target], workers = 2, state_db = state_db, dedup = True))
+            stats = {name: os.stat(os.path.join(self.target, name)) for name in ('clean', 'copy', 'twin')}
+            states = state_db.get_states([(stat.st_dev, stat.st_ino) for stat in stats.values()])
+        finally:
+            state_db.close()
+
+        digest = hashlib.sha256(b'clone').hexdigest()
+        self.assertEqual(states[(stats["copy"].st_dev, stats["copy"].st_ino)][3], digest)
+        self.assertEqual(states[(stats["twin"].st_dev, stats["twin"].st_ino)][3], digest)
+        self.assertEqual(states[(stats["clean"].st_dev, stats["clean"].st_ino)][4], 27000)
+
+    @unittest.skipIf(hasattr(os, 'setxattr') is False, 'extended attributes are not supported')
+    def test_memoized_file_is_not_rescanned(self):
+        state_db = sql_management.FileStateDB(database = os.path.join(self.root, 'state.db'))
+        hasher = hashing.HashingService(workers = 1, memo = True, state_db = state_db)
+        try:
+            list(self.clam.scan([self.target], workers = 2, state_db = state_db))
+            hasher.sha256(os.path.join(self.target, 'clean')) # Memoized in extended attribute, ctime is changed.
+            list(self.clam.scan([self.target], workers = 2, state_db = state_db))
+        finally:
+            hasher.close()
+            state_db.close()
+
+        self.assertEqual(self.clam.scan_stats["Skipped"], 2) # 'clean' and 'hidden\nclean'.
+
+    @unittest.skipIf(hasattr(os, 'setxattr') is False, 'extended attributes are not supported')
+    def test_dedup_ignores_forged_memo(self):
+        evil = os.path.join(self.target, 'evil')
+        with open(os.path.join(self.target, 'clone'), 'wb') as file_: # Same size as 'evil', clean.
+            file_.write(b'EVIl')
+        evil_stat = os.stat(evil)
+        forged = '{}:{}:{}'.format(evil_stat.st_mtime_ns, evil_stat.st_size, hashlib.sha256(b'EVIl').hexdigest())
+        os.setxattr(evil, hashing.HashingService.XATTR, forged.encode('ascii')) # Owner claims 'evil' is a copy of 'clone'.
+
+        hasher = hashing.HashingService(workers = 1, memo = True)
+        try:
+            found = list(self.clam.scan([self.target], workers = 2, dedup = True, hasher = hasher))
+        finally:
+            hasher.close()
+
+        self.assertEqual(sorted(found), sorted('{}: Eicar-Test-Signature FOUND'.format(os.path.join(self.target, name))
+                                               for name in ('evil', 'hidden\nevil')))
+
+    def scan_removing(self, remove, **kwargs) -> list:
+        """ Scan target, files of shards chosen by 'remove' (shards -> list of shards) are removed after walk. """
+
+        make_shards = self.clam._ClamAV__make_shards
+
+        def __make_shards(files, shards):
+            result = make_shards(files, shards)
+            for shard in remove(result):
+                for path, stat in shard:
+                    os.remove(path)
+            return result
+
+        with mock.patch.object(self.clam, '_ClamAV__make_shards', __make_shards):
+            return list(self.clam.scan([self.target], workers = 2, **kwargs))
+
+    def test_removed_shard_is_skipped(self):
+        found = self.scan_removing(lambda shards: shards[:1] + shards[-1:]) # Listed and unlisted ('hidden\n...') shards.
+
+        self.assertEqual(self.clam.shard_returncodes[0], 0)
+        self.assertEqual(self.clam.shard_returncodes[-1], 0)
+        self.assertEqual(os.listdir(self.target), ['evil']) # 'clean' is in the largest shard.
+        self.assertEqual(found, ['{}: Eicar-Test-Signature FOUND'.format(os.path.join(self.target, 'evil'))])
+
+    def test_removed_shards_in_daemon_mode(self):
+        self.clam.daemon = clamd.ClamD(os.path.join(self.root, 'missing.sock')) # Empty shards are not sent to clamd.
+
+        self.assertEqual(self.scan_removing(lambda shards: shards, daemon = True), [])
+        self.assertEqual(self.clam.returncode, 0)
+
+
+class FakeClamD():
+    """ clamd client, which never answers. """
+
+    address = 'fake.sock'
+
+    def ping(self) -> bool:
+        return False
+
+
+@unittest.skipIf(os.name == 'nt', 'Unix sockets only')
+class DaemonTest(unittest.TestCase):
+    """ Private clamd directory and watchdog. """
+
+    def setUp(self):
+        self.runtime = tempfile.mkdtemp()
+        self.clam = clamav.ClamAV({"Scanner": None, "Updater": None, "Daemon": None})
+
+    def tearDown(self):
+        shutil.rmtree(self.runtime)
+        if self.clam.daemon_dir is not None and self.clam.daemon_dir.startswith(tempfile.gettempdir()) is True:
+            shutil.rmtree(self.clam.daemon_dir, ignore_errors = True)
+
+    def daemon_dir(self) -> str:
+        with mock.patch.dict(os.environ, {"XDG_RUNTIME_DIR": self.runtime}):
+            return self.clam._ClamAV__daemon_dir()
+
+    def test_runtime_dir_is_used(self):
+        daemon_dir = self.daemon_dir()
+
+        self.assertEqual(daemon_dir, os.path.join(self.runtime, 'envysec-clamd'))
+        self.assertEqual(stat.S_IMODE(os.stat(daemon_dir).st_mode), 0o700)
+
+    def test_shared_dir_is_not_reused(self):
+        os.mkdir(os.path.join(self.runtime, 'envysec-clamd'))
+        os.chmod(os.path.join(self.runtime, 'envysec-clamd'), 0o777)
+
+        daemon_dir = self.daemon_dir()
+
+        self.assertNotEqual(daemon_dir, os.path.join(self.runtime, 'envysec-clamd'))
+        self.assertEqual(stat.S_IMODE(os.stat(daemon_dir).st_mode), 0o700)
+
+    def test_symlink_is_not_reused(self):
+        os.symlink(tempfile.gettempdir(), os.path.join(self.runtime, 'envysec-clamd'))
+
+        self.assertNotEqual(self.daemon_dir(), os.path.join(self.runtime, 'envysec-clamd'))
+
+    def test_private_clamd_is_not_started_at_system_address(self):
+        daemon = os.path.join(self.runtime, 'clamd')
+        with open(daemon, 'w') as daemon_f:
+            daemon_f.write(FAKE_CLAMD.format(python = sys.executable))
+        os.chmod(daemon, 0o700)
+        system_socket = os.path.join(self.runtime, 'system.ctl') # System clamd is down.
+        self.clam = clamav.ClamAV({"Scanner": None, "Updater": None, "Daemon": daemon}, daemon_address = system_socket)
+
+        with mock.patch.dict(os.environ, {"XDG_RUNTIME_DIR": os.path.join(self.runtime, 'missing')}):
+            self.assertTrue(self.clam.start_daemon(timeout = 10, watch_interval = 0.1))
+        daemon_dir = self.clam.daemon_dir
+        try:
+            self.assertEqual(self.clam.daemon.address, os.path.join(daemon_dir, 'clamd.sock'))
+            self.assertFalse(os.path.exists(system_socket))
+        finally:
+            process = self.clam.daemon_process
+            self.assertTrue(self.clam.stop_daemon())
+
+        self.assertIsNotNone(process.poll())
+        self.assertFalse(os.path.exists(daemon_dir)) # mkdtemp directory is removed.
+        self.assertIsNone(self.clam.daemon_watchdog)
+
+    def test_watchdog_gives_up_if_clamd_can_not_be_spawned(self):
+        self.clam.daemon = FakeClamD()
+
+        with self.assertLogs('ClamAV', level = 'CRITICAL'):
+            self.clam._ClamAV__watch_daemon(0.01, 1) # Returns instead of raising ValueError.
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import os
+import shutil
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules import clamd
+
+
+class FakeClamdHandler(socketserver.BaseRequestHandler):
+    """ clamd stand-in: PING, VERSION, IDSESSION scans and INSTREAM.
+    Content with 'EVIL' is infected, stream over 'max_stream' bytes is refused (like 'StreamMaxLength'),
+    clamd hangs (never replies) on content with 'HANG'.
+    """
+
+    def handle(self):
+        self.buffer = b''
+        command = self.read_command()
+        if command == 'zPING':
+            self.request.sendall(b'PONG\0')
+        elif command == 'zVERSION':
+            self.request.sendall(b'ClamAV 1.0.0/27000/Thu Oct  1 07:00:00 2026\0')
+        elif command == 'zIDSESSION':
+            request_id = 0
+            while True:
+                command = self.read_command()
+                if command in (None, 'zEND'):
+                    break
+                request_id += 1
+                path = command.split(' ', 1)[1]
+                with open(path, 'rb') as file_:
+                    content = file_.read()
+                if b'HANG' in content:
+                    return self.hang()
+                verdict = 'Eicar-Test-Signature FOUND' if b'EVIL' in content else 'OK'
+                self.request.sendall('{}: {}: {}\0'.format(request_id, path, verdict).encode('utf-8'))
+        elif command == 'zINSTREAM':
+            content = b''
+            while True:
+                size = struct.unpack('!L', self.read_exactly(4))[0]
+                if size == 0:
+                    break
+                if len(content) + size > self.server.max_stream:
+                    self.request.sendall(b'INSTREAM size limit exceeded. ERROR\0')
+                    self.request.shutdown(socket.SHUT_RDWR) # Unread data makes client's send fail.
+                    return
+                content += self.read_exactly(size)
+            if b'HANG' in content:
+                return self.hang()
+            self.request.sendall(b'stream: Eicar-Test-Signature FOUND\0' if b'EVIL' in content else b'stream: OK\0')
+
+    def hang(self):
+        """ Stop replying until client closes connection. """
+
+        while self.request.recv(65536):
+            pass
+
+    def read_exactly(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            data = self.request.recv(65536)
+            if not data:
+                raise ConnectionError('client closed connection')
+            self.buffer += data
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read_command(self) -> str:
+        while b'\0' not in self.buffer:
+            data = self.request.recv(65536)
+            if not data:
+                return None
+            self.buffer += data
+        command, self.buffer = self.buffer.split(b'\0', 1)
+        return command.decode('utf-8')
+
+
+def collect(generator) -> tuple:
+    """ Run scan generator, return (lines, returncode). """
+
+    lines = list()
+    while True:
+        try:
+            lines.append(next(generator))
+        except StopIteration as stop:
+            return lines, stop.value
+
+
+@unittest.skipIf(hasattr(socket, 'AF_UNIX') is False, 'Unix sockets only')
+class ClamDTest(unittest.TestCase):
+    """ ClamD client against fake clamd on Unix socket. """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.server = socketserver.ThreadingUnixStreamServer(os.path.join(self.root, 'clamd.sock'), FakeClamdHandler)
+        self.server.daemon_threads = True
+        self.server.max_stream = 1024 * 1024
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        self.client = clamd.ClamD('unix://' + os.path.join(self.root, 'clamd.sock'))
+
+        self.target = os.path.join(self.root, 'target')
+        os.mkdir(self.target)
+        for name, content in (('clean', b'clean'), ('evil', b'EVIL'), ('huge', b'\0' * 8 * 1024 * 1024)):
+            with open(os.path.join(self.target, name), 'wb') as file_:
+                file_.write(content)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def test_control_commands(self):
+        self.assertTrue(self.client.ping())
+        self.assertEqual(self.client.version(), 'ClamAV 1.0.0/27000/Thu Oct  1 07:00:00 2026')
+
+    def test_session_scan(self):
+        targets = [os.path.join(self.target, name) for name in ('clean', 'evil')]
+
+        lines, returncode = collect(self.client.scan(targets, mode = 'CONTSCAN'))
+
+        self.assertEqual(lines, ['{}: Eicar-Test-Signature FOUND'.format(targets[1])])
+        self.assertEqual(returncode, 1)
+
+    def test_instream_survives_reset_connection(self):
+        lines, returncode = collect(self.client.scan([self.target], mode = 'INSTREAM'))
+
+        self.assertEqual(lines, ['{}: Eicar-Test-Signature FOUND'.format(os.path.join(self.target, 'evil'))])
+        self.assertEqual(returncode, 2) # 'huge' is not scanned.
+
+    def test_instream_missing_file(self):
+        self.assertIs(self.client._ClamD__instream(os.path.join(self.target, 'missing')), False)
+
+    def test_silent_clamd_fails_scan(self):
+        hang = os.path.join(self.root, 'hang')
+        with open(hang, 'wb') as file_:
+            file_.write(b'HANG')
+        client = clamd.ClamD('unix://' + os.path.join(self.root, 'clamd.sock'), scan_timeout = 0.5)
+
+        self.assertEqual(collect(client.scan([os.path.join(self.target, 'evil'), hang], mode = 'CONTSCAN')),
+                         (['{}: Eicar-Test-Signature FOUND'.format(os.path.join(self.target, 'evil'))], 2))
+        self.assertEqual(collect(client.scan([hang], mode = 'INSTREAM')), ([], 2))
+
+    def test_unreachable_clamd(self):
+        self.assertFalse(clamd.ClamD(os.path.join(self.root, 'missing.sock')).ping())
+
+
+class AddressTest(unittest.TestCase):
+    """ clamd address parsing. """
+
+    def test_addresses(self):
+        client = clamd.ClamD('/run/clamd.ctl')
+        parse = client._ClamD__parse_address
+
+        self.assertEqual(parse('/run/clamd.ctl'), (socket.AF_UNIX, '/run/clamd.ctl'))
+        self.assertEqual(parse('unix:///run/clamd.ctl'), (socket.AF_UNIX, '/run/clamd.ctl'))
+        self.assertEqual(parse('tcp://127.0.0.1:3310'), (socket.AF_INET, ('127.0.0.1', 3310)))
+        self.assertEqual(parse('tcp://[::1]:3310'), (socket.AF_INET6, ('::1', 3310)))
+
+
+if __name__ == '__main__':
+    unittest.main()
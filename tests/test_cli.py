@@ -0,0 +1,118 @@
+import importlib.util
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import envysec
+from modules import output
+
+
+class FakeClam():
+    """ ClamAV stand-in: reports every target as infected. """
+
+    daemon = None
+    daemon_process = None
+
+    def __init__(self):
+        self.duplicates = dict()
+        self.scan_stats = {"Scanned": 0, "Skipped": 0, "SkippedBytes": 0, "Duplicates": 0, "DuplicateBytes": 0}
+
+    def stop_daemon(self):
+        self.daemon_process = None
+        return True
+
+    def scan(self, targets, **kwargs):
+        for target in targets:
+            self.scan_stats["Scanned"] += 1
+            yield '{}: Eicar-Test-Signature FOUND'.format(target.strip('\'\"'))
+
+
+class FakeMetadefender():
+    """ Metadefender stand-in: every hash is known and detected. """
+
+    def hash_file(self, target):
+        return 'AB' * 32
+
+    def lookup_hashes(self, hashes, cache = None):
+        return {hashsum: ({"FakeAV": "Eicar"}, {"TotalDetections": 1, "TotalAV": 1}) for hashsum in hashes}
+
+    def poll_reports(self, data_ids, timeout = None, source = None):
+        while source is not None and source.get() is not None:
+            pass
+        return iter(())
+
+
+class FakeStatistic():
+    def seen(self, hashsum = None, found = None):
+        return {"Count": 0, "First": None, "Last": None}
+
+    def record(self, *args, **kwargs):
+        pass
+
+
+class FakeSettings():
+    settings = {"ScanWorkers": 1, "HashBatchWindow": 0.1}
+
+
+class FakeExcludeDB():
+    def get_exceptions(self):
+        return dict()
+
+
+class FakeHasher():
+    workers = 1
+
+
+def interface(buffer: io.StringIO) -> envysec.ConsoleInterface:
+    """ ConsoleInterface with fake subsystems, records are written to 'buffer' as ndjson. """
+
+    cli = envysec.ConsoleInterface(output_format = 'ndjson')
+    cli.output = output.OutputWriter('ndjson', stream = buffer, message_records = True)
+    cli._ConsoleInterface__subsystems.update(envy_conf = FakeSettings(), clam = FakeClam(), metadef = FakeMetadefender(),
+                                             stat_db = FakeStatistic(), exclude_db = FakeExcludeDB(),
+                                             state_db = None, hasher = FakeHasher())
+    return cli
+
+
+@unittest.skipIf(importlib.util.find_spec('requests') is None, 'requests is not installed')
+class FileScannerTest(unittest.TestCase):
+    """ End-to-end run of file scan through lazily imported modules. """
+
+    def test_file_scan_reports_verified_detection(self):
+        with tempfile.NamedTemporaryFile() as target:
+            buffer = io.StringIO()
+            cli = interface(buffer)
+            self.assertTrue(cli.file_scanner([target.name]))
+            cli.output.close()
+
+        records = [json.loads(line) for line in buffer.getvalue().splitlines()]
+        files = [record for record in records if record["type"] == 'file']
+        self.assertEqual(len(files), 1)
+        self.assertEqual(files[0]["target"], target.name)
+        self.assertEqual(files[0]["status"], 'verified')
+        self.assertEqual(files[0]["signature"], 'Eicar-Test-Signature')
+        self.assertEqual([record["type"] for record in records][-1], 'summary')
+
+
+class CloseTest(unittest.TestCase):
+    """ Resources owned by subsystems are released on close. """
+
+    def test_private_clamd_is_stopped(self):
+        clam = FakeClam()
+        clam.daemon_process = object() # Private clamd was started.
+        cli = envysec.ConsoleInterface(output_format = 'ndjson')
+        cli.output = output.OutputWriter('ndjson', stream = io.StringIO())
+        cli._ConsoleInterface__subsystems.update(clam = clam)
+
+        cli.close()
+
+        self.assertIsNone(clam.daemon_process)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+import http.server
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeMetadefenderHandler(http.server.BaseHTTPRequestHandler):
+    """ Metadefender APIv4 stand-in: file upload and scan report.
+    Report is done on 3rd request, report of file named 'stuck' is never done.
+    """
+
+    def do_POST(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                self.rfile.read(size + 2)
+                if size == 0:
+                    break
+        else:
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        with self.server.lock:
+            data_id = '{}-{}'.format(self.headers["filename"], len(self.server.polls))
+            self.server.polls[data_id] = 0
+        self.reply(200, {"data_id": data_id})
+
+    def do_GET(self):
+        data_id = self.path.rsplit('/', 1)[-1]
+        with self.server.lock:
+            if data_id not in self.server.polls:
+                return self.reply(404, {"error": {"code": 404003, "messages": ["Not Found"]}})
+            self.server.polls[data_id] += 1
+            progress = 10 if data_id.startswith('stuck') is True else min(self.server.polls[data_id] * 50 - 50, 100)
+
+        self.reply(200, {
+            "file_info": {"display_name": data_id},
+            "scan_results": {
+                "progress_percentage": progress,
+                "scan_details": {"FakeAV": {"scan_result_i": 1, "threat_found": "Eicar"}},
+                "total_avs": 1,
+                "total_detected_avs": 1,
+                "scan_all_result_a": "Infected",
+                "total_time": 1
+            }
+        })
+
+    def reply(self, code: int, data: dict):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipIf(importlib.util.find_spec('requests') is None, 'requests is not installed')
+class AsyncMetadefenderTest(unittest.TestCase):
+    """ AsyncMetadefender file scans against local fake Metadefender server. """
+
+    def setUp(self):
+        import requests
+        from modules import metadefender
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeMetadefenderHandler)
+        self.server.lock = threading.Lock()
+        self.server.polls = dict() # data_id: number of report requests
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        base_url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+        class LocalSession(requests.Session):
+            """ Session sending Metadefender requests to fake server. """
+
+            def request(self, method, url, **kwargs):
+                return super().request(method, url.replace('https://api.metadefender.com', base_url), **kwargs)
+
+        self.metadef = metadefender.Metadefender('0' * 32, rate_limit = None, poll_timeout = 1)
+        self.metadef.session = LocalSession()
+        self.metadef.poll_interval = (0.01, 0.05)
+        self.async_metadef = metadefender.AsyncMetadefender(self.metadef, concurrency = 2)
+
+        self.root = tempfile.mkdtemp()
+        for name in ('first', 'second', 'stuck'):
+            with open(os.path.join(self.root, name), 'wb') as file_:
+                file_.write(name.encode())
+
+    def tearDown(self):
+        self.async_metadef.close()
+        self.metadef.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def test_scan_file_waits_for_reports(self):
+        targets = [os.path.join(self.root, name) for name in ('first', 'second')]
+
+        results = dict(self.async_metadef.scan_many('scan_file', targets))
+
+        self.assertEqual(sorted(results), sorted(targets))
+        for report in results.values():
+            self.assertEqual(report, ({"FakeAV": "Eicar"}, {"TotalAV": 1, "TotalDetections": 1, "TotalRecognized": "Infected", "TimeSpent": 1}))
+        self.assertEqual(sorted(self.server.polls.values()), [3, 3])
+
+    def test_scan_file_polling_is_bounded(self):
+        results = dict(self.async_metadef.scan_many('scan_file', [os.path.join(self.root, 'stuck')]))
+
+        self.assertEqual(list(results.values()), [False])
+        self.assertLess(list(self.server.polls.values())[0], 50) # Interval backs off while progress does not change.
+
+
+class BrokenMetadefender():
+    """ Metadefender stand-in: lookup raises 'lookup_error', upload fails with server error. """
+
+    poll_interval = (0.01, 0.05)
+
+    def __init__(self, lookup_error: Exception):
+        self.lookup_error = lookup_error
+        self.uploads = list()
+
+    def hash_file(self, target):
+        return target.upper()
+
+    def lookup_hashes(self, hashes, cache = None):
+        raise self.lookup_error
+
+    def scan_file(self, target, wait = True):
+        self.uploads.append(target)
+        raise ConnectionError('Metadefender: Server-side problem detected, please, try again later.', 503)
+
+    def poll_reports(self, data_ids, timeout = None, source = None):
+        while source is not None and source.get() is not None:
+            pass
+        return iter(())
+
+
+class UnknownMetadefender(BrokenMetadefender):
+    """ Metadefender stand-in: every hash is unknown, upload fails with server error. """
+
+    def lookup_hashes(self, hashes, cache = None):
+        return {hashsum: False for hashsum in hashes}
+
+
+@unittest.skipIf(importlib.util.find_spec('requests') is None, 'requests is not installed')
+class VerificationPipelineTest(unittest.TestCase):
+    """ Pipeline delivers result of every file and closes on Metadefender failures. """
+
+    def verify(self, lookup_error: Exception, metadefender_class = BrokenMetadefender) -> dict:
+        from modules import metadefender
+
+        results = dict()
+        self.metadef = metadefender_class(lookup_error)
+        pipeline = metadefender.VerificationPipeline(self.metadef, results.__setitem__,
+                                                     batch_size = 2, window = 0.01)
+        for target in ('a', 'b', 'c'):
+            pipeline.add(target)
+
+        closer = threading.Thread(target = pipeline.close, daemon = True)
+        closer.start()
+        closer.join(timeout = 10)
+        self.assertFalse(closer.is_alive(), 'close() is blocked')
+        return results
+
+    def test_server_error_is_not_reported_as_quota(self):
+        results = self.verify(ConnectionError('Metadefender: Server-side problem detected, please, try again later.', 500))
+
+        self.assertEqual(results, {"a": False, "b": False, "c": False})
+        self.assertEqual(self.metadef.uploads, []) # Failed lookup is not turned into uploads.
+
+    def test_unknown_hashes_are_uploaded(self):
+        results = self.verify(None, UnknownMetadefender)
+
+        self.assertEqual(results, {"a": False, "b": False, "c": False})
+        self.assertEqual(sorted(self.metadef.uploads), ['a', 'b', 'c'])
+
+    def test_quota_refusal_is_reported_as_not_verified(self):
+        results = self.verify(ConnectionRefusedError('Metadefender: rate limit or quota exceeded.'))
+
+        self.assertEqual(results, {"a": None, "b": None, "c": None})
+
+    def test_unexpected_lookup_error_does_not_block_close(self):
+        results = self.verify(TypeError('unexpected'))
+
+        self.assertEqual(results, {"a": False, "b": False, "c": False})
+        self.assertEqual(self.metadef.uploads, [])
+
+    def test_server_error_code(self):
+        from modules import metadefender
+
+        metadef = metadefender.Metadefender('0' * 32, rate_limit = None)
+        with self.assertRaises(ConnectionError) as raised:
+            metadef._Metadefender__http_code_check(500)
+        self.assertNotIsInstance(raised.exception, ConnectionRefusedError)
+        metadef.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
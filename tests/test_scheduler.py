@@ -0,0 +1,69 @@
+import io
+import json
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import envysec
+from modules import output
+from modules import scheduler
+
+
+class FakeAsyncMetadefender():
+    """ AsyncMetadefender stand-in: every lookup waits for the other command group at barrier,
+    so lookups pass only if command groups are run concurrently.
+    """
+
+    def __init__(self, parties: int):
+        self.barrier = threading.Barrier(parties, timeout = 10)
+
+    def scan_many(self, method, targets):
+        self.barrier.wait()
+        for target in targets:
+            yield target, {"FakeAV": '{} of {}'.format(method, target)}
+
+
+class CommandSchedulerTest(unittest.TestCase):
+    """ Commands depending on failed one are skipped, run reports failure. """
+
+    def test_failed_command_skips_dependent_ones(self):
+        def __fail():
+            raise ConnectionError('unreachable')
+
+        envy_scheduler = scheduler.CommandScheduler()
+        envy_scheduler.add('update', __fail)
+        envy_scheduler.add('scan_file', lambda: True, after = ('update',))
+        envy_scheduler.add('get_exceptions', lambda: True, after = ('scan_file',))
+        envy_scheduler.add('scan_ip', lambda: True)
+
+        self.assertFalse(envy_scheduler.run())
+        self.assertEqual(list(envy_scheduler.errors), ['update'])
+        self.assertEqual(envy_scheduler.skipped, ['scan_file', 'get_exceptions'])
+        self.assertEqual(envy_scheduler.results, {"scan_ip": True})
+
+
+class ConcurrentCommandsTest(unittest.TestCase):
+    """ Command groups share one ConsoleInterface while run concurrently. """
+
+    def test_url_and_domain_groups_run_concurrently(self):
+        buffer = io.StringIO()
+        cli = envysec.ConsoleInterface(output_format = 'ndjson')
+        cli.output = output.OutputWriter('ndjson', stream = buffer)
+        cli._ConsoleInterface__subsystems.update(async_metadef = FakeAsyncMetadefender(2))
+
+        envy_scheduler = scheduler.CommandScheduler()
+        envy_scheduler.add('scan_url', cli.url_scanner, ['example.com/{}'.format(index) for index in range(50)])
+        envy_scheduler.add('scan_domain', cli.domain_scanner, ['example{}.org'.format(index) for index in range(50)])
+        passed = envy_scheduler.run()
+        cli.close()
+
+        self.assertTrue(passed, envy_scheduler.errors)
+        records = [json.loads(line) for line in buffer.getvalue().splitlines()] # Records are not interleaved.
+        self.assertEqual(sorted(record["type"] for record in records), ['domain'] * 50 + ['url'] * 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules import sql_management
+
+
+class FileStateTest(unittest.TestCase):
+    """ File state index: clean states and memoized hashes share rows. """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.state_db = sql_management.FileStateDB(database = os.path.join(self.root, 'exclude.db'))
+
+    def tearDown(self):
+        self.state_db.close()
+        shutil.rmtree(self.root)
+
+    def test_clean_state_keeps_recorded_hash(self):
+        self.state_db.update_hashes([(1, 10, 100, 1000, 1000, 'ab' * 32)])
+        self.state_db.update_states([(1, 10, 100, 1000, 1000, None, 27000)])
+
+        self.assertEqual(self.state_db.get_states([(1, 10)]), {(1, 10): (100, 1000, 1000, 'ab' * 32, 27000)})
+
+    def test_clean_state_drops_hash_of_changed_file(self):
+        self.state_db.update_hashes([(1, 10, 100, 1000, 1000, 'ab' * 32)])
+        self.state_db.update_states([(1, 10, 101, 2000, 2000, None, 27000)])
+
+        self.assertEqual(self.state_db.get_states([(1, 10)]), {(1, 10): (101, 2000, 2000, None, 27000)})
+
+    def test_clean_state_records_new_hash(self):
+        self.state_db.update_hashes([(1, 10, 100, 1000, 1000, 'ab' * 32)])
+        self.state_db.update_states([(1, 10, 100, 1000, 1000, 'cd' * 32, 27000)])
+
+        self.assertEqual(self.state_db.get_states([(1, 10)]), {(1, 10): (100, 1000, 1000, 'cd' * 32, 27000)})
+
+
+class MigrationTest(unittest.TestCase):
+    """ Every table is created by versioned migrations of it\'s own database. """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def schema(self, database: str) -> tuple:
+        """ Return (user_version, set of table names) of database. """
+
+        connection = sqlite3.connect(os.path.join(self.root, database))
+        try:
+            version = connection.execute("PRAGMA user_version;").fetchone()[0]
+            tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table';")}
+        finally:
+            connection.close()
+        return version, tables
+
+    def test_databases_have_own_schema(self):
+        for manager in (sql_management.FileStateDB, sql_management.QuotaDB, sql_management.ExcludeDB):
+            manager(database = os.path.join(self.root, 'exclude.db')).close()
+        sql_management.CacheDB(database = os.path.join(self.root, 'cache.db')).close()
+
+        self.assertEqual(self.schema('exclude.db'), (len(sql_management.DBManager.MIGRATIONS), {'Exclusion', 'Statistic', 'FileState', 'Quota'}))
+        self.assertEqual(self.schema('cache.db'), (len(sql_management.CacheDB.MIGRATIONS), {'ReportCache'}))
+
+    def test_tables_created_on_first_use_are_kept(self):
+        connection = sqlite3.connect(os.path.join(self.root, 'exclude.db'))
+        connection.execute("""CREATE TABLE FileState (Device INTEGER NOT NULL, Inode INTEGER NOT NULL, Size INTEGER NOT NULL,
+                              MtimeNs INTEGER NOT NULL, CtimeNs INTEGER NOT NULL, Hash TEXT, SignatureVersion INTEGER NOT NULL,
+                              Date TEXT NOT NULL, PRIMARY KEY (Device, Inode));""")
+        connection.execute("INSERT INTO FileState VALUES (1, 10, 100, 1000, 1000, NULL, 27000, '');")
+        connection.commit()
+        connection.close()
+
+        state_db = sql_management.FileStateDB(database = os.path.join(self.root, 'exclude.db'))
+        try:
+            self.assertEqual(state_db.get_states([(1, 10)]), {(1, 10): (100, 1000, 1000, None, 27000)})
+        finally:
+            state_db.close()
+        self.assertEqual(self.schema('exclude.db')[0], len(sql_management.DBManager.MIGRATIONS))
+
+
+if __name__ == '__main__':
+    unittest.main()